@@ -0,0 +1,254 @@
+# general imports
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import subprocess
+import tracemalloc
+import contextlib
+import io
+import warnings
+import numpy as np
+
+# allow running from repo root or benchmarks folder
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# external scripts imports
+from scripts import analyses
+from scripts import change
+from scripts import indices
+from scripts import spatial
+import synthetic
+
+# globals
+RESULTS = os.path.join(os.path.dirname(__file__), 'results', 'pipeline.jsonl')
+SCENES = os.path.join(os.path.dirname(__file__), 'results', 'scenes')
+
+
+def get_peak_rss():
+    """
+    Gets the peak resident memory of this process in mb,
+    or None where the resource module is unavailable.
+
+    :return: Float of mb or None.
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # linux reports kb, mac reports bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if platform.system() == 'Darwin' else rss / 1024
+
+
+def get_commit():
+    """
+    Gets the short hash of the checked out commit.
+
+    :return: String hash or None.
+    """
+
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+class Timer:
+    """
+    Collects wall time and python peak memory of each
+    pipeline stage run within stage().
+    """
+
+    def __init__(self, quiet=True):
+        self.stages = {}
+        self.quiet = quiet
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        out = io.StringIO() if self.quiet else sys.stdout
+        tracemalloc.reset_peak()
+        s = time.perf_counter()
+        with contextlib.redirect_stdout(out):
+            yield
+        duration = time.perf_counter() - s
+        self.stages[name] = {'seconds': round(duration, 4),
+                             'peak_mb': round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 2)}
+
+
+def run_pipeline(client, geometry, from_date, to_date, timer, crs='EPSG:4326'):
+    """
+    Runs each stage of analyses.run_analysis in turn
+    against a stac client, timing every stage.
+
+    :param client: Stac client, e.g. synthetic.LocalStacClient.
+    :param geometry: List of latitude, longitude dicts.
+    :param from_date: Start date string (YYYY-MM-DD).
+    :param to_date: End date string (YYYY-MM-DD).
+    :param timer: Timer to record stages in.
+    :param crs: Crs to load in, e.g. synthetic.CRS for the native grid.
+    :return: Dataset of temporal means with outliers removed.
+    """
+
+    bbox = spatial.qml_polygon_to_bbox(geometry)
+
+    with timer.stage('query'):
+        items = analyses.query_stac(collections=[synthetic.COLLECTION],
+                                    from_date=from_date,
+                                    to_date=to_date,
+                                    bbox=bbox,
+                                    use_cache=False,
+                                    client=client)
+
+    with timer.stage('build'):
+        resolution, resampling = analyses.get_read_resolution(spatial.project_bbox(bbox, crs), crs=crs)
+        ds = analyses.build_dataset(items=items,
+                                    bbox=bbox,
+                                    crs=crs,
+                                    resolution=resolution,
+                                    like=None,
+                                    ignore_warnings=True,
+                                    bands=indices.get_bands('NDVI') + ['mask'],
+                                    resampling=resampling)
+
+    with timer.stage('mask'):
+        ds = analyses.mask_invalid_scenes(ds=ds,
+                                          mask_var='mask',
+                                          valid=[1, 4, 5],
+                                          min_pct=1.0,
+                                          drop_mask=True)
+
+    with timer.stage('index'):
+        ds = analyses.calculate_index(ds=ds, index='NDVI', drop_bands=True)
+
+    with timer.stage('load'):
+        ds = analyses.load_dataset(ds=ds, logic='all')
+
+    with timer.stage('change'):
+        change.detect_change(ds['veg_idx']).load()
+
+    with timer.stage('reduce'):
+        mask = spatial.rasterize_polygon(geometry, ds['x'].values, ds['y'].values,
+                                         erode=analyses.EDGE_PIXELS, crs=crs)
+        ds = analyses.get_temporal_means(ds, mask=mask)
+
+    with timer.stage('outliers'):
+        values = analyses.remove_outliers_array(ds['veg_idx'].values[np.newaxis],
+                                                ds['time'].values)
+
+    return ds, values
+
+
+def read_results(path):
+    """
+    Reads all previous benchmark runs.
+
+    :param path: Path to results jsonl.
+    :return: List of run dicts.
+    """
+
+    if not os.path.exists(path):
+        return []
+
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(runs):
+    """
+    Prints per-stage change between the last two runs.
+
+    :param runs: List of run dicts, oldest first.
+    :return: None.
+    """
+
+    if len(runs) < 2:
+        print('Need at least two runs to compare.')
+        return
+
+    old, new = runs[-2], runs[-1]
+    print('Comparing {} ({}) to {} ({}).'.format(old['commit'], old['timestamp'],
+                                                 new['commit'], new['timestamp']))
+    if old['params'] != new['params']:
+        print('Warning: runs used different parameters.')
+
+    print('{:<10}{:>10}{:>10}{:>9}{:>12}{:>12}'.format('stage', 'old s', 'new s', 'change',
+                                                       'old mb', 'new mb'))
+    for name, stage in new['stages'].items():
+        before = old['stages'].get(name)
+        if before is None:
+            continue
+        change = (stage['seconds'] - before['seconds']) / max(before['seconds'], 1e-9) * 100
+        print('{:<10}{:>10.3f}{:>10.3f}{:>8.1f}%{:>12.2f}{:>12.2f}'.format(
+            name, before['seconds'], stage['seconds'], change, before['peak_mb'], stage['peak_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the analysis pipeline offline against '
+                                                 'synthetic landsat scenes.')
+    parser.add_argument('--size', type=int, default=256, help='Scene width and height in pixels.')
+    parser.add_argument('--site-fraction', type=float, default=0.5, help='Site width as fraction of scene.')
+    parser.add_argument('--years', type=int, default=5, help='Length of record in years.')
+    parser.add_argument('--scenes-per-year', type=int, default=23, help='Scenes per year.')
+    parser.add_argument('--crs', default='native',
+                        help='Load on the native utm grid or warp to a crs, e.g. EPSG:4326.')
+    parser.add_argument('--scenes', default=SCENES, help='Folder to write synthetic scenes to.')
+    parser.add_argument('--output', default=RESULTS, help='Results jsonl to append to.')
+    parser.add_argument('--compare', action='store_true', help='Compare last two runs and exit.')
+    parser.add_argument('--verbose', action='store_true', help='Show pipeline output.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(read_results(args.output))
+        return
+
+    warnings.filterwarnings('ignore')
+    params = {'size': args.size, 'site_fraction': args.site_fraction,
+              'years': args.years, 'scenes_per_year': args.scenes_per_year, 'crs': args.crs}
+
+    # build scenes once per parameter set, reused by later runs
+    folder = os.path.join(args.scenes, '{size}_{years}_{scenes_per_year}'.format(**params))
+    print('Preparing synthetic scenes in {}.'.format(folder))
+    items = synthetic.make_items(folder, size=args.size, years=args.years,
+                                 scenes_per_year=args.scenes_per_year)
+    client = synthetic.LocalStacClient(items)
+    geometry = synthetic.site_geometry(args.size, fraction=args.site_fraction)
+
+    # run and time
+    print('Benchmarking pipeline over {} scenes.'.format(len(items)))
+    timer = Timer(quiet=not args.verbose)
+    tracemalloc.start()
+    s = time.perf_counter()
+    crs = synthetic.CRS if args.crs == 'native' else args.crs
+    ds, _ = run_pipeline(client, geometry, '2000-01-01', '{}-12-31'.format(2000 + args.years), timer, crs=crs)
+    total = time.perf_counter() - s
+    tracemalloc.stop()
+
+    run = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+           'commit': get_commit(),
+           'params': params,
+           'num_scenes': len(items),
+           'num_valid': int(ds['time'].size),
+           'total_seconds': round(total, 4),
+           'peak_rss_mb': get_peak_rss(),
+           'stages': timer.stages}
+
+    # show and store
+    for name, stage in timer.stages.items():
+        print('{:<10}{:>8.3f} s{:>10.2f} mb'.format(name, stage['seconds'], stage['peak_mb']))
+    print('Total: {:.3f} s, peak rss {} mb.'.format(total, run['peak_rss_mb']))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+
+
+if __name__ == '__main__':
+    main()
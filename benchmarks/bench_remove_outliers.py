@@ -0,0 +1,97 @@
+# general imports
+import os
+import sys
+import time
+import argparse
+import contextlib
+import io
+import warnings
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# allow running from repo root or benchmarks folder
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# external scripts imports
+from scripts import analyses
+
+
+def make_series(num_sites, num_times, seed=0):
+    """
+    Generates synthetic ndvi-like series with gaps and spikes.
+
+    :param num_sites: Number of series.
+    :param num_times: Number of scenes per series.
+    :param seed: Random seed.
+    :return: Tuple of 2d float32 values (sites, time) and datetimes.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    # roughly landsat revisit
+    times = pd.date_range('1990-01-01', periods=num_times, freq='16D').values
+
+    # seasonal signal plus noise, nan gaps and spikes
+    season = 0.2 * np.sin(np.arange(num_times) * 2 * np.pi / 23)
+    values = 0.4 + season + rng.normal(0, 0.03, (num_sites, num_times))
+    values[rng.random(values.shape) < 0.05] = np.nan
+    values[rng.random(values.shape) < 0.02] -= 0.4
+
+    return values.astype('float32'), times
+
+
+def run_xarray(values, times, user_factor):
+    """
+    Runs the xarray remove_outliers once per series.
+    """
+
+    results = np.empty_like(values)
+    for i, row in enumerate(values):
+        ds = xr.Dataset({'veg_idx': ('time', row)}, coords={'time': times})
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[i] = analyses.remove_outliers(ds, user_factor=user_factor)['veg_idx'].values
+
+    return results
+
+
+def run_numpy(values, times, user_factor):
+    """
+    Runs the array remove_outliers_array once for all series.
+    """
+
+    return analyses.remove_outliers_array(values, times, user_factor=user_factor)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark remove_outliers engines.')
+    parser.add_argument('--sites', type=int, default=2000)
+    parser.add_argument('--times', type=int, default=750)
+    parser.add_argument('--user-factor', type=float, default=2)
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore')
+    values, times = make_series(args.sites, args.times)
+    print('Benchmarking {} series of {} scenes.'.format(args.sites, args.times))
+
+    # time both engines
+    s = time.perf_counter()
+    xr_result = run_xarray(values, times, args.user_factor)
+    xr_duration = time.perf_counter() - s
+
+    s = time.perf_counter()
+    np_result = run_numpy(values, times, args.user_factor)
+    np_duration = time.perf_counter() - s
+
+    # check results agree
+    same_nans = np.array_equal(np.isnan(xr_result), np.isnan(np_result))
+    same_vals = np.allclose(np.nan_to_num(xr_result), np.nan_to_num(np_result))
+
+    print('xarray: {:.3f} s ({:.3f} ms per series)'.format(xr_duration, xr_duration / args.sites * 1000))
+    print('numpy:  {:.3f} s ({:.3f} ms per series)'.format(np_duration, np_duration / args.sites * 1000))
+    print('Speed up: {:.1f}x'.format(xr_duration / np_duration))
+    print('Results match: {}'.format(same_nans and same_vals))
+
+
+if __name__ == '__main__':
+    main()
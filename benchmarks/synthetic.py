@@ -0,0 +1,213 @@
+# general imports
+import os
+import datetime
+import numpy as np
+
+# raster imports
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from pyproj import Transformer
+
+# stac imports
+from pystac import Item, Asset, ItemCollection
+from shapely.geometry import box, shape, mapping
+from shapely.ops import transform as transform_geometry
+
+# globals
+CRS = 'EPSG:32750'              # utm 50s, pilbara
+ORIGIN = (400000.0, 7480000.0)  # top left of every synthetic scene
+RESOLUTION = 30                 # native landsat metres
+COLLECTION = 'ga_ls8c_ard_3'
+BANDS = ['nbart_blue', 'nbart_green', 'nbart_red', 'nbart_nir',
+         'nbart_swir_1', 'nbart_swir_2', 'oa_fmask']
+
+
+def write_cog(path, array, transform):
+    """
+    Writes a single band uint16 cloud optimised geotiff
+    with internal tiling and power of two overviews.
+
+    :param path: Output file path.
+    :param array: 2d uint16 numpy array.
+    :param transform: Affine transform of array.
+    :return: None.
+    """
+
+    profile = {'driver': 'GTiff', 'dtype': 'uint16', 'count': 1, 'nodata': 0,
+               'width': array.shape[1], 'height': array.shape[0],
+               'crs': CRS, 'transform': transform, 'tiled': True,
+               'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate'}
+
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(array, 1)
+        factors = [f for f in [2, 4, 8, 16] if min(array.shape) // f >= 1]
+        dst.build_overviews(factors, Resampling.average)
+
+
+def make_scene(folder, index, date, size, rng, invalid_rate):
+    """
+    Writes one synthetic landsat-like scene (six nbart bands
+    and an fmask band) and returns its stac item.
+
+    :param folder: Output folder.
+    :param index: Scene number, used in ids.
+    :param date: Scene datetime.
+    :param size: Scene width and height in pixels.
+    :param rng: Numpy random generator.
+    :param invalid_rate: Chance a scene holds cloud.
+    :return: pystac Item.
+    """
+
+    transform = from_origin(ORIGIN[0], ORIGIN[1], RESOLUTION, RESOLUTION)
+
+    # seasonal vegetation signal, red drops and nir rises with greenness
+    greenness = 0.5 + 0.3 * np.sin(date.timetuple().tm_yday / 365 * 2 * np.pi)
+    noise = rng.normal(0, 100, (size, size))
+    arrays = {
+        'nbart_blue': 600 + noise,
+        'nbart_green': 900 + noise,
+        'nbart_red': 1500 - 700 * greenness + noise,
+        'nbart_nir': 2000 + 1500 * greenness + noise,
+        'nbart_swir_1': 2500 + noise,
+        'nbart_swir_2': 1800 + noise,
+    }
+
+    # fmask valid (1) with an occasional cloud (2) blob
+    fmask = np.ones((size, size))
+    if rng.random() < invalid_rate:
+        y, x = rng.integers(0, size, 2)
+        fmask[max(y - size // 8, 0):y + size // 8, max(x - size // 8, 0):x + size // 8] = 2
+    arrays['oa_fmask'] = fmask
+
+    # write bands
+    scene_id = 'synthetic_{:05d}'.format(index)
+    assets = {}
+    for band in BANDS:
+        path = os.path.join(folder, '{}_{}.tif'.format(scene_id, band))
+        if not os.path.exists(path):
+            write_cog(path, np.clip(arrays[band], 1, 10000).astype('uint16'), transform)
+        assets[band] = Asset(href=os.path.abspath(path), media_type='image/tiff; application=geotiff')
+
+    # footprint in lat lon
+    to_wgs84 = Transformer.from_crs(CRS, 'EPSG:4326', always_xy=True).transform
+    footprint = box(ORIGIN[0], ORIGIN[1] - size * RESOLUTION, ORIGIN[0] + size * RESOLUTION, ORIGIN[1])
+    footprint = transform_geometry(to_wgs84, footprint)
+
+    item = Item(id=scene_id,
+                geometry=mapping(footprint),
+                bbox=list(footprint.bounds),
+                datetime=date,
+                properties={'proj:epsg': int(CRS.split(':')[1]),
+                            'proj:shape': [size, size],
+                            'proj:transform': list(transform)[:6]},
+                collection=COLLECTION)
+    for band, asset in assets.items():
+        item.add_asset(band, asset)
+
+    return item
+
+
+def make_items(folder, size=256, years=5, scenes_per_year=23, invalid_rate=0.3, seed=0):
+    """
+    Writes a synthetic record of scenes to a folder, reusing
+    any already written, and returns their stac items.
+
+    :param folder: Output folder.
+    :param size: Scene width and height in pixels.
+    :param years: Length of record in years.
+    :param scenes_per_year: Scenes per year (landsat 8 is ~23).
+    :param invalid_rate: Chance a scene holds cloud.
+    :param seed: Random seed.
+    :return: pystac ItemCollection.
+    """
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    start = datetime.datetime(2000, 1, 1, 2, tzinfo=datetime.timezone.utc)
+    step = datetime.timedelta(days=365 / scenes_per_year)
+
+    items = [make_scene(folder, i, start + step * i, size, rng, invalid_rate)
+             for i in range(years * scenes_per_year)]
+
+    return ItemCollection(items)
+
+
+def site_geometry(size, fraction=0.5):
+    """
+    Gets a square site polygon centred in the synthetic
+    scenes, as a qml polygon of latitude, longitude dicts.
+
+    :param size: Scene width and height in pixels.
+    :param fraction: Site width as a fraction of scene width.
+    :return: List of latitude, longitude dicts.
+    """
+
+    half = size * RESOLUTION * fraction / 2
+    centre = (ORIGIN[0] + size * RESOLUTION / 2, ORIGIN[1] - size * RESOLUTION / 2)
+    site = box(centre[0] - half, centre[1] - half, centre[0] + half, centre[1] + half)
+
+    to_wgs84 = Transformer.from_crs(CRS, 'EPSG:4326', always_xy=True).transform
+    site = transform_geometry(to_wgs84, site)
+
+    return [{'latitude': y, 'longitude': x} for x, y in site.exterior.coords]
+
+
+class LocalSearch:
+    """
+    Result of a LocalStacClient search, mimicking the parts
+    of pystac_client.ItemSearch used by analyses.
+    """
+
+    def __init__(self, items, limit):
+        self.items = items
+        self.limit = limit or len(items) or 1
+
+    def pages(self):
+        for i in range(0, len(self.items), self.limit):
+            yield ItemCollection(self.items[i:i + self.limit])
+
+    def items_as_dicts(self):
+        return [item.to_dict() for item in self.items]
+
+    def item_collection(self):
+        return ItemCollection(self.items)
+
+    def get_all_items(self):
+        return self.item_collection()
+
+
+class LocalStacClient:
+    """
+    In-memory stand-in for a stac api, answering searches by
+    collection, datetime range and bbox over a list of items,
+    so the pipeline can be run and timed offline.
+    """
+
+    def __init__(self, items):
+        self.items = list(items)
+
+    def search(self, collections=None, datetime=None, bbox=None, limit=None, **kwargs):
+        collections = [collections] if isinstance(collections, str) else collections
+
+        # parse date range, open ends allowed
+        start, end = None, None
+        if datetime:
+            start, _, end = datetime.partition('/')
+            start, end = (start or None), (end or None)
+
+        found = []
+        for item in self.items:
+            date = item.datetime.date().isoformat()
+            if collections and item.collection_id not in collections:
+                continue
+            if start and start != '..' and date < start[:10]:
+                continue
+            if end and end != '..' and date > end[:10]:
+                continue
+            if bbox and not shape(item.geometry).intersects(box(*bbox)):
+                continue
+            found.append(item)
+
+        return LocalSearch(found, limit)
@@ -0,0 +1,332 @@
+# general imports
+import os
+import sys
+import sqlite3
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# external scripts imports, all qt-free
+from scripts import analyses
+from scripts import backend
+from scripts import change
+from scripts import indices
+from scripts import instrument
+from scripts import series
+from scripts import spatial
+from scripts import store
+
+# globals
+DATABASE = os.path.join('data', 'monitoria.db')
+SITESTORE = os.path.join('data', 'data.jsonl')
+LEGACY_SITESTORE = os.path.join('data', 'data.json')
+CREATE_SITE_INDICES = ('CREATE TABLE IF NOT EXISTS SITE_INDICES (id INTEGER NOT NULL, idx TEXT NOT NULL, '
+                       'dates BLOB, veg_raw BLOB, PRIMARY KEY (id, idx))')
+CREATE_SITE_CHANGE = ('CREATE TABLE IF NOT EXISTS SITE_CHANGE (id INTEGER NOT NULL, dates BLOB, ewma BLOB, '
+                      'magnitude REAL, direction INTEGER, conseqs INTEGER, changed REAL, pixels BLOB, '
+                      'PRIMARY KEY (id))')
+
+
+def read_db_sites(path, ids=None):
+    """
+    Reads sites from the MONITORING_AREAS table of a
+    monitoria sqlite database, with any other index series
+    from the SITE_INDICES table.
+
+    :param path: Path to sqlite database.
+    :param ids: List of ids to read, or None for all.
+    :return: List of dicts of id, geometry, dates, values and indices.
+    """
+
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute('SELECT id, dates, veg_raw, geometry FROM MONITORING_AREAS').fetchall()
+        conn.execute(CREATE_SITE_INDICES)
+        index_rows = conn.execute('SELECT id, idx, dates, veg_raw FROM SITE_INDICES').fetchall()
+    finally:
+        conn.close()
+
+    # other index series per site
+    site_indices = {}
+    for id, name, dates, values in index_rows:
+        site_indices.setdefault(id, {})[name] = (series.decode_dates(dates), series.decode_values(values))
+
+    sites = []
+    for id, dates, values, geometry in rows:
+        if ids is None or id in ids:
+            sites.append({'id': id,
+                          'geometry': spatial.wkt_to_qml_polygon(wkt_polygon=geometry),
+                          'dates': series.decode_dates(dates),
+                          'values': series.decode_values(values),
+                          'indices': site_indices.get(id, {})})
+
+    return sites
+
+
+def write_db_results(path, results):
+    """
+    Writes site series back to the MONITORING_AREAS table,
+    and any change results to the SITE_CHANGE table, in a
+    single transaction.
+
+    :param path: Path to sqlite database.
+    :param results: Dict of site id to dict of index name to tuple of dates and values lists,
+    and analyses.CHANGE to dict of change results.
+    :return: None.
+    """
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(CREATE_SITE_CHANGE)
+        changes = {id: result[analyses.CHANGE] for id, result in results.items() if analyses.CHANGE in result}
+        others = {id: {name: value for name, value in result.items() if name not in [analyses.INDEX, analyses.CHANGE]}
+                  for id, result in results.items()}
+        with conn:
+            conn.executemany('UPDATE MONITORING_AREAS SET dates = ?, veg_raw = ? WHERE id = ?',
+                             [(series.encode_dates(result[analyses.INDEX][0]),
+                               series.encode_values(result[analyses.INDEX][1]), id)
+                              for id, result in results.items()])
+            conn.executemany('INSERT OR REPLACE INTO SITE_INDICES (id, idx, dates, veg_raw) VALUES (?, ?, ?, ?)',
+                             [(id, name, series.encode_dates(dates), series.encode_values(values))
+                              for id, result in others.items()
+                              for name, (dates, values) in result.items()])
+            conn.executemany('INSERT OR REPLACE INTO SITE_CHANGE (id, dates, ewma, magnitude, direction, conseqs, '
+                             'changed, pixels) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             [(id, series.encode_dates(c['dates']), series.encode_values(c['ewma']),
+                               c['magnitude'], c['direction'], c['conseqs'], c['changed'],
+                               change.encode_pixels(c['pixels']))
+                              for id, c in changes.items()])
+    finally:
+        conn.close()
+
+
+def read_json_sites(path, ids=None):
+    """
+    Reads sites from a site journal (see store.SiteStore),
+    importing the legacy data.json alongside it if needed.
+
+    :param path: Path to site journal.
+    :param ids: List of ids to read, or None for all.
+    :return: List of dicts of id, geometry, dates, values and indices.
+    """
+
+    site_store = store.SiteStore(path=path, legacy_path=LEGACY_SITESTORE)
+
+    sites = []
+    for id, site in site_store.load(series=True).items():
+        if (ids is None or id in ids) and site.get('geometry'):
+            sites.append({'id': id,
+                          'geometry': site['geometry'],
+                          'dates': site.get('dates'),
+                          'values': site.get('veg_raw'),
+                          'indices': site.get('indices') or {}})
+
+    return sites
+
+
+def write_json_results(path, results):
+    """
+    Appends site series to a site journal in a single write.
+
+    :param path: Path to site journal.
+    :param results: Dict of site id to dict of index name to tuple of dates and values lists,
+    and analyses.CHANGE to dict of change results.
+    :return: None.
+    """
+
+    site_store = store.SiteStore(path=path)
+    sites = site_store.load(series=True)
+
+    updated = []
+    for id, result in results.items():
+        result = dict(result)
+        dates, values = result.pop(analyses.INDEX)
+        site_change = result.pop(analyses.CHANGE, None) or sites[id].get('change')
+        indices = dict(sites[id].get('indices') or {}, **result)
+        site = dict(sites[id], dates=dates, veg_raw=values, indices=indices, change=site_change)
+        updated.append(site)
+
+    site_store.put_many(updated)
+
+
+def smooth_sites(sites):
+    """
+    Smooths the stored series of many sites in one
+    vectorised pass, see analyses.smooth_series.
+
+    :param sites: List of dicts of id, dates and values.
+    :return: Dict of site id to list of smoothed values.
+    """
+
+    sites = [site for site in sites if site['dates'] is not None and site['values'] is not None]
+    smoothed = analyses.smooth_series([(site['dates'], site['values']) for site in sites]) or []
+
+    return {site['id']: [None if np.isnan(v) else float(v) for v in smooth]
+            for site, smooth in zip(sites, smoothed)}
+
+
+def write_db_smoothed(path, smoothed):
+    """
+    Writes veg_smooth series to the MONITORING_AREAS table
+    in a single transaction.
+
+    :param path: Path to sqlite database.
+    :param smoothed: Dict of site id to list of smoothed values.
+    :return: None.
+    """
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.executemany('UPDATE MONITORING_AREAS SET veg_smooth = ? WHERE id = ?',
+                             [(series.encode_values(values), id) for id, values in smoothed.items()])
+    finally:
+        conn.close()
+
+
+def write_json_smoothed(path, smoothed):
+    """
+    Appends veg_smooth series to a site journal in a
+    single write.
+
+    :param path: Path to site journal.
+    :param smoothed: Dict of site id to list of smoothed values.
+    :return: None.
+    """
+
+    site_store = store.SiteStore(path=path)
+    sites = site_store.load(series=True)
+    site_store.put_many([dict(sites[id], veg_smooth=values) for id, values in smoothed.items()])
+
+
+def analyse_cluster(sites, incremental, to_date, index, trace_memory=False):
+    """
+    Process pool worker, runs the pipeline for a cluster.
+
+    :param sites: List of dicts of id, geometry, dates and values.
+    :param incremental: Append new scenes only, else rebuild.
+    :param to_date: End date string (YYYY-MM-DD), or None for today.
+    :param index: List of index names calculated alongside analyses.INDEX.
+    :param trace_memory: Trace memory so spans record per stage peaks.
+    :return: Tuple of dict of site id to dict of index name to tuple of
+    dates and values lists (or None), and list of stage span dicts.
+    """
+
+    # per stage memory peaks, each worker process runs one cluster at a time
+    if trace_memory:
+        instrument.start_tracing()
+
+    recorder = instrument.Recorder()
+    results = analyses.analyse_sites(sites=sites, incremental=incremental, to_date=to_date,
+                                     recorder=recorder, index=index)
+
+    return results, recorder.to_dicts()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the monitoria analysis pipeline without the gui.')
+    parser.add_argument('--source', choices=['db', 'json'], default='db',
+                        help='Read sites from monitoria.db or the sites journal.')
+    parser.add_argument('--path', default=None,
+                        help='Path to database or journal, defaults to those in data folder.')
+    parser.add_argument('--sites', type=int, nargs='*', default=None,
+                        help='Ids of sites to run, defaults to all.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Append scenes newer than each site\'s last date.')
+    parser.add_argument('--no-cluster', action='store_true',
+                        help='Run every site on its own instead of sharing reads with neighbours.')
+    parser.add_argument('--to-date', default=None,
+                        help='End date (YYYY-MM-DD), defaults to today.')
+    parser.add_argument('--index', nargs='*', default=[], choices=list(indices.INDICES),
+                        help='Indices to calculate alongside {} from the same download.'.format(analyses.INDEX))
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Dask threads per worker process, defaults to cpus / workers.')
+    parser.add_argument('--spans', default=instrument.SPAN_LOG,
+                        help='Json lines file to append stage timings to.')
+    parser.add_argument('--smooth-only', action='store_true',
+                        help='Smooth the stored series of sites without running the analysis.')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Trace memory so stage timings record per stage peaks, slows the analysis.')
+    args = parser.parse_args(argv)
+
+    # read sites
+    path = args.path or (DATABASE if args.source == 'db' else SITESTORE)
+    if args.source == 'db':
+        sites = read_db_sites(path, ids=args.sites)
+    else:
+        sites = read_json_sites(path, ids=args.sites)
+
+    if args.smooth_only:
+        smoothed = smooth_sites(sites)
+        if len(smoothed) > 0:
+            if args.source == 'db':
+                write_db_smoothed(path, smoothed)
+            else:
+                write_json_smoothed(path, smoothed)
+
+        # notify and return
+        print('Smoothed {} sites.'.format(len(smoothed)))
+        return 0
+
+    # notify
+    print('Running analysis for {} sites on {} workers.'.format(len(sites), args.workers))
+
+    # group neighbours so they share one query and load
+    by_id = {site['id']: site for site in sites}
+    if args.no_cluster:
+        clusters = [[id] for id in by_id]
+    else:
+        clusters = spatial.cluster_bboxes({id: spatial.qml_polygon_to_bbox(site['geometry'])
+                                           for id, site in by_id.items()})
+
+    # run clusters across process pool
+    results, spans, failed = {}, [], 0
+    # split cpus between processes so dask threads do not oversubscribe
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    with ProcessPoolExecutor(max_workers=args.workers,
+                             initializer=backend.configure,
+                             initargs=('threads', threads)) as pool:
+        futures = {pool.submit(analyse_cluster, [by_id[id] for id in ids], args.incremental, args.to_date,
+                               args.index, args.trace_memory): ids
+                   for ids in clusters}
+
+        for future in as_completed(futures):
+            try:
+                cluster_results, cluster_spans = future.result()
+                spans += cluster_spans
+                for id, result in cluster_results.items():
+                    if result is not None:
+                        results[id] = result
+            except Exception as e:
+                print('Failed sites {}: {}'.format(futures[future], e))
+                failed += len(futures[future])
+
+    # write everything back at once
+    if len(results) > 0:
+        if args.source == 'db':
+            write_db_results(path, results)
+        else:
+            write_json_results(path, results)
+
+        # smooth updated sites together
+        smoothed = smooth_sites([{'id': id, 'dates': result[analyses.INDEX][0], 'values': result[analyses.INDEX][1]}
+                                 for id, result in results.items()])
+        if args.source == 'db':
+            write_db_smoothed(path, smoothed)
+        else:
+            write_json_smoothed(path, smoothed)
+
+    # keep stage timings for later inspection
+    instrument.write_spans(spans, path=args.spans)
+
+    # notify and return
+    print('Updated {} sites, {} failed.'.format(len(results), failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,13 +2,12 @@
 import random
 import sys
 import time
-import uuid
 import json
 import numpy as np
 
 # pyside imports
 from PySide2.QtWidgets import QApplication
-from PySide2.QtCore import Qt, Slot, QAbstractListModel, QModelIndex, QThreadPool, QRunnable, QPoint, QObject
+from PySide2.QtCore import Qt, Slot, Signal, QAbstractListModel, QModelIndex, QThreadPool, QRunnable, QPoint, QPointF, QObject
 from PySide2.QtGui import QGuiApplication
 from PySide2.QtPositioning import QGeoPolygon
 from PySide2.QtQml import QQmlApplicationEngine
@@ -18,8 +17,12 @@ from PySide2.QtCharts import QtCharts
 # external scripts imports
 from scripts import classes
 from scripts import analyses
+from scripts import backend
+from scripts import change
 from scripts import data
+from scripts import instrument
 from scripts import spatial
+from scripts import series
 
 
 # to install odc-stac with pip
@@ -29,31 +32,44 @@ from scripts import spatial
 
 
 class MonitoringAreasModel(QAbstractListModel):
+
+    # analysis progress signals for qml, keyed by monitoring area id
+    analysisProgress = Signal(int, str, arguments=['id', 'stage'])
+    analysisFinished = Signal(int, arguments=['id'])
+    analysisFailed = Signal(int, str, arguments=['id', 'message'])
+
     def __init__(self):
         super(MonitoringAreasModel, self).__init__()
         self.monitoring_areas = []
+        self.selected_index = -1
+
+        # background analyses, keyed by monitoring area id
+        self.pool = QThreadPool.globalInstance()
+        self.runnables = {}
+
+        # stage spans of each area's last analysis, see instrument.py
+        self.spans = {}
+
+        # indices calculated alongside analyses.INDEX, see indices.py
+        self.indices = []
+
+        # ensure table exists and legacy text series are binary
+        db = data.connect_to_db()
+        data.create_monitoring_areas_table(db=db)
+        data.create_site_indices_table(db=db)
+        data.create_site_change_table(db=db)
+        data.migrate_monitoring_areas_table(db=db)
 
         # get all existing monitoring areas in db
         self.get_monitoring_areas()
 
     def data(self, index=QModelIndex(), role=Qt.DisplayRole):
-        monitoring_area = self.monitoring_areas[index.row()]
-        value = monitoring_area.get(list(monitoring_area)[role - Qt.UserRole])
-
-        return value
+        getter = classes.ROLE_GETTERS.get(role)
+        if index.isValid() and getter is not None:
+            return getter(self.monitoring_areas[index.row()])
 
     def roleNames(self):
-        roles = {
-            hash(Qt.UserRole): 'id'.encode(),
-            hash(Qt.UserRole + 1): 'code'.encode(),
-            hash(Qt.UserRole + 2): 'dates'.encode(),
-            hash(Qt.UserRole + 3): 'veg_raw'.encode(),
-            hash(Qt.UserRole + 4): 'veg_smooth'.encode(),
-            hash(Qt.UserRole + 5): 'geometry'.encode(),
-            hash(Qt.UserRole + 6): 'selected'.encode(),
-        }
-
-        return roles
+        return classes.ROLE_NAMES
 
     def rowCount(self, parent=QModelIndex()):
         num_rows = len(self.monitoring_areas)
@@ -76,8 +92,8 @@ class MonitoringAreasModel(QAbstractListModel):
         # begin the reset model
         self.beginResetModel()
 
-        # open db
-        db = data.connect_to_db('monitoring_areas_get')
+        # get thread's pooled db
+        db = data.connect_to_db()
 
         # get monitoring areas data
         query = QSqlQuery(query='SELECT * FROM MONITORING_AREAS', db=db)
@@ -90,31 +106,23 @@ class MonitoringAreasModel(QAbstractListModel):
             # convert wkt to qml polygon
             qml_polygon = spatial.wkt_to_qml_polygon(wkt_polygon=query.value(5))
 
-            # convert date data into lists
-            if query.value(2) != '':
-                dates = [str(dt) for dt in list(query.value(2).split(','))]
-
-            # convert veg raw data into lists
-            if query.value(3) != '':
-                values = [float(val) for val in list(query.value(3).split(','))]
+            # decode binary series into arrays, none if never analysed
+            dates = series.decode_dates(data.from_blob(query.value(2)))
+            values = series.decode_values(data.from_blob(query.value(3)))
+            smooth = series.decode_values(data.from_blob(query.value(4)))
 
             # add monitoring area and vertices to model list
-            self.monitoring_areas.append({
-                'id': query.value(0),
-                'code': query.value(1),
-                'dates': dates,
-                'veg_raw': values,
-                'veg_smooth': query.value(4),
-                'geometry': qml_polygon,
-                'selected': False
-            })
+            self.monitoring_areas.append(classes.Site(id=query.value(0),
+                                                      code=query.value(1),
+                                                      dates=dates,
+                                                      veg_raw=values,
+                                                      veg_smooth=smooth,
+                                                      geometry=qml_polygon))
 
         # end and emit the reset
+        self.selected_index = -1
         self.endResetModel()
 
-        # close db
-        db.close()
-
     @Slot(list)
     def insert_monitoring_area(self, qml_polygon):
         """
@@ -133,30 +141,18 @@ class MonitoringAreasModel(QAbstractListModel):
         # begin insert row model operation
         self.beginInsertRows(QModelIndex(), self.rowCount(), self.rowCount())
 
-        # insert item into list  todo can i use rolenames?
-        row = {'id': None,
-               'code': None,
-               'dates': None,
-               'veg_raw': None,
-               'veg_smooth': None,
-               'geometry': qml_polygon,
-               'selected': False
-               }
+        # insert item into list
+        row = classes.Site(geometry=spatial.wkt_to_qml_polygon(wkt_polygon=wkt_polygon))
         self.monitoring_areas.insert(self.rowCount(), row)
 
-        # open db
-        db_conn = uuid.uuid4().hex
-        db = data.connect_to_db('monitoring_area_insert_{}'.format(db_conn))
-
         # add new area into monitoring area table
-        query = QSqlQuery(db=db)
-        query.prepare('INSERT OR IGNORE INTO MONITORING_AREAS (geometry) '
-                      'VALUES (:geometry)')
+        query = data.prepare_query('INSERT OR IGNORE INTO MONITORING_AREAS (geometry) '
+                                   'VALUES (:geometry)')
         query.bindValue(':geometry', wkt_polygon)
         query.exec_()
 
-        # close db
-        db.close()
+        # keep new id so analyses can find this row
+        row.update({'id': query.lastInsertId()})
 
         # end insert row model operation
         self.endInsertRows()
@@ -171,131 +167,153 @@ class MonitoringAreasModel(QAbstractListModel):
         # notify
         print('Deleting area from MONITORING_AREA table.')
 
-        # set all selected values to false (reset selection)
-        for idx, row in enumerate(self.monitoring_areas):
-            if row['selected']:
-
-                # start begin remove rows
-                self.beginRemoveRows(QModelIndex(), idx, idx)  # todo check last idx is correct
+        # get selected rows, last first so indexes stay valid
+        selected = [idx for idx, row in enumerate(self.monitoring_areas) if row['selected']]
 
-                # remove list item
-                self.monitoring_areas.remove(row)
+        # drop all selected areas from monitoring area table in one transaction
+        with data.transaction():
+            query = data.prepare_query('DELETE FROM MONITORING_AREAS WHERE id = :id')
+            index_query = data.prepare_query('DELETE FROM SITE_INDICES WHERE id = :id')
+            change_query = data.prepare_query('DELETE FROM SITE_CHANGE WHERE id = :id')
+            for idx in reversed(selected):
 
-                # open db
-                db_conn = uuid.uuid4().hex
-                db = data.connect_to_db('monitoring_area_delete_{}'.format(db_conn))
+                # start begin remove rows
+                self.beginRemoveRows(QModelIndex(), idx, idx)
 
-                # drop existing area from monitoring area table
-                query = QSqlQuery(db=db)
-                query.prepare('DELETE FROM MONITORING_AREAS WHERE id = :id')
+                # remove list item and db row
+                row = self.monitoring_areas.pop(idx)
                 query.bindValue(':id', row['id'])
                 query.exec_()
-
-                # close db
-                db.close()
+                index_query.bindValue(':id', row['id'])
+                index_query.exec_()
+                change_query.bindValue(':id', row['id'])
+                change_query.exec_()
 
                 # end remove rows session
                 self.endRemoveRows()
 
+        # selected rows are gone
+        self.selected_index = -1
+
     @Slot()
-    def perform_analysis(self):
+    @Slot(bool)
+    def perform_analysis(self, incremental=False):
         """
+        Starts a background analysis for each selected
+        monitoring area. See runTasks.
 
-        :param geometry:
-        :return:
+        :param incremental: Append new scenes only, else rebuild.
+        :return: None.
         """
 
         # notify
         print('Performing analysis.')
 
-        # from multiprocessing.pool import ThreadPool
-        # import dask
-        # dask.config.set(pool=ThreadPool(2))
+        # start a task per selected row
+        for row in self.monitoring_areas:
+            if row['selected']:
+                self.runTasks(row['id'], incremental)
+
+    @Slot(int, object)
+    def apply_analysis(self, id, result):
+        """
+        Applies a finished analysis to the model and database.
+        Always called on the main thread via queued signal.
 
-        # find selected row
+        :param id: Monitoring area id.
+        :param result: Dict of dates and veg_raw lists, indices dict of other series
+        and change dict of ewmacd results, see change.reduce_change.
+        :return: None.
+        """
+
+        # find row, may have been deleted while running
         for idx, row in enumerate(self.monitoring_areas):
-            if row['selected']:
-                geometry = row['geometry']
-
-                # check if geometry exists and proceed
-                if geometry is not None or len(geometry) > 0:
-
-                    # get bounding box
-                    xs = [coord.get('longitude') for coord in geometry]
-                    ys = [coord.get('latitude') for coord in geometry]
-                    bbox = [min(xs), min(ys), max(xs), max(ys)]
-
-                    collections = ['ga_ls5t_ard_3', 'ga_ls7e_ard_3', 'ga_ls8c_ard_3']
-                    from_date, to_date = '1990-01-01',  '2021-12-31' #'1995-12-31'
-
-                    # query aws stac for available collection items
-                    items = analyses.query_stac(collections=collections,
-                                                from_date=from_date,
-                                                to_date=to_date,
-                                                bbox=bbox)
-
-                    # now build a dataset using all available items
-                    ds = analyses.build_dataset(items=items,
-                                                bbox=bbox,
-                                                crs='EPSG:4326',
-                                                resolution=10 / 111000,
-                                                like=None,
-                                                ignore_warnings=True)
-
-                    # mask out (remove) any invalid scenes
-                    ds = analyses.mask_invalid_scenes(ds=ds,
-                                                      mask_var='mask',
-                                                      valid=[1, 4, 5],
-                                                      min_pct=1.0,
-                                                      drop_mask=True)
-
-                    # calculate ndvi index
-                    ds = analyses.calculate_index(ds=ds,
-                                                  index='NDVI',
-                                                  drop_bands=True)
-
-                    # load the dataset all at same time (we only have one band)
-                    ds = analyses.load_dataset(ds=ds, logic='all')
-
-                    # remove edge pixels
-                    # todo remove edge pixels
-
-                    # reduce down to one mean value per scene
-                    ds = analyses.get_temporal_means(ds)
-
-                    # remove spike outliers
-                    ds = analyses.remove_outliers(ds, user_factor=2)
-
-                    # prepare dates
-                    dts = ds['time'].dt.strftime('%Y-%m-%d').values
-                    dts = ','.join([str(dt) for dt in dts])
-
-                    # prepare veg values
-                    vals = ds['veg_idx'].values
-                    vals = ','.join([str(val) for val in vals])
-
-                    # update row
-                    self.monitoring_areas[idx].update({'dates': dts, 'veg_raw': vals})
-                    self.dataChanged.emit(self.index(idx), self.index(idx), self.roleNames())
-
-                    # open db
-                    db_conn = uuid.uuid4().hex
-                    db = data.connect_to_db('monitoring_area_update_{}'.format(db_conn))
-
-                    # add new area into monitoring area table
-                    query = QSqlQuery(db=db)
-                    query.prepare('UPDATE MONITORING_AREAS '
-                                  'SET dates = :dates, veg_raw = :veg_raw '
-                                  'WHERE id = :id')
-                    query.bindValue(':id', row['id'])
-                    query.bindValue(':dates', dts)
-                    query.bindValue(':veg_raw', vals)
+            if row['id'] == id:
+
+                # encode to binary once, keep decoded arrays in model
+                dts = series.encode_dates(result['dates'])
+                vals = series.encode_values(result['veg_raw'])
+                smooth = series.encode_values(analyses.smooth_series([(result['dates'], result['veg_raw'])])[0])
+
+                # update row
+                self.monitoring_areas[idx].update({'dates': series.decode_dates(dts),
+                                                   'veg_raw': series.decode_values(vals),
+                                                   'veg_smooth': series.decode_values(smooth)})
+                self.dataChanged.emit(self.index(idx), self.index(idx),
+                                      [classes.ROLE_IDS['dates'], classes.ROLE_IDS['veg_raw'],
+                                       classes.ROLE_IDS['veg_smooth']])
+
+                # update area in monitoring area table
+                query = data.prepare_query('UPDATE MONITORING_AREAS '
+                                           'SET dates = :dates, veg_raw = :veg_raw, veg_smooth = :veg_smooth '
+                                           'WHERE id = :id')
+                query.bindValue(':id', id)
+                query.bindValue(':dates', data.to_blob(dts))
+                query.bindValue(':veg_raw', data.to_blob(vals))
+                query.bindValue(':veg_smooth', data.to_blob(smooth))
+                query.exec_()
+
+                # store other indices' series, kept out of the model rows
+                with data.transaction():
+                    query = data.prepare_query('INSERT OR REPLACE INTO SITE_INDICES (id, idx, dates, veg_raw) '
+                                               'VALUES (:id, :idx, :dates, :veg_raw)')
+                    for name, (dates, values) in result.get('indices', {}).items():
+                        query.bindValue(':id', id)
+                        query.bindValue(':idx', name)
+                        query.bindValue(':dates', data.to_blob(series.encode_dates(dates)))
+                        query.bindValue(':veg_raw', data.to_blob(series.encode_values(values)))
+                        query.exec_()
+
+                # store change results, kept out of the model rows
+                site_change = result.get('change')
+                if site_change is not None:
+                    query = data.prepare_query('INSERT OR REPLACE INTO SITE_CHANGE '
+                                               '(id, dates, ewma, magnitude, direction, conseqs, changed, pixels) '
+                                               'VALUES (:id, :dates, :ewma, :magnitude, :direction, :conseqs, '
+                                               ':changed, :pixels)')
+                    query.bindValue(':id', id)
+                    query.bindValue(':dates', data.to_blob(series.encode_dates(site_change['dates'])))
+                    query.bindValue(':ewma', data.to_blob(series.encode_values(site_change['ewma'])))
+                    query.bindValue(':magnitude', site_change['magnitude'])
+                    query.bindValue(':direction', site_change['direction'])
+                    query.bindValue(':conseqs', site_change['conseqs'])
+                    query.bindValue(':changed', site_change['changed'])
+                    query.bindValue(':pixels', data.to_blob(change.encode_pixels(site_change['pixels'])))
                     query.exec_()
 
-                    # close db
-                    db.close()
+                break
 
-                    print(ds)
+    @Slot()
+    def smooth_all(self):
+        """
+        Smooths every monitoring area's veg_raw series in one
+        vectorised pass (see analyses.smooth_series) and writes
+        all veg_smooth series in one transaction.
+
+        :return: None.
+        """
+
+        # notify
+        print('Smoothing all monitoring areas.')
+
+        rows = [row for row in self.monitoring_areas if row['dates'] is not None and row['veg_raw'] is not None]
+        if len(rows) == 0:
+            return
+
+        smoothed = analyses.smooth_series([(row['dates'], row['veg_raw']) for row in rows])
+
+        # store all at once
+        with data.transaction():
+            query = data.prepare_query('UPDATE MONITORING_AREAS SET veg_smooth = :veg_smooth WHERE id = :id')
+            for row, smooth in zip(rows, smoothed):
+                blob = series.encode_values(smooth)
+                row.update({'veg_smooth': series.decode_values(blob)})
+                query.bindValue(':id', row['id'])
+                query.bindValue(':veg_smooth', data.to_blob(blob))
+                query.exec_()
+
+        self.dataChanged.emit(self.index(0), self.index(len(self.monitoring_areas) - 1),
+                              [classes.ROLE_IDS['veg_smooth']])
 
     @Slot(int)
     def select_poly(self, index):
@@ -306,149 +324,467 @@ class MonitoringAreasModel(QAbstractListModel):
         :return:
         """
 
-        # set all selected values to false (reset selection)
-        for idx, row in enumerate(self.monitoring_areas):
-            self.monitoring_areas[idx].update({'selected': False})
-            self.dataChanged.emit(self.index(idx), self.index(idx), self.roleNames())
+        # deselect previous polygon only
+        self.deselect_polys()
 
         # now, update selected polygon row via input index and emit
-        self.monitoring_areas[index].update({'selected': True})
-        self.dataChanged.emit(self.index(index), self.index(index), self.roleNames())
+        self.set_selected(index, True)
+        self.selected_index = index
 
     @Slot()
     def deselect_polys(self):
         """
+        Deselects the selected polygon, repainting only that row.
 
-        :return:
+        :return: None.
         """
 
-        # set all selected values to false (reset selection)
-        for idx, row in enumerate(self.monitoring_areas):
-            self.monitoring_areas[idx].update({'selected': False})
-            self.dataChanged.emit(self.index(idx), self.index(idx), self.roleNames())
+        # reset previous selection only
+        self.set_selected(self.selected_index, False)
+        self.selected_index = -1
+
+    def set_selected(self, index, selected):
+        """
+        Sets a row's selected flag and notifies views of only
+        that row and role.
+
+        :param index: Row to change, ignored if out of range.
+        :param selected: New selected flag.
+        :return: None.
+        """
+
+        if 0 <= index < self.rowCount():
+            self.monitoring_areas[index].selected = selected
+            self.dataChanged.emit(self.index(index), self.index(index), [classes.SELECTED_ROLE])
+
+    def selected_row(self):
+        """
+        Gets the selected row, or None if nothing is selected.
+
+        :return: Site or None.
+        """
+
+        if 0 <= self.selected_index < self.rowCount():
+            return self.monitoring_areas[self.selected_index]
 
     @Slot(result=int)
     def count_dates(self):
-        for idx, row in enumerate(self.monitoring_areas):
-            if row['selected']:
-                if row['dates'] is None:
-                    return 0
-                else:
-                    return len(row['dates'])
+        row = self.selected_row()
+        if row is not None:
+            if row['dates'] is None:
+                return 0
+            else:
+                return len(row['dates'])
 
     @Slot(result=float)
     def get_min_veg_value(self):
-        for idx, row in enumerate(self.monitoring_areas):
-            if row['selected']:
-                if row['veg_raw'] is None:
-                    return 0
-                else:
-                    return min(row['veg_raw'])
-                    #return np.percentile(row['veg_raw'], 0.25)
+        row = self.selected_row()
+        if row is not None:
+            if row['veg_raw'] is None:
+                return 0
+            else:
+                return float(np.nanmin(row['veg_raw']))
+                #return np.percentile(row['veg_raw'], 0.25)
 
     @Slot(result=float)
     def get_max_veg_value(self):
-        for idx, row in enumerate(self.monitoring_areas):
-            if row['selected']:
-                if row['veg_raw'] is None:
-                    return 0
-                else:
-                    return max(row['veg_raw'])
-                    #return np.percentile(row['veg_raw'], 99.75)
+        row = self.selected_row()
+        if row is not None:
+            if row['veg_raw'] is None:
+                return 0
+            else:
+                return float(np.nanmax(row['veg_raw']))
+                #return np.percentile(row['veg_raw'], 99.75)
+
+    @Slot(result=float)
+    def get_min_date(self):
+        row = self.selected_row()
+        if row is not None and row['dates'] is not None:
+            return float(series.to_msecs(row['dates']).min())
+        return 0
+
+    @Slot(result=float)
+    def get_max_date(self):
+        row = self.selected_row()
+        if row is not None and row['dates'] is not None:
+            return float(series.to_msecs(row['dates']).max())
+        return 0
 
     @Slot(QtCharts.QAbstractSeries)
-    def graph(self, series):
+    @Slot(QtCharts.QAbstractSeries, int)
+    def graph(self, chart_series, width=1000):
+        """
+        Draws the selected area's vegetation values against
+        their dates (ms since epoch for a DateTimeAxis), with
+        the whole record downsampled to the chart width.
 
-        series.setPointsVisible(True)
-        series.setColor('red')
+        :param chart_series: Qml line series to fill.
+        :param width: Chart plot width in pixels.
+        :return: None.
+        """
 
-        for idx, row in enumerate(self.monitoring_areas):
-            if row['selected']:
-                for i, v in enumerate(row['veg_raw']):
-                    series.append(i, v)
+        chart_series.setPointsVisible(True)
+        chart_series.setColor('red')
+
+        self.graph_range(chart_series, 0, 0, width)
+
+    @Slot(QtCharts.QAbstractSeries, float, float, int)
+    def graph_range(self, chart_series, min_msecs, max_msecs, width):
+        """
+        Refills a chart series with the selected area's values
+        within a date range (e.g. after zooming), downsampled via
+        lttb to one point per pixel and replaced in one call. A
+        range where min is not below max draws the whole record.
+
+        :param chart_series: Qml line series to fill.
+        :param min_msecs: Start of visible range, ms since epoch.
+        :param max_msecs: End of visible range, ms since epoch.
+        :param width: Chart plot width in pixels.
+        :return: None.
+        """
+
+        row = self.selected_row()
+        if row is None or row['veg_raw'] is None:
+            chart_series.clear()
+            return
+
+        xs, ys = series.to_msecs(row['dates']), row['veg_raw']
+
+        # keep visible points plus one either side so lines reach edges
+        if min_msecs < max_msecs:
+            inside = np.nonzero((xs >= min_msecs) & (xs <= max_msecs))[0]
+            if len(inside) > 0:
+                start, end = max(inside[0] - 1, 0), min(inside[-1] + 2, len(xs))
+                xs, ys = xs[start:end], ys[start:end]
+
+        # one point per pixel, handed over in one bulk replace
+        xs, ys = series.lttb(xs, ys, threshold=max(int(width), 3))
+        chart_series.replace([QPointF(x, y) for x, y in zip(xs, ys)])
 
     @Slot(str)
     def log(self, msg):
         print(msg)
 
     @Slot(int)
-    def runTasks(self, id):
+    @Slot(int, bool)
+    def runTasks(self, id, incremental=False):
+        """
+        Runs the analysis pipeline for a monitoring area on the
+        global thread pool. Stage progress, results and errors
+        come back as signals and are applied on the main thread.
+
+        :param id: Monitoring area id.
+        :param incremental: Append new scenes only, else rebuild.
+        :return: None.
+        """
 
         # notify
         print('Downloading available satellite data.')
 
-        # todo implement threading like here
-        #threadCount = QThreadPool.globalInstance().maxThreadCount()
-        #print(f"Running {threadCount} Threads")
-        #pool = QThreadPool.globalInstance()
-        #runnable = Runnable(id=id, monitoring_areas=self.monitoring_areas)
-        #pool.start(runnable)
-        ...
+        self.start_task(ids=[id], incremental=incremental)
+
+    @Slot()
+    @Slot(bool)
+    @Slot(bool, bool)
+    def perform_batch_analysis(self, selected_only=False, incremental=False):
+        """
+        Runs analysis for all (or selected) monitoring areas,
+        clustering neighbouring areas so each cluster shares a
+        single stac query and load. One task runs per cluster.
+
+        :param selected_only: Only include selected areas.
+        :param incremental: Append new scenes only, else rebuild.
+        :return: None.
+        """
+
+        # notify
+        print('Performing batch analysis.')
+
+        # get bbox of every candidate area not already running
+        bboxes = {}
+        for row in self.monitoring_areas:
+            if selected_only and not row['selected']:
+                continue
+            if row['geometry'] and row['id'] not in self.runnables:
+                bboxes[row['id']] = spatial.qml_polygon_to_bbox(row['geometry'])
+
+        # start a task per cluster
+        for ids in spatial.cluster_bboxes(bboxes):
+            self.start_task(ids=ids, incremental=incremental)
+
+    def start_task(self, ids, incremental):
+        """
+        Builds and starts a Runnable for one or more monitoring
+        areas, processed together as a cluster.
+
+        :param ids: List of monitoring area ids.
+        :param incremental: Append new scenes only, else rebuild.
+        :return: None.
+        """
+
+        # one task per site at a time
+        for id in set(ids) & set(self.runnables):
+            print('Analysis already running for monitoring area {}.'.format(id))
+        ids = [id for id in ids if id not in self.runnables]
+
+        # build tasks on copies of rows so worker never touches model
+        sites = []
+        for row in self.monitoring_areas:
+            if row['id'] in ids and row['geometry']:
+                sites.append({'id': row['id'],
+                              'geometry': list(row['geometry']),
+                              'dates': row['dates'],
+                              'values': row['veg_raw']})
+
+        if len(sites) == 0:
+            return
+
+        # attach stored series of other requested indices
+        query = data.prepare_query('SELECT idx, dates, veg_raw FROM SITE_INDICES WHERE id = :id')
+        for site in sites:
+            site['indices'] = {}
+            query.bindValue(':id', site['id'])
+            query.exec_()
+            while query.next():
+                if query.value(0) in self.indices:
+                    site['indices'][query.value(0)] = (series.decode_dates(data.from_blob(query.value(1))),
+                                                       series.decode_values(data.from_blob(query.value(2))))
+            query.finish()
+
+        runnable = Runnable(sites=sites, incremental=incremental, index=self.indices)
+
+        # wire worker signals, queued onto main thread
+        runnable.signals.progress.connect(self.analysisProgress)
+        runnable.signals.result.connect(self.apply_analysis)
+        runnable.signals.error.connect(self.analysisFailed)
+        runnable.signals.spans.connect(self.apply_spans)
+        runnable.signals.finished.connect(self.finish_task)
+
+        # keep reference until finished and start
+        for site in sites:
+            self.runnables[site['id']] = runnable
+            self.spans.pop(site['id'], None)
+        self.pool.start(runnable)
+
+    @Slot(list)
+    def apply_spans(self, spans):
+        """
+        Keeps the stage spans of a finished task against each
+        of its monitoring areas and appends them to the span
+        log. Called on the main thread before finish_task.
+
+        :param spans: List of span dicts.
+        :return: None.
+        """
+
+        for span in spans:
+            for id in span['sites']:
+                self.spans.setdefault(id, []).append(span)
+
+        instrument.write_spans(spans)
+
+    @Slot(int, result='QVariantList')
+    def get_stage_spans(self, id):
+        """
+        Gets the stage spans (stage, wall, cpu, bytes, scenes
+        in and out, peak mb) of a monitoring area's last
+        analysis, for display in qml.
+
+        :param id: Monitoring area id.
+        :return: List of span dicts.
+        """
+
+        return self.spans.get(id, [])
+
+    @Slot(list)
+    def set_indices(self, names):
+        """
+        Sets the indices calculated alongside analyses.INDEX
+        by later analyses, all from the same download.
+
+        :param names: List of index names, e.g. NDMI, MAVI.
+        :return: None.
+        """
+
+        self.indices = [name.upper() for name in names if name.upper() != analyses.INDEX]
+
+    @Slot(int, str, result='QVariantList')
+    def get_index_series(self, id, name):
+        """
+        Gets a stored index series of a monitoring area, for
+        comparing against its veg_raw series.
+
+        :param id: Monitoring area id.
+        :param name: Index name, e.g. NDMI.
+        :return: List of [msecs, value] pairs.
+        """
+
+        query = data.prepare_query('SELECT dates, veg_raw FROM SITE_INDICES WHERE id = :id AND idx = :idx')
+        query.bindValue(':id', id)
+        query.bindValue(':idx', name.upper())
+        query.exec_()
+
+        # read then release statement so it does not stay open on the connection
+        found = query.next()
+        row = [query.value(i) for i in range(2)] if found else None
+        query.finish()
+        if not found:
+            return []
+
+        dates = series.decode_dates(data.from_blob(row[0]))
+        values = series.decode_values(data.from_blob(row[1]))
+        if dates is None or values is None:
+            return []
+
+        return [[float(x), float(y)] for x, y in zip(series.to_msecs(dates), values)]
+
+    @Slot(int, result='QVariantMap')
+    def get_site_change(self, id):
+        """
+        Gets the stored ewmacd change of a monitoring area, its
+        summary and ewma series, for display in qml.
+
+        :param id: Monitoring area id.
+        :return: Dict of magnitude, direction, conseqs, changed and
+        ewma list of [msecs, value] pairs, empty if none stored.
+        """
+
+        query = data.prepare_query('SELECT dates, ewma, magnitude, direction, conseqs, changed '
+                                   'FROM SITE_CHANGE WHERE id = :id')
+        query.bindValue(':id', id)
+        query.exec_()
+
+        # read then release statement so it does not stay open on the connection
+        found = query.next()
+        row = [query.value(i) for i in range(6)] if found else None
+        query.finish()
+        if not found:
+            return {}
+
+        dates = series.decode_dates(data.from_blob(row[0]))
+        values = series.decode_values(data.from_blob(row[1]))
+        ewma = []
+        if dates is not None and values is not None:
+            ewma = [[float(x), float(y)] for x, y in zip(series.to_msecs(dates), values) if not np.isnan(y)]
+
+        return {'magnitude': row[2],
+                'direction': row[3],
+                'conseqs': row[4],
+                'changed': row[5],
+                'ewma': ewma}
+
+    @Slot(int)
+    def cancelTasks(self, id):
+        """
+        Requests cancellation of a running analysis, or all
+        running analyses if id is -1. Tasks stop before their
+        next pipeline stage.
+
+        :param id: Monitoring area id, or -1 for all.
+        :return: None.
+        """
+
+        for key, runnable in self.runnables.items():
+            if id == -1 or key == id:
+                runnable.cancel()
+
+    @Slot(int)
+    def finish_task(self, id):
+        """
+        Releases a finished task and notifies qml.
+
+        :param id: Monitoring area id.
+        :return: None.
+        """
+
+        self.runnables.pop(id, None)
+        self.analysisFinished.emit(id)
+
+
+class RunnableSignals(QObject):
+    """
+    Signals for Runnable, as QRunnable cannot emit itself.
+    """
+    progress = Signal(int, str)
+    result = Signal(int, object)
+    error = Signal(int, str)
+    spans = Signal(list)
+    finished = Signal(int)
 
 
 class Runnable(QRunnable):
-    def __init__(self, id, monitoring_areas):
+    def __init__(self, sites, incremental=False, index=None):
         super().__init__()
-        self.id = id
-        self.monitoring_areas = monitoring_areas
+        self.sites = sites
+        self.incremental = incremental
+        self.index = index
+        self.cancelled = False
+        self.recorder = instrument.Recorder()
+        self.signals = RunnableSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def progress(self, stage):
+        """
+        Progress callback given to the pipeline. Emits stage for
+        each site and stops the pipeline if cancellation was
+        requested.
+
+        :param stage: Name of stage about to run.
+        :return: None.
+        """
+
+        if self.cancelled:
+            raise analyses.AnalysisCancelled()
+
+        for site in self.sites:
+            self.signals.progress.emit(site['id'], stage)
 
     def run(self):
 
         # notify
         print('Performing analysis.')
 
-        # todo temp
-        # from multiprocessing.pool import ThreadPool
-        # import dask
-        # dask.config.set(pool=ThreadPool(2))
-
-        # # get geometry for selected polygon
-        # for monitoring_area in self.monitoring_areas:
-        #     if self.id == monitoring_area.get('id'):
-        #         geometry = monitoring_area.get('geometry')
-        #
-        # # check if geometry exists and proceed
-        # if geometry is not None or len(geometry) > 0:
-        #     xs = [coord.get('longitude') for coord in geometry]
-        #     ys = [coord.get('latitude') for coord in geometry]
-        #     bbox = [min(xs), min(ys), max(xs), max(ys)]
-        #
-        #     collections = ['ga_ls5t_ard_3', 'ga_ls7e_ard_3', 'ga_ls8c_ard_3']
-        #     from_date, to_date = '1990-01-01', '2004-06-15'  # '2021-12-31'
-        #
-        #     # query aws stac for available collection items
-        #     items = analyses.query_stac(collections=collections,
-        #                                 from_date=from_date,
-        #                                 to_date=to_date,
-        #                                 bbox=bbox)
-        #
-        #     # now build a dataset using all available items
-        #     ds = analyses.build_dataset(items=items,
-        #                                 bbox=bbox,
-        #                                 crs='EPSG:4326',
-        #                                 resolution=10 / 111000,
-        #                                 like=None,
-        #                                 ignore_warnings=True)
-        #
-        #     # mask out (remove) any invalid scenes
-        #     ds = analyses.mask_invalid_scenes(ds=ds,
-        #                                       mask_var='mask',
-        #                                       valid=[1, 4, 5],
-        #                                       min_pct=1.0,
-        #                                       drop_mask=True)
-        #
-        #     # calculate ndvi index
-        #     ds = analyses.calculate_index(ds=ds,
-        #                                   index='NDVI',
-        #                                   drop_bands=True)
-        #
-        #     # load the dataset all at same time (we only have one band)
-        #     ds = analyses.load_dataset(ds=ds, logic='all')
-        #
-        #     # reduce down to one mean value per scene
-        #     ds = analyses.get_temporal_means(ds)
-        #
-        #     print(ds)
+        # per stage memory peaks if opted in, shared by concurrent runnables
+        if instrument.TRACE_MEMORY:
+            instrument.start_tracing()
+
+        try:
+            # run whole pipeline for site or cluster
+            results = analyses.analyse_sites(sites=self.sites,
+                                             incremental=self.incremental,
+                                             progress=self.progress,
+                                             recorder=self.recorder,
+                                             index=self.index)
+
+            # hand back to model on main thread
+            for id, result in results.items():
+                if result is not None:
+                    dates, values = result.pop(analyses.INDEX)
+                    site_change = result.pop(analyses.CHANGE, None)
+                    self.signals.result.emit(id, {'dates': dates, 'veg_raw': values, 'indices': result,
+                                                  'change': site_change})
+
+        except analyses.AnalysisCancelled:
+            print('Analysis cancelled.')
+            for site in self.sites:
+                self.signals.error.emit(site['id'], 'Cancelled')
+
+        except Exception as e:
+            print(e)
+            for site in self.sites:
+                self.signals.error.emit(site['id'], str(e))
+
+        finally:
+            # release any db connection this worker thread opened
+            data.close_connection()
+
+            # hand back stage timings, even if failed part way
+            self.signals.spans.emit(self.recorder.to_dicts())
+
+            for site in self.sites:
+                self.signals.finished.emit(site['id'])
 
 
 if __name__ == "__main__":
@@ -457,17 +793,23 @@ if __name__ == "__main__":
     #app = QGuiApplication(sys.argv)  # this doesnt work with charts, use below
     app = QApplication(sys.argv)
 
-    # init engine and load qml
-    engine = QQmlApplicationEngine()
-    engine.load("qml/main2.qml")  # todo change
+    # set dask backend once, any cluster is reused until quit
+    backend.configure()
+    app.aboutToQuit.connect(backend.shutdown)
 
     # init models
-    #monitoring_areas = MonitoringAreasModel()
+    monitoring_areas = MonitoringAreasModel()
     sites = classes.SitesModel()
+    sites_viewport = classes.SitesViewportModel(sites)
 
-    # set model to qml app
-    #engine.rootContext().setContextProperty('MonitoringAreasModel', monitoring_areas)
+    # set models to qml app before loading so bindings resolve
+    engine = QQmlApplicationEngine()
+    engine.rootContext().setContextProperty('MonitoringAreasModel', monitoring_areas)
     engine.rootContext().setContextProperty('SitesModel', sites)
+    engine.rootContext().setContextProperty('SitesViewportModel', sites_viewport)
+
+    # load qml
+    engine.load("qml/main2.qml")  # todo change
 
     # quit if nada...
     if not engine.rootObjects():
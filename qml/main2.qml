@@ -269,6 +269,20 @@ ApplicationWindow {
         activeMapType: supportedMapTypes[1]
         copyrightsVisible: false
 
+        // tell model what is visible so only those polygons are drawn
+        function updateViewport() {
+          var topLeft = map.toCoordinate(Qt.point(0, 0), false);
+          var bottomRight = map.toCoordinate(Qt.point(map.width, map.height), false);
+          if (topLeft.isValid && bottomRight.isValid) {
+            SitesModel.setViewport(topLeft.longitude, bottomRight.latitude,
+                                   bottomRight.longitude, topLeft.latitude, map.zoomLevel);
+          }
+        }
+        onCenterChanged: updateViewport()
+        onZoomLevelChanged: updateViewport()
+        onWidthChanged: updateViewport()
+        onHeightChanged: updateViewport()
+
         // non-polygon mouse interactions
         MouseArea {
           id: mapMouseArea
@@ -276,12 +290,18 @@ ApplicationWindow {
 
           onClicked: {
             if (mouse.button == Qt.LeftButton) {
-              SitesModel.deselectAreas();  // deselect polygons
+              var point = Qt.point(mouseX, mouseY);
+              var coord = map.toCoordinate(point);
+
+              // pick polygon under click via spatial index, else deselect
+              if (inEditSession == true) {
+                SitesModel.deselectAreas();
+              } else {
+                SitesModel.pickArea(coord.longitude, coord.latitude);
+              }
 
               // move this to a mappolygon class in python
               if (inEditSession == true) {
-                var point = Qt.point(mouseX, mouseY);
-                var coord = map.toCoordinate(point);
                 tempPolygon.addCoordinate(coord)
 
                 // // if 3 vertices detected, enable insert button
@@ -325,7 +345,7 @@ ApplicationWindow {
         // map polygon view
         MapItemView {
           id: mapPolygonsView
-          model: SitesModel
+          model: SitesViewportModel
           delegate:
 
           // map polygon delegate
@@ -343,18 +363,7 @@ ApplicationWindow {
               samples: 2
             }
 
-            // map mouse interactivity for local polygons
-            MouseArea {
-              id: mapPolygonMouseArea
-              anchors.fill: parent
-              enabled: inEditSession ? false : true
-
-              onClicked: {
-                if (mouse.button == Qt.LeftButton) {
-                  SitesModel.selectArea(index);
-                }
-              }
-            }
+            // clicks pass through to map, picked via SitesModel.pickArea
           }
         }
 
@@ -735,6 +744,46 @@ ApplicationWindow {
       Layout.fillHeight: true
       color: "#404040"
       radius: 3
+
+      // analysis status text
+      Text {
+        id: analysisStatus
+        anchors.centerIn: parent
+        color: "white"
+        text: ""
+        property int failedId: -1
+      }
+
+      // update status from background analyses
+      Connections {
+        target: MonitoringAreasModel
+        function onAnalysisProgress(id, stage) {
+          analysisStatus.text = "Area " + id + ": " + stage
+        }
+        function onAnalysisFailed(id, message) {
+          analysisStatus.text = "Area " + id + ": " + message
+          analysisStatus.failedId = id
+        }
+        function onAnalysisFinished(id) {
+          if (analysisStatus.failedId !== id) {
+            // total time and slowest stage of this run
+            var spans = MonitoringAreasModel.get_stage_spans(id)
+            var total = 0, slowest = null
+            for (var i = 0; i < spans.length; i++) {
+              total += spans[i].wall
+              if (slowest === null || spans[i].wall > slowest.wall) {
+                slowest = spans[i]
+              }
+            }
+            analysisStatus.text = "Area " + id + ": finished"
+            if (slowest !== null) {
+              analysisStatus.text += " in " + total.toFixed(1) + " s\n(" +
+                                     slowest.stage + " " + slowest.wall.toFixed(1) + " s)"
+            }
+          }
+          analysisStatus.failedId = -1
+        }
+      }
     }
 
     // bottom panel for graphing
@@ -756,9 +805,10 @@ ApplicationWindow {
           visible: false
         }
 
-        ValueAxis{
+        DateTimeAxis {
           id: xAxis
           labelsColor: "white"
+          format: "yyyy"
         }
 
         ValueAxis{
@@ -766,20 +816,38 @@ ApplicationWindow {
           labelsColor: "white"
         }
 
+        // resample the drawn series to the visible date range
+        function resample() {
+          if (chart.count > 0) {
+            MonitoringAreasModel.graph_range(chart.series(0), xAxis.min.getTime(),
+                                             xAxis.max.getTime(), chart.plotArea.width)
+          }
+        }
+
         MouseArea {
           anchors.fill: parent
           acceptedButtons: Qt.AllButtons
 
+          // zoom on wheel, then resample to new range
+          onWheel: {
+            if (wheel.angleDelta.y > 0) {
+              chart.zoomIn()
+            } else {
+              chart.zoomOut()
+            }
+            chart.resample()
+          }
+
           onClicked: {
             chart.removeAllSeries()
 
-            xAxis.min = 0
-            xAxis.max = MonitoringAreasModel.count_dates()
+            xAxis.min = new Date(MonitoringAreasModel.get_min_date())
+            xAxis.max = new Date(MonitoringAreasModel.get_max_date())
             yAxis.min = MonitoringAreasModel.get_min_veg_value()
             yAxis.max = MonitoringAreasModel.get_max_veg_value()
 
             var series = chart.createSeries(ChartView.SeriesTypeLine, "A", xAxis, yAxis);
-            MonitoringAreasModel.graph(series)
+            MonitoringAreasModel.graph(series, chart.plotArea.width)
 
 
             //if (mouse.button == Qt.LeftButton) {
@@ -1,31 +1,141 @@
 # general imports
 import time
+import datetime
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import xarray as xr
+from numpy.lib.stride_tricks import sliding_window_view
 
 # odc imports
+from pystac import ItemCollection
 from pystac_client import Client
 from odc import stac
 
+# external scripts imports
+from scripts import backend
+from scripts import cache
+from scripts import change
+from scripts import cubes
+from scripts import indices
+from scripts import instrument
+from scripts import spatial
+
 # globals
 AWS_S3_ENDPOINT = 's3.ap-southeast-2.amazonaws.com'
 STAC_ENDPOINT = 'https://explorer.sandbox.dea.ga.gov.au/stac/'
+COLLECTIONS = ['ga_ls5t_ard_3', 'ga_ls7e_ard_3', 'ga_ls8c_ard_3']
+FROM_DATE = '1990-01-01'
+LS7_SLC_OFF_DATE = '2003-05-31'  # landsat 7 scenes after this have scan line gaps
+INDEX = 'NDVI'  # default vegetation index, see indices.INDICES
+STAC_PAGE_SIZE = 250  # items per stac search page
+STAC_SEARCH_WORKERS = 8  # concurrent stac searches
+STAC_SPLIT_YEARS = 5  # years per concurrent search within a collection
+EDGE_PIXELS = 1  # num of polygon edge pixels excluded from means
+LOAD_CRS = 'native'  # load each item on its own utm grid, or a crs string e.g. EPSG:4326
+NATIVE_RESOLUTION = 30  # landsat ard pixel size in metres
+PIXEL_BUDGET = 512 * 512  # max pixels read per scene before using coarser overviews
+METRES_PER_DEGREE = 111320
+TRAILING_WINDOW = 64  # num of stored scenes given as context to incremental outlier removal
+SMOOTH_LAMBDA = 10  # whittaker smoothing strength, larger is smoother
+SMOOTH_STEP_DAYS = 16  # landsat revisit, the time unit smoothing strength is given in
+CHANGE = 'change'  # key of a site's ewmacd change results, see change.reduce_change
 
 # configure rasterio for dea aws
-stac.configure_rio(cloud_defaults=True,
-                   aws={"aws_unsigned": True},
-                   AWS_S3_ENDPOINT=AWS_S3_ENDPOINT)
+backend.configure_rio(cloud_defaults=True,
+                      aws={"aws_unsigned": True},
+                      AWS_S3_ENDPOINT=AWS_S3_ENDPOINT)
 
 
-def query_stac(collections, from_date, to_date, bbox):
+class AnalysisCancelled(Exception):
+    """
+    Raised from a progress callback to stop an analysis
+    between pipeline stages.
     """
+    pass
 
-    :param collections:
-    :param from_date:
-    :param to_date:
-    :param bbox:
-    :return:
+
+def notify_progress(progress, stage):
+    """
+    Passes the name of the stage about to run to an optional
+    progress callback. Callbacks may raise AnalysisCancelled
+    to stop the pipeline before the stage begins.
+
+    :param progress: Callable accepting a stage name, or None.
+    :param stage: Name of the pipeline stage.
+    :return: None.
+    """
+
+    if progress is not None:
+        progress(stage)
+
+
+def split_date_range(from_date, to_date, years):
+    """
+    Splits a date range into consecutive, non-overlapping
+    ranges of at most a number of years, so one collection
+    can be searched as several concurrent queries.
+
+    :param from_date: Start date string (YYYY-MM-DD).
+    :param to_date: End date string (YYYY-MM-DD).
+    :param years: Max years per range, or None to not split.
+    :return: List of date range strings (YYYY-MM-DD/YYYY-MM-DD).
+    """
+
+    start = datetime.date.fromisoformat(from_date[:10])
+    end = datetime.date.fromisoformat(to_date[:10])
+    if not years or start > end:
+        return ['{}/{}'.format(from_date, to_date)]
+
+    ranges = []
+    while start <= end:
+        stop = min(datetime.date(start.year + years, start.month, 1) - datetime.timedelta(days=1), end)
+        ranges.append('{}/{}'.format(start.isoformat(), stop.isoformat()))
+        start = stop + datetime.timedelta(days=1)
+
+    return ranges
+
+
+def search_stac(catalog, collection, date_range, bbox, limit):
+    """
+    Runs one stac search and pages through all results.
+    Safe to run from several threads on a shared client.
+
+    :param catalog: Stac client.
+    :param collection: Stac collection name.
+    :param date_range: Date range string (YYYY-MM-DD/YYYY-MM-DD).
+    :param bbox: List of min x, min y, max x, max y.
+    :param limit: Num of items per page.
+    :return: List of item dicts.
+    """
+
+    query = catalog.search(collections=collection,
+                           datetime=date_range,
+                           bbox=bbox,
+                           limit=limit)
+
+    return [item.to_dict() for item in query.get_all_items()]
+
+
+def query_stac(collections, from_date, to_date, bbox, use_cache=True, client=None):
+    """
+    Queries the dea stac for all items within the
+    collections, dates and bbox. Searches are cached
+    locally (see cache.py) so repeat queries of the same
+    or a neighbouring bbox skip the network entirely.
+
+    Uncached collections are searched concurrently on one
+    shared client, each split into date ranges of
+    STAC_SPLIT_YEARS so long records page in parallel too.
+    Items are de-duplicated by id.
+
+    :param collections: List of stac collection names.
+    :param from_date: Start date string (YYYY-MM-DD).
+    :param to_date: End date string (YYYY-MM-DD).
+    :param bbox: List of min x, min y, max x, max y.
+    :param use_cache: Read from and write to the local item cache.
+    :param client: Stac client to search, defaults to opening STAC_ENDPOINT.
+    :return: ItemCollection of all found items.
     """
 
     # notify
@@ -34,42 +144,135 @@ def query_stac(collections, from_date, to_date, bbox):
     # todo checks
     #
 
-    # iter through collections and build queries
-    items = None
+    # open cache once for all collections
+    conn = cache.connect_to_cache() if use_cache else None
+
+    # iter through collections, taking cached items and noting the rest
+    found, searches = {}, {}
     for collection in collections:
         print('Checking for collection: {}.'.format(collection))
 
         # get range of dates
         date_range = '{}/{}'.format(from_date, to_date)
 
-        # fix landsat 7 end date for slc-off
-        if collection == 'ga_ls7e_ard_3' and to_date > '2003-05-31':
-            date_range = '{}/{}'.format(from_date, '2003-05-31')
+        # fix landsat 7 end date for slc-off, skip if starting after it
+        if collection == 'ga_ls7e_ard_3' and to_date > LS7_SLC_OFF_DATE:
+            if from_date > LS7_SLC_OFF_DATE:
+                print('Skipping collection, no scenes before slc-off.')
+                continue
+            date_range = '{}/{}'.format(from_date, LS7_SLC_OFF_DATE)
+
+        # check cache first, skip network on hit
+        if use_cache:
+            cached = cache.get_cached_items(collection=collection,
+                                            date_range=date_range,
+                                            bbox=bbox,
+                                            conn=conn)
+            if cached is not None:
+                print('Using {} cached items.'.format(len(cached)))
+                found[collection] = cached
+                continue
+
+        searches[collection] = date_range
+
+    # search padded bbox so neighbouring sites hit cache later
+    search_bbox = cache.pad_bbox(bbox) if use_cache else bbox
+
+    # run all remaining searches at once on one client
+    if len(searches) > 0:
+        catalog = client or Client.open(STAC_ENDPOINT)
+
+        with ThreadPoolExecutor(max_workers=STAC_SEARCH_WORKERS) as pool:
+            futures = {}
+            for collection, date_range in searches.items():
+                for sub_range in split_date_range(*date_range.split('/'), years=STAC_SPLIT_YEARS):
+                    future = pool.submit(search_stac, catalog, collection, sub_range,
+                                         search_bbox, STAC_PAGE_SIZE)
+                    futures.setdefault(collection, []).append(future)
+
+            # join each collection's ranges in date order
+            for collection, collection_futures in futures.items():
+                items = [item for future in collection_futures for item in future.result()]
+
+                # store and subset back to requested bbox
+                if use_cache:
+                    cache.set_cached_items(collection=collection,
+                                           date_range=searches[collection],
+                                           bbox=search_bbox,
+                                           items=items,
+                                           conn=conn)
+                    items = cache.filter_items(items, bbox)
+
+                found[collection] = items
+
+    # close cache
+    if conn is not None:
+        conn.close()
+
+    # combine in collection order, dropping items found twice
+    items, ids = [], set()
+    for collection in collections:
+        for item in found.get(collection, []):
+            if item['id'] not in ids:
+                ids.add(item['id'])
+                items.append(item)
 
-        # perform query
-        catalog = Client.open(STAC_ENDPOINT)
-        query = catalog.search(collections=collection,
-                               datetime=date_range,
-                               bbox=bbox,
-                               limit=250)
-
-        # create items if new, else append
-        if items is None:
-            items = query.get_all_items()
-        else:
-            items = items + query.get_all_items()
+    # convert back to items
+    items = ItemCollection(items)
 
     # notify and return
     print('Found {} items in total.'.format(len(items)))
     return items
 
 
-def build_dataset(items, bbox, crs, resolution, like, ignore_warnings):
+def get_read_resolution(bbox, crs='EPSG:4326', pixel_budget=None):
+    """
+    Picks the resolution to read a bbox at. Sites read at
+    the native 30 m grid unless that exceeds the per scene
+    pixel budget, in which case the resolution is doubled
+    until it fits. Power of two multiples line up with cog
+    overview levels, so large sites read small overviews
+    rather than full resolution pixels. Coarser reads are
+    averaged, the QA mask is always read nearest.
+
+    :param bbox: List of min x, min y, max x, max y in crs units.
+    :param crs: Crs string of bbox and output grid.
+    :param pixel_budget: Max pixels per scene, defaults to PIXEL_BUDGET.
+    :return: Tuple of resolution in crs units and resampling (or None).
     """
 
+    pixel_budget = pixel_budget or PIXEL_BUDGET
+
+    # native pixel size in crs units
+    resolution = NATIVE_RESOLUTION
+    if spatial.is_geographic(crs):
+        resolution = NATIVE_RESOLUTION / METRES_PER_DEGREE
+
+    # step up overview levels until scene fits budget
+    factor = 1
+    width, height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    while (width / (resolution * factor)) * (height / (resolution * factor)) > pixel_budget:
+        factor *= 2
+
+    # notify
+    if factor > 1:
+        print('Reading at {}x native resolution to fit pixel budget.'.format(factor))
+
+    # average down to overview, keep mask categories intact
+    resampling = {'*': 'average', 'mask': 'nearest'} if factor > 1 else None
+
+    return resolution * factor, resampling
+
+
+def build_dataset(items, bbox, crs, resolution, like, ignore_warnings, bands=None, resampling=None):
+    """
+    Builds a lazy dataset of the requested bands. Only the
+    assets of these bands are read, see indices.get_bands.
+
     :param ignore_warnings:
     :param items:
-    :param bands:
+    :param bands: List of band names to load, defaults to all.
+    :param resampling: Resampling method or dict of band to method, optional.
     :param bbox:
     :param crs:
     :param resolution:
@@ -200,7 +403,7 @@ def build_dataset(items, bbox, crs, resolution, like, ignore_warnings):
         warnings.filterwarnings('ignore')
 
     # always set same names as config conforms ls, s2
-    bands = ['blue', 'green', 'red', 'nir', 'swir_1', 'swir_2', 'mask']
+    bands = bands or ['blue', 'green', 'red', 'nir', 'swir_1', 'swir_2', 'mask']
 
     # build xr dataset
     ds = stac.stac_load(items,
@@ -208,11 +411,12 @@ def build_dataset(items, bbox, crs, resolution, like, ignore_warnings):
                         bbox=bbox,
                         crs=crs,
                         resolution=resolution,
+                        resampling=resampling,
                         groupby="solar_day",
                         stac_cfg=config,
                         skip_broken_datasets=True,
                         like=like,
-                        chunks={})
+                        chunks=backend.get_chunks(crs))
 
     # rename latitude,longitude to y, x if exist
     if 'latitude' in ds and 'longitude' in ds:
@@ -227,6 +431,38 @@ def build_dataset(items, bbox, crs, resolution, like, ignore_warnings):
     return ds
 
 
+def get_valid_fraction(scenes, valid, min_pct):
+    """
+    Gets the fraction of valid QA mask pixels for each scene
+    in a block of scenes (..., y, x). When every pixel must be
+    valid (min pct of 1.0), each scene is checked row by row
+    and stops at its first invalid pixel, returning 1.0 or 0.0.
+
+    :param scenes: Numpy array of QA mask values (..., y, x).
+    :param valid: List of valid QA mask values.
+    :param min_pct: Minimum valid fraction required per scene.
+    :return: Numpy array of valid fractions (...).
+    """
+
+    # flatten leading dims so each scene is checked in turn
+    shape = scenes.shape[:-2]
+    scenes = scenes.reshape((-1,) + scenes.shape[-2:])
+    fractions = np.zeros(len(scenes), dtype='float32')
+
+    for i, scene in enumerate(scenes):
+        if min_pct >= 1.0:
+            # short circuit on first row holding an invalid pixel
+            fractions[i] = 1.0
+            for row in scene:
+                if not np.isin(row, valid).all():
+                    fractions[i] = 0.0
+                    break
+        else:
+            fractions[i] = np.isin(scene, valid).mean() if scene.size else 0.0
+
+    return fractions.reshape(shape)
+
+
 def mask_invalid_scenes(ds, mask_var, valid, min_pct, drop_mask):
     """
     Uses the QA mask to remove whole scenes if above
@@ -234,6 +470,11 @@ def mask_invalid_scenes(ds, mask_var, valid, min_pct, drop_mask):
     1.0 is 100% valid, 0.5 is 50% valid, etc. Invalid
     scenes are removed entirely.
 
+    The mask is streamed one scene per chunk through
+    get_valid_fraction, in parallel on the dask scheduler,
+    so only a valid fraction per scene is ever held and
+    no spectral band is read for rejected scenes.
+
     :param ds:
     :param mask_var:
     :param valid:
@@ -248,35 +489,75 @@ def mask_invalid_scenes(ds, mask_var, valid, min_pct, drop_mask):
     # todo checks
     #
 
-    # subset and download mask variable
+    # subset mask variable, one whole scene per chunk if lazy
     mask = ds[mask_var]
-    mask = mask.load()
+    if mask.chunks is not None:
+        mask = mask.chunk({'time': 1, 'y': -1, 'x': -1})
 
-    # get total number of cells for a scene (i.e. raster)
-    total = mask.sizes['x'] * mask.sizes['y']
-
-    # convert valid/invalid to binary, sum and make a mask
-    mask = xr.where(mask.isin(valid), 1, 0)
-    mask = mask.sum(['x', 'y']) / total
-    mask = xr.where(mask == min_pct, True, False)
+    # get valid fraction per scene without holding the cube
+    fractions = xr.apply_ufunc(get_valid_fraction, mask,
+                               kwargs={'valid': valid, 'min_pct': min_pct},
+                               input_core_dims=[['y', 'x']],
+                               dask='parallelized',
+                               output_dtypes=['float32'])
+    fractions = fractions.compute(**backend.get_compute_kwargs())
 
     # obtain valid date and times, subset valid only
-    valid_dts = mask['time'].where(mask, drop=True)
+    valid_dts = fractions['time'].values[(fractions >= min_pct).values]
     ds = ds.sel(time=valid_dts)
 
     # drop mask variable
     if drop_mask is True:
-        ds = ds.drop_vars('mask')
+        ds = ds.drop_vars(mask_var)
 
     # notify and return
     print('Retained {} valid scenes following mask.'.format(len(valid_dts)))
     return ds
 
 
+def calculate_indices(ds, index_names, drop_bands):
+    """
+    Calculates one or more indices (e.g., NDVI, NDMI) from
+    a dataset of bands in one pass. Each band is cast to
+    float32 once, lazily and chunk by chunk, and shared by
+    every index, so no full copy of the dataset is made.
+    Indices are stored in lower case variables, e.g. ndvi.
+    See indices.INDICES for those supported.
+
+    :param ds: Dataset of bands.
+    :param index_names: List of index names.
+    :param drop_bands: Drop all variables except the indices.
+    :return: Dataset with a variable per index.
+    """
+
+    # notify
+    print('Calculating indices: {}.'.format(', '.join(index_names)))
+
+    # cast shared bands once, float32 arithmetic from here
+    bands = {band: ds[band].astype('float32') for band in indices.get_bands(index_names)}
+
+    # calculate each index via its registered formula
+    index_vars = []
+    for name in index_names:
+        var = indices.get_var(name)
+        ds[var] = indices.get_index(name)['formula'](bands)
+        index_vars.append(var)
+
+    # drop all bands except indices if requested
+    if drop_bands is True:
+        drop_vars = [v for v in ds.data_vars if v not in index_vars]
+        ds = ds.drop_vars(drop_vars)
+
+    # notify and return
+    print('Indices were calculated.')
+    return ds
+
+
 def calculate_index(ds, index, drop_bands):
     """
     Calculates a index (e.g., NDVI) from a dataset
-    of bands.
+    of bands into the veg_idx variable. See
+    calculate_indices to get several at once.
 
     :param ds:
     :param index:
@@ -284,34 +565,30 @@ def calculate_index(ds, index, drop_bands):
     :return:
     """
 
-    # notify
-    print('Calculating index: {}.'.format(index))
+    # calculate as single index then store as veg_idx
+    ds = calculate_indices(ds=ds, index_names=[index], drop_bands=drop_bands)
+    ds = ds.rename({indices.get_var(index): 'veg_idx'})
 
-    # todo checks
-    #
+    return ds
 
-    # calculate ndvi
-    if index.lower() == 'ndvi':
-        ds['veg_idx'] = ((ds['nir'] - ds['red']) /
-                         (ds['nir'] + ds['red']))
 
-        # calculate mavi todo add more indices
-    # ...
+def get_index_names(index=None):
+    """
+    Gets the list of indices to calculate, always starting
+    with INDEX, which is kept as each site's veg_raw series.
 
-    # drop all bands except index if requested
-    if drop_bands is True:
-        drop_vars = [v for v in ds.data_vars if v != 'veg_idx']
-        ds = ds.drop_vars(drop_vars)
+    :param index: Index name or list of names, optional.
+    :return: List of unique index names.
+    """
 
-    # force type to float32 to be safe
-    ds = ds.astype('float32')
+    index = [index] if isinstance(index, str) else list(index or [])
 
-    # todo check if band attributes lost
-    #
+    names = []
+    for name in [INDEX] + index:
+        if name.upper() not in names:
+            names.append(name.upper())
 
-    # notify and return
-    print('Index was calculated.')
-    return ds
+    return names
 
 
 def load_dataset(ds, logic):
@@ -337,7 +614,7 @@ def load_dataset(ds, logic):
 
         # download all at once and time it
         s = time.time()
-        ds = ds.load()
+        ds = ds.load(**backend.get_compute_kwargs())
         e = time.time()
 
         # format duration and notify
@@ -350,7 +627,7 @@ def load_dataset(ds, logic):
 
             # download band and time it
             s = time.time()
-            ds[var] = ds[var].load()
+            ds[var] = ds[var].load(**backend.get_compute_kwargs())
             e = time.time()
 
             # format duration and notify
@@ -362,18 +639,39 @@ def load_dataset(ds, logic):
     return ds
 
 
-def get_temporal_means(ds):
+def get_temporal_means(ds, mask=None, counts=False):
     """
-
-    :param ds:
-    :return:
+    Reduces each scene to a single mean value. If a boolean
+    mask (y, x) is given, e.g. from spatial.rasterize_polygon,
+    only pixels inside the mask are gathered and averaged,
+    otherwise the whole bbox is.
+
+    :param ds: Dataset with time, x and y dims.
+    :param mask: 2d boolean numpy array (y, x) on ds grid, optional.
+    :param counts: Keep each scene's num of valid pixels as a pixels
+    coord, used to weight scenes merged by combine_means.
+    :return: Dataset of means along time.
     """
 
     # notify
     print('Reducing dataset scenes to temporal means.')
 
     # reduce via mean
-    ds = ds.mean(['x', 'y'])
+    if mask is None:
+        dims = ['x', 'y']
+    else:
+        # gather only in-mask pixels then reduce them
+        iy, ix = np.nonzero(mask)
+        ds = ds.isel(y=xr.DataArray(iy, dims='pixel'),
+                     x=xr.DataArray(ix, dims='pixel'))
+        dims = 'pixel'
+
+    # count pixels valid in any variable before they are averaged away
+    if counts:
+        pixels = ds.to_array().notnull().any('variable').sum(dims)
+        ds = ds.mean(dims).assign_coords(pixels=pixels)
+    else:
+        ds = ds.mean(dims)
 
     # todo check if need attrs back on
     #
@@ -449,6 +747,981 @@ def remove_outliers(ds, user_factor=2):
     print('Outlier removal successful.')
     return ds
 
+
+def get_outlier_window(times):
+    """
+    Gets the rolling median window size used by outlier
+    removal, i.e. scenes per year divided by seven, odd and
+    at least three. Matches the logic in remove_outliers.
+
+    :param times: 1d array of datetime64 values.
+    :return: Odd window size integer.
+    """
+
+    # calc win size via num of dates per calendar year spanned
+    years = times.astype('datetime64[Y]').astype(int)
+    win_size = int(len(times) / 7)
+    win_size = int(win_size / int(years.max() - years.min() + 1))
+
+    if win_size < 3:
+        win_size = 3
+    elif win_size % 2 == 0:
+        win_size = win_size + 1
+
+    return win_size
+
+
+def remove_outliers_array(values, times, user_factor=2):
+    """
+    Array version of remove_outliers for many series at once.
+    Takes a 2d (sites, time) matrix sharing one time axis and
+    flags the same median spike outliers as nan, without any
+    xarray intermediates.
+
+    :param values: 2d numpy array (sites, time) of index values.
+    :param times: 1d array of datetime64 values for time axis.
+    :param user_factor: Outlier user factor, see remove_outliers.
+    :return: 2d float32 numpy array with outliers set to nan.
+    """
+
+    # check if user factor provided
+    if user_factor <= 0:
+        raise TypeError('User factor is less than 0, must be above 0.')
+
+    values = np.array(values, dtype='float32', ndmin=2)
+    num_times = values.shape[1]
+    win_size = get_outlier_window(np.asarray(times, dtype='datetime64[ns]'))
+    half = win_size // 2
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+
+        # calc cutoff val per series i.e. stdv of series multiply by user-factor
+        cutoffs = np.nanstd(values, axis=1, keepdims=True) * user_factor
+
+        # calc centred rolling median, nan if window incomplete or holds nan
+        medians = np.full_like(values, np.nan)
+        if num_times >= win_size:
+            windows = sliding_window_view(values, win_size, axis=1)
+            medians[:, half:num_times - half] = np.median(windows, axis=2)
+
+        # replace roll nans with orig vals where orig was not nan
+        nans = np.isnan(values)
+        medians = np.where(np.isnan(medians) != nans, values, medians)
+
+        # calc mask of outliers where absolute diffs exceed cutoff
+        outliers = np.abs(values - medians) > cutoffs
+
+        # get left and right neighbours of outliers, mean and max of each
+        lefts = np.full_like(values, np.nan)
+        rights = np.full_like(values, np.nan)
+        lefts[:, 1:] = values[:, :-1]
+        rights[:, :-1] = values[:, 1:]
+        lefts[~outliers] = np.nan
+        rights[~outliers] = np.nan
+        nbr_means = (lefts + rights) / 2
+        nbr_maxs = np.fmax(lefts, rights)
+
+        # keep nan only if middle val < mean of neighbours - cutoff or > max + cutoff
+        middles = np.where(outliers, values, np.nan)
+        outliers = (middles < nbr_means - cutoffs) | (middles > nbr_maxs + cutoffs)
+
+    # flag outliers as nan
+    values[outliers] = np.nan
+
+    return values
+
+
+def smooth_series_array(values, times, lam=None):
+    """
+    Whittaker smoother for many series at once, each with
+    its own irregular dates. Fits z minimising
+    sum(w * (y - z) ** 2) + lam * sum(d2(z) ** 2), where d2
+    is the second divided difference over each series' own
+    dates and w is 0 at nan gaps, which are filled. The
+    banded system (W + lam * D'D) z = W y is solved for all
+    series together by a pentadiagonal LDL' factorisation,
+    looping once over time and vectorised over series.
+
+    Series of differing lengths are padded at the end with
+    nan values and NaT dates, and padding stays nan.
+
+    :param values: 2d numpy array (sites, time) of index values.
+    :param times: 2d (sites, time) or 1d (time) datetime64 array.
+    :param lam: Smoothing strength, defaults to SMOOTH_LAMBDA.
+    :return: 2d float32 numpy array of smoothed values.
+    """
+
+    lam = SMOOTH_LAMBDA if lam is None else lam
+    values = np.array(values, dtype='float64', ndmin=2)
+    times = np.broadcast_to(np.asarray(times, dtype='datetime64[D]'), values.shape)
+    num_sites, num_times = values.shape
+
+    # nothing to smooth
+    smoothed = np.full(values.shape, np.nan, dtype='float32')
+    if num_times < 3:
+        return smoothed
+
+    # weights zero at gaps and padding
+    padding = np.isnat(times)
+    weights = (~np.isnan(values) & ~padding).astype('float64')
+    ys = np.where(weights > 0, values, 0.0)
+
+    # dates in revisit steps, padding steps on from last date, never two on one day
+    days = np.where(padding, 0, times.astype('int64')).astype('float64')
+    steps = np.diff(days, axis=1)
+    steps = np.where(padding[:, 1:], 1.0, np.maximum(steps, 1.0))
+    steps = steps / SMOOTH_STEP_DAYS
+
+    # second divided difference coefficients per row of d
+    h0, h1 = steps[:, :-1], steps[:, 1:]
+    c0 = 2 / (h0 * (h0 + h1))
+    c1 = -2 / (h0 * h1)
+    c2 = 2 / (h1 * (h0 + h1))
+
+    # bands of a = w + lam * d'd, diagonal a0, first a1, second a2
+    a0 = weights.copy()
+    a0[:, :-2] += lam * c0 ** 2
+    a0[:, 1:-1] += lam * c1 ** 2
+    a0[:, 2:] += lam * c2 ** 2
+    a1 = np.zeros((num_sites, num_times - 1))
+    a1[:, :-1] += lam * c0 * c1
+    a1[:, 1:] += lam * c1 * c2
+    a2 = lam * c0 * c2
+
+    # series with under two values are singular, ignore their warnings
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # factorise, l1 and l2 are the sub diagonals of unit lower l
+        d = np.zeros_like(a0)
+        l1 = np.zeros_like(a0)
+        l2 = np.zeros_like(a0)
+        d[:, 0] = a0[:, 0]
+        l1[:, 1] = a1[:, 0] / d[:, 0]
+        d[:, 1] = a0[:, 1] - l1[:, 1] ** 2 * d[:, 0]
+        for i in range(2, num_times):
+            l2[:, i] = a2[:, i - 2] / d[:, i - 2]
+            l1[:, i] = (a1[:, i - 1] - l2[:, i] * l1[:, i - 1] * d[:, i - 2]) / d[:, i - 1]
+            d[:, i] = a0[:, i] - l1[:, i] ** 2 * d[:, i - 1] - l2[:, i] ** 2 * d[:, i - 2]
+
+        # forward solve l u = w y
+        u = weights * ys
+        for i in range(1, num_times):
+            u[:, i] -= l1[:, i] * u[:, i - 1]
+            if i > 1:
+                u[:, i] -= l2[:, i] * u[:, i - 2]
+
+        # back solve l' z = u / d
+        z = u / d
+        for i in range(num_times - 2, -1, -1):
+            z[:, i] -= l1[:, i + 1] * z[:, i + 1]
+            if i < num_times - 2:
+                z[:, i] -= l2[:, i + 2] * z[:, i + 2]
+
+    # keep series with two or more values, padding stays nan
+    fitted = weights.sum(axis=1) >= 2
+    smoothed[fitted] = z[fitted]
+    smoothed[padding] = np.nan
+
+    return smoothed
+
+
+def smooth_series(series_list, lam=None):
+    """
+    Smooths a list of stored series in one vectorised pass,
+    see smooth_series_array.
+
+    :param series_list: List of tuples of dates and values (lists or arrays), or None.
+    :param lam: Smoothing strength, defaults to SMOOTH_LAMBDA.
+    :return: List of float32 numpy arrays of smoothed values, or None.
+    """
+
+    # pad all series to longest
+    lengths = [len(s[0]) if s is not None and s[0] is not None else 0 for s in series_list]
+    num_times = max(lengths, default=0)
+    values = np.full((len(series_list), num_times), np.nan, dtype='float64')
+    times = np.full((len(series_list), num_times), np.datetime64('NaT'), dtype='datetime64[D]')
+    for row, (series, length) in enumerate(zip(series_list, lengths)):
+        if length > 0:
+            times[row, :length] = np.asarray(series[0], dtype='datetime64[D]')
+            values[row, :length] = np.asarray(series[1], dtype='float64')
+
+    smoothed = smooth_series_array(values, times, lam=lam)
+
+    return [smoothed[row, :length] if length > 0 else None for row, length in enumerate(lengths)]
+
+
+def group_items_by_crs(items, crs=None):
+    """
+    Groups items by the crs they are loaded in. In native
+    mode each item is loaded on its own utm grid (proj:epsg),
+    so a site spanning utm zones gets a group per zone and no
+    scene is warped. Otherwise all items share the given crs.
+
+    :param items: ItemCollection of stac items.
+    :param crs: Native or a crs string, defaults to LOAD_CRS.
+    :return: Dict of crs string to ItemCollection.
+    """
+
+    crs = crs or LOAD_CRS
+    if crs != 'native':
+        return {crs: items}
+
+    groups = {}
+    for item in items:
+        epsg = item.properties.get('proj:epsg')
+        key = 'EPSG:{}'.format(epsg) if epsg else spatial.GEOGRAPHIC_CRS
+        groups.setdefault(key, []).append(item)
+
+    return {key: ItemCollection(group) for key, group in groups.items()}
+
+
+def combine_means(datasets):
+    """
+    Combines temporal means of the same site loaded on
+    different grids into one dataset ordered by time. A site
+    imaged by tiles of two crs groups on the same day gets
+    one scene that day, the mean of both weighted by their
+    valid pixels (see get_temporal_means counts), dated at
+    the first acquisition.
+
+    :param datasets: List of datasets of temporal means.
+    :return: Dataset of temporal means, or None if none given.
+    """
+
+    if len(datasets) == 0:
+        return None
+
+    # grid coords differ between crs groups and are not needed
+    datasets = [ds.drop_vars('spatial_ref', errors='ignore') for ds in datasets]
+    if len(datasets) == 1:
+        return datasets[0].drop_vars('pixels', errors='ignore')
+
+    ds = xr.concat(datasets, dim='time').sortby('time')
+    weights, ds = ds['pixels'], ds.drop_vars('pixels')
+
+    # nothing to merge if every scene is on its own day
+    days = ds['time'].dt.floor('D').rename('day')
+    if len(np.unique(days)) == len(days):
+        return ds
+
+    # weight by valid pixels per variable, days without any are nan
+    weights = weights * ds.notnull()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged = (ds.fillna(0) * weights).groupby(days).sum() / weights.groupby(days).sum()
+    times = ds['time'].groupby(days).min()
+
+    return merged.rename({'day': 'time'}).assign_coords(time=times.values)
+
+
+def load_cube(items, bbox, crs, resolution, resampling, index_names, progress=None, recorder=None):
+    """
+    Runs the build, mask, index and load stages for items
+    sharing one crs, returning the loaded index cube.
+
+    :param items: ItemCollection of stac items.
+    :param bbox: List of min x, min y, max x, max y in lon, lat.
+    :param crs: Crs string to load in.
+    :param resolution: Resolution in crs units, see get_read_resolution.
+    :param resampling: Resampling, see get_read_resolution.
+    :param index_names: List of index names.
+    :param progress: Callable given each stage name, see notify_progress.
+    :param recorder: instrument.Recorder given a span per stage, optional.
+    :return: Loaded dataset (time, y, x) of indices or None if no valid scenes.
+    """
+
+    # now build a dataset using all available items
+    notify_progress(progress, 'build')
+    with instrument.span(recorder, 'build') as span:
+        ds = build_dataset(items=items,
+                           bbox=bbox,
+                           crs=crs,
+                           resolution=resolution,
+                           like=None,
+                           ignore_warnings=True,
+                           bands=indices.get_bands(index_names) + ['mask'],
+                           resampling=resampling)
+        span.scenes_in, span.scenes_out = len(items), len(ds['time'])
+
+    # mask out (remove) any invalid scenes
+    notify_progress(progress, 'mask')
+    with instrument.span(recorder, 'mask') as span:
+        span.scenes_in, span.bytes = len(ds['time']), ds['mask'].nbytes
+        ds = mask_invalid_scenes(ds=ds,
+                                 mask_var='mask',
+                                 valid=[1, 4, 5],
+                                 min_pct=1.0,
+                                 drop_mask=True)
+        span.scenes_out = len(ds['time'])
+
+    # nothing valid to process
+    if len(ds['time']) == 0:
+        return None
+
+    # calculate all requested indices from one read of their bands
+    notify_progress(progress, 'index')
+    with instrument.span(recorder, 'index'):
+        ds = calculate_indices(ds=ds,
+                               index_names=index_names,
+                               drop_bands=True)
+
+    # load the dataset all at same time (we only have the indices)
+    notify_progress(progress, 'load')
+    with instrument.span(recorder, 'load') as span:
+        ds = load_dataset(ds=ds, logic='all')
+        span.scenes_in = span.scenes_out = len(ds['time'])
+        span.bytes = ds.nbytes
+
+    return ds
+
+
+def load_cached_cube(items, geometry, bbox, crs, index_names, from_date, to_date, progress=None, recorder=None,
+                     history=False):
+    """
+    Gets a site's loaded index cube, reading any cached cube
+    (see cubes.py) and only building, masking and loading
+    items not yet checked into it, which are then appended
+    to it. Items are tracked by id rather than date, so only
+    items the search returned but the cube has not seen are
+    loaded. Incremental runs only search after each site's
+    last date, so scenes published late but acquired before
+    it are not picked up until a full rebuild. A cube is
+    rebuilt if it does not reach back to from date or
+    predates item tracking. The date the cube's record
+    starts from is kept in its checked_from attribute.
+
+    :param items: ItemCollection of stac items.
+    :param geometry: List of latitude, longitude dicts.
+    :param bbox: List of min x, min y, max x, max y in lon, lat.
+    :param crs: Crs string to load in.
+    :param index_names: List of index names.
+    :param from_date: Start date string (YYYY-MM-DD).
+    :param to_date: End date string (YYYY-MM-DD).
+    :param progress: Callable given each stage name, see notify_progress.
+    :param recorder: instrument.Recorder given a span per stage, optional.
+    :param history: Return the whole cached record rather than from from date.
+    :return: Dataset (time, y, x) of indices within dates, or None if no valid scenes.
+    """
+
+    resolution, resampling = get_read_resolution(spatial.project_bbox(bbox, crs), crs=crs)
+
+    # no cache, load everything, record starts at from date
+    if not cubes.is_enabled():
+        ds = load_cube(items, bbox, crs, resolution, resampling, index_names, progress, recorder)
+        if ds is not None:
+            ds.attrs.update({'checked_from': from_date, 'checked_to': to_date})
+        return ds
+
+    # use cached cube if it covers the start of the range
+    key = cubes.get_cube_key(geometry, crs, resolution, index_names)
+    cached = cubes.read_cube(key)
+    if cached is not None and (cached.attrs.get('checked_from', '9999') > from_date or
+                               'item_ids' not in cached.attrs):
+        cached = None
+
+    # only load items not yet checked into cube
+    item_ids = [item.id for item in items]
+    if cached is not None:
+        checked = set(cached.attrs['item_ids'])
+        items = ItemCollection([item for item in items if item.id not in checked])
+        print('Using cached cube, {} new items to load.'.format(len(items)))
+
+    # load new scenes and store
+    ds = None
+    if len(items) > 0:
+        ds = load_cube(items, bbox, crs, resolution, resampling, index_names, progress, recorder)
+
+    if cached is None:
+        if ds is not None:
+            cubes.write_cube(key, ds, checked_from=from_date, checked_to=to_date, item_ids=item_ids)
+    else:
+        new = ds if ds is not None else cached.isel(time=slice(0, 0))
+        cubes.write_cube(key, new, checked_from=cached.attrs['checked_from'],
+                         checked_to=max(to_date, cached.attrs['checked_to']), item_ids=item_ids, append=True)
+        ds = cubes.read_cube(key).sortby('time')
+
+    # subset to requested dates
+    if ds is None:
+        return None
+
+    ds.attrs['checked_from'] = ds.attrs.get('checked_from', from_date)
+    return ds.sel(time=slice(ds.attrs['checked_from'] if history else from_date, to_date))
+
+
+def reduce_cube(ds, geometry, crs, erode, progress=None, recorder=None):
+    """
+    Runs the reduce stage, one mean value per scene within
+    the site polygon projected to the cube's grid.
+
+    :param ds: Loaded dataset (time, y, x) of indices.
+    :param geometry: List of latitude, longitude dicts.
+    :param crs: Crs string of cube grid.
+    :param erode: Num of polygon edge pixels to exclude from means.
+    :param progress: Callable given each stage name, see notify_progress.
+    :param recorder: instrument.Recorder given a span per stage, optional.
+    :return: Dataset of temporal means.
+    """
+
+    # reduce down to one mean value per scene within polygon, minus edge pixels
+    notify_progress(progress, 'reduce')
+    with instrument.span(recorder, 'reduce') as span:
+        mask = spatial.rasterize_polygon(geometry, ds['x'].values, ds['y'].values, erode=erode, crs=crs)
+        ds = get_temporal_means(ds, mask=mask, counts=True).load(**backend.get_compute_kwargs())
+        span.scenes_in = span.scenes_out = len(ds['time'])
+
+    return ds
+
+
+def detect_site_change(ds, geometry, crs, erode, progress=None, recorder=None):
+    """
+    Runs the change stage, ewmacd per pixel of the INDEX
+    cube mapped over dask chunks (see change.detect_change),
+    then reduced to the site within the polygon projected to
+    the cube's grid (see change.reduce_change).
+
+    :param ds: Dataset (time, y, x) of indices over the whole record.
+    :param geometry: List of latitude, longitude dicts.
+    :param crs: Crs string of cube grid.
+    :param erode: Num of polygon edge pixels to exclude.
+    :param progress: Callable given each stage name, see notify_progress.
+    :param recorder: instrument.Recorder given a span per stage, optional.
+    :return: Dict of site change results, see change.reduce_change.
+    """
+
+    # detect change per pixel before any spatial reduction
+    notify_progress(progress, 'change')
+    with instrument.span(recorder, 'change') as span:
+        mask = spatial.rasterize_polygon(geometry, ds['x'].values, ds['y'].values, erode=erode, crs=crs)
+        changes = change.detect_change(ds[indices.get_var(INDEX)]).load(**backend.get_compute_kwargs())
+        span.scenes_in = span.scenes_out = len(ds['time'])
+        span.bytes = changes.nbytes
+
+    return change.reduce_change(changes, mask, crs=crs)
+
+
+def load_means(items, geometry, bbox, crs, index_names, erode, from_date, to_date, progress=None, recorder=None,
+               ewmacd=False):
+    """
+    Gets a site's loaded index cube for items sharing one
+    crs, from the cube cache where possible, and reduces it
+    to temporal means. The polygon is projected onto the
+    grid rather than the scenes warped. If ewmacd, change is
+    detected over the cube first, as long as the cube holds
+    the whole record from FROM_DATE, e.g. when rebuilding or
+    from the cube cache.
+
+    :param items: ItemCollection of stac items.
+    :param geometry: List of latitude, longitude dicts.
+    :param bbox: List of min x, min y, max x, max y in lon, lat.
+    :param crs: Crs string to load in.
+    :param index_names: List of index names.
+    :param erode: Num of polygon edge pixels to exclude from means.
+    :param from_date: Start date string (YYYY-MM-DD).
+    :param to_date: End date string (YYYY-MM-DD).
+    :param progress: Callable given each stage name, see notify_progress.
+    :param recorder: instrument.Recorder given a span per stage, optional.
+    :param ewmacd: Detect change, see detect_site_change.
+    :return: Tuple of dataset of temporal means and dict of change
+    results, either None if no valid scenes or not run.
+    """
+
+    ds = load_cached_cube(items, geometry, bbox, crs, index_names, from_date, to_date, progress, recorder,
+                          history=ewmacd)
+    if ds is None or len(ds['time']) == 0:
+        return None, None
+
+    # change needs the whole record to train on
+    site_change = None
+    if ewmacd and ds.attrs.get('checked_from', from_date) <= FROM_DATE:
+        site_change = detect_site_change(ds, geometry, crs, erode, progress, recorder)
+
+    ds = ds.sel(time=slice(from_date, to_date))
+    if len(ds['time']) == 0:
+        return None, site_change
+
+    return reduce_cube(ds, geometry, crs, erode, progress, recorder), site_change
+
+
+def run_analysis(geometry, from_date, to_date, collections=None, progress=None, erode=None, recorder=None,
+                 index=None, crs=None, ewmacd=False):
+    """
+    Runs the query, build, mask, index, load, change and
+    reduce stages for a site polygon and date range. Outliers
+    are not removed here so callers can choose the series
+    context. Items are loaded per crs group (see
+    group_items_by_crs) and only their per scene means are
+    combined. Change is detected on the group with the most
+    items, as pixel series cannot span grids.
+
+    :param geometry: List of latitude, longitude dicts.
+    :param from_date: Start date string (YYYY-MM-DD).
+    :param to_date: End date string (YYYY-MM-DD).
+    :param collections: List of stac collection names.
+    :param progress: Callable given each stage name, see notify_progress.
+    :param erode: Num of polygon edge pixels to exclude from means.
+    :param recorder: instrument.Recorder given a span per stage, optional.
+    :param index: Index name or list of names, INDEX is always included.
+    :param crs: Native or a crs string to load in, defaults to LOAD_CRS.
+    :param ewmacd: Detect change, see load_means.
+    :return: Tuple of dataset of temporal means and dict of change
+    results, either None if no valid scenes or not run.
+    """
+
+    # use defaults if none given
+    collections = collections or COLLECTIONS
+    index_names = get_index_names(index)
+    erode = EDGE_PIXELS if erode is None else erode
+
+    # get bounding box
+    bbox = spatial.qml_polygon_to_bbox(geometry)
+
+    # query aws stac for available collection items
+    notify_progress(progress, 'query')
+    with instrument.span(recorder, 'query') as span:
+        items = query_stac(collections=collections,
+                           from_date=from_date,
+                           to_date=to_date,
+                           bbox=bbox)
+        span.scenes_out = len(items)
+
+    # nothing new to process
+    if len(items) == 0:
+        return None, None
+
+    # load each crs group on its own grid, keep only means
+    groups = group_items_by_crs(items, crs)
+    change_crs = max(groups, key=lambda key: len(groups[key]))
+    means, site_change = [], None
+    for group_crs, group in groups.items():
+        ds, group_change = load_means(items=group,
+                                      geometry=geometry,
+                                      bbox=bbox,
+                                      crs=group_crs,
+                                      index_names=index_names,
+                                      erode=erode,
+                                      from_date=from_date,
+                                      to_date=to_date,
+                                      progress=progress,
+                                      recorder=recorder,
+                                      ewmacd=ewmacd and group_crs == change_crs)
+        if ds is not None:
+            means.append(ds)
+        if group_change is not None:
+            site_change = group_change
+
+    return combine_means(means), site_change
+
+
+def build_series(dates, values):
+    """
+    Builds a temporal means dataset from previously
+    stored lists of dates and vegetation values.
+
+    :param dates: List of date strings (YYYY-MM-DD).
+    :param values: List of vegetation index values.
+    :return: Dataset with veg_idx variable along time.
+    """
+
+    # convert to typed arrays
+    dates = np.array(dates, dtype='datetime64[ns]')
+    values = np.array(values, dtype='float32')
+
+    # build dataset
+    ds = xr.Dataset({'veg_idx': ('time', values)}, coords={'time': dates})
+
+    return ds
+
+
+def get_next_date(dates):
+    """
+    Gets the day following the last stored date, i.e.
+    the start date of an incremental query.
+
+    :param dates: List of date strings (YYYY-MM-DD).
+    :return: Date string (YYYY-MM-DD) or None if no dates.
+    """
+
+    # nothing stored yet
+    if dates is None or len(dates) == 0:
+        return None
+
+    # step one day past latest date
+    last = datetime.date.fromisoformat(str(max(dates))[:10])
+    next_date = last + datetime.timedelta(days=1)
+
+    return next_date.isoformat()
+
+
+def append_series(ds_old, ds_new, window=None, user_factor=2):
+    """
+    Removes outliers from newly acquired temporal means
+    using a trailing window of stored values as context
+    and returns only the new, cleaned values.
+
+    :param ds_old: Dataset of stored temporal means.
+    :param ds_new: Dataset of new temporal means.
+    :param window: Num of trailing stored scenes used as context.
+    :param user_factor: Outlier user factor, see remove_outliers.
+    :return: Dataset of cleaned new temporal means.
+    """
+
+    # notify
+    print('Appending {} new scenes to series.'.format(len(ds_new['time'])))
+
+    # use default window if none given
+    window = window or TRAILING_WINDOW
+
+    # drop any new scenes already stored
+    ds_new = ds_new.isel(time=(ds_new['time'] > ds_old['time'].max()).values)
+
+    # combine trailing window and new scenes
+    trailing = ds_old.isel(time=slice(-window, None))
+    ds = xr.concat([trailing, ds_new[['veg_idx']]], dim='time')
+
+    # remove spike outliers over combined window
+    ds['veg_idx'] = ('time', remove_outliers_array(ds['veg_idx'].values, ds['time'].values,
+                                                   user_factor=user_factor)[0])
+
+    # keep new scenes only
+    ds = ds.isel(time=slice(len(trailing['time']), None))
+
+    return ds
+
+
+def merge_series(ds, dates=None, values=None, user_factor=2):
+    """
+    Removes outliers from new temporal means and converts
+    them to lists of dates and values. If a stored series
+    is given, new values are cleaned against its trailing
+    window and appended to it (see append_series).
+
+    :param ds: Dataset of new temporal means.
+    :param dates: List or array of stored dates, or None.
+    :param values: List or array of stored vegetation values, or None.
+    :param user_factor: Outlier user factor, see remove_outliers.
+    :return: Tuple of lists of dates and values.
+    """
+
+    # remove spike outliers, against stored tail if appending
+    appending = dates is not None and len(dates) > 0
+    if appending:
+        old = build_series(dates=dates, values=values)
+        ds = append_series(ds_old=old, ds_new=ds, user_factor=user_factor)
+    else:
+        ds['veg_idx'] = ('time', remove_outliers_array(ds['veg_idx'].values, ds['time'].values,
+                                                       user_factor=user_factor)[0])
+
+    # prepare dates and veg values
+    dts = [str(dt) for dt in ds['time'].dt.strftime('%Y-%m-%d').values]
+    vals = [float(val) for val in ds['veg_idx'].values]
+
+    # append to stored series if given
+    if appending:
+        dts = [str(dt) for dt in dates] + dts
+        vals = [float(val) for val in values] + vals
+
+    return dts, vals
+
+
+def crop_to_bbox(ds, bbox):
+    """
+    Crops a dataset to the pixels whose centres fall in a
+    bbox, padded by half a pixel so that tiny sites always
+    keep at least one pixel.
+
+    :param ds: Dataset or DataArray with x and y dims.
+    :param bbox: List of min x, min y, max x, max y.
+    :return: Cropped dataset or DataArray.
+    """
+
+    # get half pixel size
+    xs, ys = ds['x'].values, ds['y'].values
+    pad_x = abs(xs[1] - xs[0]) / 2 if len(xs) > 1 else 0
+    pad_y = abs(ys[1] - ys[0]) / 2 if len(ys) > 1 else 0
+
+    # select pixels within padded bbox, works for either y order
+    keep_x = (xs >= bbox[0] - pad_x) & (xs <= bbox[2] + pad_x)
+    keep_y = (ys >= bbox[1] - pad_y) & (ys <= bbox[3] + pad_y)
+
+    return ds.isel(x=keep_x, y=keep_y)
+
+
+def load_batch_means(items, sites, bbox, crs, index_names, erode, progress=None, recorder=None, ewmacd=False):
+    """
+    Runs the build, mask, index, load, change and reduce
+    stages for a cluster of sites over items sharing one crs,
+    with one load over their union extent. The mask is
+    streamed once, a scene at a time, to find each site's
+    valid scenes, the indices are then read once for scenes
+    valid at any site, and per site change and means are
+    split out of the cube.
+
+    :param items: ItemCollection of stac items.
+    :param sites: Dict of site id to list of latitude, longitude dicts.
+    :param bbox: Union bbox of sites in lon, lat.
+    :param crs: Crs string to load in.
+    :param index_names: List of index names.
+    :param erode: Num of polygon edge pixels to exclude from means.
+    :param progress: Callable given each stage name, see notify_progress.
+    :param recorder: instrument.Recorder given a span per stage, optional.
+    :param ewmacd: Detect change per site, items must cover the whole record.
+    :return: Tuple of dicts of site id to dataset of temporal means
+    and site id to dict of change results, or None.
+    """
+
+    # site extents on load grid
+    bboxes = {id: spatial.project_bbox(spatial.qml_polygon_to_bbox(geometry), crs)
+              for id, geometry in sites.items()}
+    results = {id: None for id in sites}
+    changes = {id: None for id in sites}
+
+    # build a single dataset over the union extent
+    notify_progress(progress, 'build')
+    with instrument.span(recorder, 'build') as span:
+        resolution, resampling = get_read_resolution(spatial.project_bbox(bbox, crs), crs=crs)
+        ds = build_dataset(items=items,
+                           bbox=bbox,
+                           crs=crs,
+                           resolution=resolution,
+                           like=None,
+                           ignore_warnings=True,
+                           bands=indices.get_bands(index_names) + ['mask'],
+                           resampling=resampling)
+        span.scenes_in, span.scenes_out = len(items), len(ds['time'])
+
+    # stream mask one scene per chunk, each site's crop reduced to a valid fraction per scene
+    notify_progress(progress, 'mask')
+    with instrument.span(recorder, 'mask') as span:
+        mask = ds['mask']
+        if mask.chunks is not None:
+            mask = mask.chunk({'time': 1, 'y': -1, 'x': -1})
+
+        fractions = xr.Dataset({str(id): xr.apply_ufunc(get_valid_fraction, crop_to_bbox(mask, site_bbox),
+                                                        kwargs={'valid': [1, 4, 5], 'min_pct': 1.0},
+                                                        input_core_dims=[['y', 'x']],
+                                                        dask='parallelized',
+                                                        output_dtypes=['float32'])
+                                for id, site_bbox in bboxes.items()})
+        fractions = fractions.compute(**backend.get_compute_kwargs())
+
+        valid_times = {id: fractions['time'].values[(fractions[str(id)] >= 1.0).values] for id in bboxes}
+
+        # only read scenes valid for at least one site
+        times = np.unique(np.concatenate(list(valid_times.values())))
+        span.scenes_in, span.scenes_out, span.bytes = len(ds['time']), len(times), mask.nbytes
+    if len(times) == 0:
+        return results, changes
+
+    ds = ds.sel(time=times).drop_vars('mask')
+
+    # calculate all requested indices from one read of their bands
+    notify_progress(progress, 'index')
+    with instrument.span(recorder, 'index'):
+        ds = calculate_indices(ds=ds,
+                               index_names=index_names,
+                               drop_bands=True)
+
+    # load the union cube once
+    notify_progress(progress, 'load')
+    with instrument.span(recorder, 'load') as span:
+        ds = load_dataset(ds=ds, logic='all')
+        span.scenes_in = span.scenes_out = len(ds['time'])
+        span.bytes = ds.nbytes
+
+    # detect change per pixel of each site's valid scenes
+    if ewmacd:
+        for id, site_bbox in bboxes.items():
+            if len(valid_times[id]) > 0:
+                site_ds = crop_to_bbox(ds, site_bbox).sel(time=valid_times[id])
+                changes[id] = detect_site_change(site_ds, sites[id], crs, erode, progress, recorder)
+
+    # split out and reduce each site within polygon, minus edge pixels
+    notify_progress(progress, 'reduce')
+    with instrument.span(recorder, 'reduce') as span:
+        for id, site_bbox in bboxes.items():
+            if len(valid_times[id]) > 0:
+                site_ds = crop_to_bbox(ds, site_bbox).sel(time=valid_times[id])
+                mask = spatial.rasterize_polygon(sites[id], site_ds['x'].values, site_ds['y'].values,
+                                                 erode=erode, crs=crs)
+                results[id] = get_temporal_means(site_ds, mask=mask, counts=True)
+        span.scenes_in, span.scenes_out = len(ds['time']), sum(len(t) for t in valid_times.values())
+
+    return results, changes
+
+
+def run_batch_analysis(sites, from_date, to_date, collections=None, progress=None, erode=None, recorder=None,
+                       index=None, crs=None, ewmacd=False):
+    """
+    Runs the analysis pipeline for a cluster of neighbouring
+    sites with one stac query and, per crs group (see
+    group_items_by_crs), one load over their union extent
+    (see load_batch_means). See spatial.cluster_bboxes for
+    building clusters. Change is detected on the group with
+    the most items, and only if loading from FROM_DATE, as
+    batch loads are not cached.
+
+    :param sites: Dict of site id to list of latitude, longitude dicts.
+    :param from_date: Start date string (YYYY-MM-DD).
+    :param to_date: End date string (YYYY-MM-DD).
+    :param collections: List of stac collection names.
+    :param progress: Callable given each stage name, see notify_progress.
+    :param erode: Num of polygon edge pixels to exclude from means.
+    :param recorder: instrument.Recorder given a span per stage, optional.
+    :param index: Index name or list of names, INDEX is always included.
+    :param crs: Native or a crs string to load in, defaults to LOAD_CRS.
+    :param ewmacd: Detect change, see load_batch_means.
+    :return: Tuple of dicts of site id to dataset of temporal means
+    and site id to dict of change results, or None.
+    """
+
+    # notify
+    print('Performing batch analysis for {} sites.'.format(len(sites)))
+
+    # use defaults if none given
+    collections = collections or COLLECTIONS
+    index_names = get_index_names(index)
+    erode = EDGE_PIXELS if erode is None else erode
+
+    # all sites share union extent
+    bbox = spatial.union_bbox([spatial.qml_polygon_to_bbox(geometry) for geometry in sites.values()])
+
+    # query aws stac once for whole cluster
+    notify_progress(progress, 'query')
+    with instrument.span(recorder, 'query') as span:
+        items = query_stac(collections=collections,
+                           from_date=from_date,
+                           to_date=to_date,
+                           bbox=bbox)
+        span.scenes_out = len(items)
+
+    # nothing new to process
+    if len(items) == 0:
+        return {id: None for id in sites}, {id: None for id in sites}
+
+    # load each crs group on its own grid, keep only means
+    groups = group_items_by_crs(items, crs)
+    change_crs = max(groups, key=lambda key: len(groups[key]))
+    means, changes = {id: [] for id in sites}, {id: None for id in sites}
+    for group_crs, group in groups.items():
+        group_means, group_changes = load_batch_means(items=group,
+                                                      sites=sites,
+                                                      bbox=bbox,
+                                                      crs=group_crs,
+                                                      index_names=index_names,
+                                                      erode=erode,
+                                                      progress=progress,
+                                                      recorder=recorder,
+                                                      ewmacd=ewmacd and from_date <= FROM_DATE and
+                                                             group_crs == change_crs)
+        for id, ds in group_means.items():
+            if ds is not None:
+                means[id].append(ds)
+            if group_changes[id] is not None:
+                changes[id] = group_changes[id]
+
+    return {id: combine_means(site_means) for id, site_means in means.items()}, changes
+
+
+def analyse_sites(sites, incremental=False, to_date=None, progress=None, recorder=None, index=None,
+                  ewmacd=True):
+    """
+    Runs the full pipeline, including outlier removal, for one
+    site or a cluster of neighbouring sites (see
+    run_batch_analysis) and returns each site's updated series.
+    If incremental, only scenes after each site's last stored
+    date are fetched and appended to its stored series.
+
+    Every requested index is calculated from the one download.
+    INDEX is always included and its stored series is a site's
+    dates and values, any other stored series are given per
+    index in the site's optional indices dict. A site missing a
+    stored series for a requested index is rebuilt in full.
+
+    If ewmacd, change is detected per pixel over each site's
+    whole record and given under CHANGE (see
+    change.reduce_change). Incremental runs only detect change
+    where the record is available from the cube cache.
+
+    :param sites: List of dicts of id, geometry, dates, values and optional indices.
+    :param incremental: Append new scenes only, else rebuild.
+    :param to_date: End date string (YYYY-MM-DD), defaults to today.
+    :param progress: Callable given each stage name, see notify_progress.
+    :param recorder: instrument.Recorder given a span per stage, optional.
+    :param index: Index name or list of names, INDEX is always included.
+    :param ewmacd: Detect change, see change.py.
+    :return: Dict of site id to dict of index name to tuple of dates and values lists,
+    and CHANGE to dict of change results if detected, or None.
+    """
+
+    # tag spans with this site or cluster
+    if recorder is not None:
+        recorder = recorder.bind([site['id'] for site in sites])
+
+    # stored series of each site per index
+    index_names = get_index_names(index)
+    stored = {}
+    for site in sites:
+        stored[site['id']] = dict(site.get('indices') or {})
+        stored[site['id']][INDEX] = (site['dates'], site['values'])
+
+    # start after last stored date if incremental and every index has history
+    from_dates = {}
+    for site in sites:
+        from_dates[site['id']] = None
+        if incremental and all(name in stored[site['id']] for name in index_names):
+            from_dates[site['id']] = get_next_date(site['dates'])
+
+    # cluster starts at its earliest site
+    from_date = min([dt or FROM_DATE for dt in from_dates.values()])
+    to_date = to_date or datetime.date.today().isoformat()
+
+    # run query, build, mask, index, load, change and reduce stages
+    if len(sites) == 1:
+        ds, site_change = run_analysis(geometry=sites[0]['geometry'],
+                                       from_date=from_date,
+                                       to_date=to_date,
+                                       progress=progress,
+                                       recorder=recorder,
+                                       index=index_names,
+                                       ewmacd=ewmacd)
+        results, changes = {sites[0]['id']: ds}, {sites[0]['id']: site_change}
+    else:
+        results, changes = run_batch_analysis(sites={site['id']: site['geometry'] for site in sites},
+                                              from_date=from_date,
+                                              to_date=to_date,
+                                              progress=progress,
+                                              recorder=recorder,
+                                              index=index_names,
+                                              ewmacd=ewmacd)
+
+    # remove spike outliers, append to stored series if incremental
+    notify_progress(progress, 'outliers')
+    with instrument.span(recorder, 'outliers'):
+        for site in sites:
+            ds = results[site['id']]
+
+            # nothing new since last run
+            if ds is None or len(ds['time']) == 0:
+                print('No new valid scenes found for site {}.'.format(site['id']))
+                results[site['id']] = None
+                continue
+
+            appending = from_dates[site['id']] is not None
+            results[site['id']] = {}
+            for name in index_names:
+                dates, values = stored[site['id']].get(name, (None, None))
+                var = indices.get_var(name)
+                results[site['id']][name] = merge_series(ds=ds[[var]].rename({var: 'veg_idx'}),
+                                                         dates=dates if appending else None,
+                                                         values=values if appending else None,
+                                                         user_factor=2)
+
+            # change results kept alongside series
+            if changes.get(site['id']) is not None:
+                results[site['id']][CHANGE] = changes[site['id']]
+
+    return results
+
+
 # working
 def _():
 
@@ -495,7 +1768,7 @@ def _():
     # reduce down to one mean value per scene
     ds = get_temporal_means(ds)
 
-    # todo perform ewmacd
+    # perform ewmacd, see detect_site_change
     #
 
     # todo extract values from veg, change, conseqs, etc.
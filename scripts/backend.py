@@ -0,0 +1,178 @@
+# general imports
+import os
+import tempfile
+
+# odc imports
+from odc import stac
+
+# optional distributed scheduler
+try:
+    from dask.distributed import Client, LocalCluster
+except ImportError:
+    Client, LocalCluster = None, None
+
+# globals
+DASK_BACKEND = 'threads'        # threads, processes or distributed
+DASK_WORKERS = os.cpu_count()   # threads, processes or cluster workers
+DASK_THREADS_PER_WORKER = 1     # distributed only
+DASK_MEMORY_LIMIT = 'auto'      # per distributed worker, e.g. '2GB'
+DASK_LOCAL_DIRECTORY = os.path.join(tempfile.gettempdir(), 'monitoria-dask')
+DASK_CHUNKS = {'time': 1, 'y': 2048, 'x': 2048}  # stac_load chunks, -1 for whole dim
+
+# current settings, rasterio settings and the persistent cluster client
+SETTINGS = {}
+RIO_SETTINGS = {}
+CLIENT = None
+
+
+def configure(backend=None, workers=None, threads_per_worker=None, memory_limit=None, chunks=None):
+    """
+    Sets the dask backend used for every analysis. Any
+    setting not given keeps its global default. Changing
+    settings closes a running cluster, the next analysis
+    starts a new one.
+
+    :param backend: One of threads, processes or distributed.
+    :param workers: Num of threads, processes or cluster workers.
+    :param threads_per_worker: Threads per distributed worker.
+    :param memory_limit: Memory limit per distributed worker.
+    :param chunks: Dict of time, y and x chunk sizes.
+    :return: None.
+    """
+
+    settings = {
+        'backend': backend or DASK_BACKEND,
+        'workers': workers or DASK_WORKERS,
+        'threads_per_worker': threads_per_worker or DASK_THREADS_PER_WORKER,
+        'memory_limit': memory_limit or DASK_MEMORY_LIMIT,
+        'chunks': dict(DASK_CHUNKS, **(chunks or {})),
+    }
+
+    if settings['backend'] not in ['threads', 'processes', 'distributed']:
+        raise ValueError('Dask backend must be threads, processes or distributed.')
+
+    # fall back if distributed not installed
+    if settings['backend'] == 'distributed' and Client is None:
+        print('Dask distributed not installed. Using threads backend.')
+        settings['backend'] = 'threads'
+
+    if settings != SETTINGS:
+        shutdown()
+        SETTINGS.clear()
+        SETTINGS.update(settings)
+
+
+def get_settings():
+    """
+    Gets current backend settings, configuring defaults
+    on first use.
+
+    :return: Dict of settings.
+    """
+
+    if not SETTINGS:
+        configure()
+
+    return SETTINGS
+
+
+def configure_rio(**settings):
+    """
+    Configures rasterio (see odc.stac.configure_rio) in this
+    process and keeps the settings so cluster workers get
+    them too, as they run in their own processes.
+
+    :param settings: Keyword arguments of odc.stac.configure_rio.
+    :return: None.
+    """
+
+    RIO_SETTINGS.clear()
+    RIO_SETTINGS.update(settings)
+
+    stac.configure_rio(**RIO_SETTINGS)
+    if CLIENT is not None:
+        stac.configure_rio(**RIO_SETTINGS, client=CLIENT)
+
+
+def get_client():
+    """
+    Gets the distributed client, starting a local cluster
+    once and reusing it for all later analyses. Worker
+    files go to a temp folder rather than the working
+    directory. Workers are given the rasterio settings of
+    configure_rio.
+
+    :return: Dask distributed Client.
+    """
+
+    global CLIENT
+
+    if CLIENT is None:
+        settings = get_settings()
+
+        # notify
+        print('Starting local dask cluster with {} workers.'.format(settings['workers']))
+
+        cluster = LocalCluster(n_workers=settings['workers'],
+                               threads_per_worker=settings['threads_per_worker'],
+                               memory_limit=settings['memory_limit'],
+                               local_directory=DASK_LOCAL_DIRECTORY,
+                               processes=True)
+        CLIENT = Client(cluster, set_as_default=False)
+
+        # workers are separate processes, configure their rasterio too
+        if RIO_SETTINGS:
+            stac.configure_rio(**RIO_SETTINGS, client=CLIENT)
+
+    return CLIENT
+
+
+def get_chunks(crs):
+    """
+    Gets stac_load chunk sizes for a crs, naming spatial
+    dims latitude and longitude for geographic crs as
+    stac_load does.
+
+    :param crs: Crs string, e.g. EPSG:4326.
+    :return: Dict of dim name to chunk size.
+    """
+
+    chunks = dict(get_settings()['chunks'])
+    if str(crs).upper() == 'EPSG:4326':
+        chunks['latitude'], chunks['longitude'] = chunks.pop('y'), chunks.pop('x')
+
+    return chunks
+
+
+def get_compute_kwargs():
+    """
+    Gets the keyword arguments that run a dask compute or
+    load on the configured backend, e.g. ds.load(**kwargs).
+    Passed per call rather than set in the global dask
+    config, which concurrent analyses would overwrite.
+
+    :return: Dict of scheduler and, if not distributed, num_workers.
+    """
+
+    settings = get_settings()
+
+    if settings['backend'] == 'distributed':
+        return {'scheduler': get_client()}
+
+    return {'scheduler': settings['backend'], 'num_workers': settings['workers']}
+
+
+def shutdown():
+    """
+    Closes the persistent cluster, if running.
+
+    :return: None.
+    """
+
+    global CLIENT
+
+    if CLIENT is not None:
+        cluster = CLIENT.cluster
+        CLIENT.close()
+        cluster.close()
+        CLIENT = None
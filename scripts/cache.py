@@ -0,0 +1,237 @@
+# general imports
+import os
+import json
+import time
+import sqlite3
+
+# shapely imports
+from shapely.geometry import box, shape
+
+# globals
+STAC_CACHE = os.path.join('data', 'stac_cache.db')
+STAC_CACHE_TTL = 7 * 24 * 60 * 60  # seconds before a cached search is stale
+STAC_CACHE_MAX_ENTRIES = 500       # oldest accessed searches evicted beyond this
+STAC_CACHE_PAD = 0.05              # degrees added around bbox so neighbours hit
+
+
+def connect_to_cache(cache_path=None):
+    """
+    Connect to the local stac item cache, creating the
+    cache table if it does not yet exist. Uses plain
+    sqlite so it is safe outside of a qt session.
+
+    :param cache_path: Path to sqlite cache file.
+    :return: sqlite3 connection.
+    """
+
+    # use default path if none given
+    cache_path = cache_path or STAC_CACHE
+
+    # open (or create) the cache file
+    conn = sqlite3.connect(cache_path)
+
+    # create cache table if needed
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS STAC_CACHE (
+            id INTEGER NOT NULL,
+            collection TEXT NOT NULL,
+            date_range TEXT NOT NULL,
+            min_x REAL NOT NULL,
+            min_y REAL NOT NULL,
+            max_x REAL NOT NULL,
+            max_y REAL NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL,
+            items TEXT NOT NULL,
+            PRIMARY KEY (id)
+        )
+        """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS STAC_CACHE_KEY
+        ON STAC_CACHE (collection, date_range)
+        """)
+
+    return conn
+
+
+def pad_bbox(bbox, pad=None):
+    """
+    Pads a bbox by a number of degrees on each side so a
+    cached search also covers neighbouring sites.
+
+    :param bbox: List of min x, min y, max x, max y.
+    :param pad: Degrees to pad each side by.
+    :return: Padded bbox list.
+    """
+
+    # use default pad if none given
+    pad = STAC_CACHE_PAD if pad is None else pad
+
+    return [bbox[0] - pad, bbox[1] - pad, bbox[2] + pad, bbox[3] + pad]
+
+
+def filter_items(items, bbox):
+    """
+    Filters a list of stac item dicts down to those whose
+    footprint intersects the bbox.
+
+    :param items: List of stac item dicts.
+    :param bbox: List of min x, min y, max x, max y.
+    :return: List of stac item dicts.
+    """
+
+    # build bbox polygon once
+    bbox = box(*bbox)
+
+    # keep items without geometry, cannot rule them out
+    return [item for item in items
+            if item.get('geometry') is None or
+            shape(item['geometry']).intersects(bbox)]
+
+
+def filter_dates(items, date_range):
+    """
+    Filters a list of stac item dicts down to those dated
+    within a date range.
+
+    :param items: List of stac item dicts.
+    :param date_range: Date range string (YYYY-MM-DD/YYYY-MM-DD).
+    :return: List of stac item dicts.
+    """
+
+    from_date, to_date = date_range.split('/')
+
+    # keep items without a datetime, cannot rule them out
+    return [item for item in items
+            if not item.get('properties', {}).get('datetime') or
+            from_date <= item['properties']['datetime'][:10] <= to_date]
+
+
+def get_cached_items(collection, date_range, bbox, conn=None):
+    """
+    Looks for a fresh cached search of the same collection
+    whose date range and bbox contain the requested ones.
+    If found, the cached items within the requested dates
+    and intersecting the requested bbox are returned, else
+    None.
+
+    :param collection: Name of stac collection.
+    :param date_range: Date range string (YYYY-MM-DD/YYYY-MM-DD).
+    :param bbox: List of min x, min y, max x, max y.
+    :param conn: Existing sqlite3 connection, optional.
+    :return: List of stac item dicts or None if cache miss.
+    """
+
+    from_date, to_date = date_range.split('/')
+
+    # open cache if no connection given
+    close = conn is None
+    conn = conn or connect_to_cache()
+
+    try:
+        # find smallest fresh search that fully contains dates and bbox
+        row = conn.execute("""
+            SELECT id, items FROM STAC_CACHE
+            WHERE collection = ? AND created > ?
+            AND substr(date_range, 1, instr(date_range, '/') - 1) <= ?
+            AND substr(date_range, instr(date_range, '/') + 1) >= ?
+            AND min_x <= ? AND min_y <= ? AND max_x >= ? AND max_y >= ?
+            ORDER BY (max_x - min_x) * (max_y - min_y) ASC
+            LIMIT 1
+            """, (collection, time.time() - STAC_CACHE_TTL, from_date, to_date,
+                  bbox[0], bbox[1], bbox[2], bbox[3])).fetchone()
+
+        # cache miss
+        if row is None:
+            return None
+
+        # touch access time for lru eviction
+        with conn:
+            conn.execute('UPDATE STAC_CACHE SET accessed = ? WHERE id = ?',
+                         (time.time(), row[0]))
+
+        # unpack and subset to dates and bbox
+        items = filter_dates(filter_items(json.loads(row[1]), bbox), date_range)
+
+    finally:
+        if close:
+            conn.close()
+
+    return items
+
+
+def set_cached_items(collection, date_range, bbox, items, conn=None):
+    """
+    Stores a list of stac item dicts against a collection,
+    date range and bbox and evicts stale or excess searches.
+
+    :param collection: Name of stac collection.
+    :param date_range: Date range string (from/to).
+    :param bbox: List of min x, min y, max x, max y searched.
+    :param items: List of stac item dicts.
+    :param conn: Existing sqlite3 connection, optional.
+    :return: None.
+    """
+
+    # open cache if no connection given
+    close = conn is None
+    conn = conn or connect_to_cache()
+
+    try:
+        now = time.time()
+        with conn:
+            conn.execute("""
+                INSERT INTO STAC_CACHE
+                (collection, date_range, min_x, min_y, max_x, max_y,
+                created, accessed, items)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (collection, date_range, bbox[0], bbox[1], bbox[2], bbox[3],
+                      now, now, json.dumps(items)))
+
+        # clean up
+        evict_cached_items(conn=conn)
+
+    finally:
+        if close:
+            conn.close()
+
+
+def evict_cached_items(conn=None, ttl=None, max_entries=None):
+    """
+    Removes cached searches older than the ttl and then the
+    least recently accessed searches above max entries.
+
+    :param conn: Existing sqlite3 connection, optional.
+    :param ttl: Seconds before a cached search is stale.
+    :param max_entries: Maximum number of searches retained.
+    :return: Number of searches removed.
+    """
+
+    # use defaults if none given
+    ttl = STAC_CACHE_TTL if ttl is None else ttl
+    max_entries = STAC_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+
+    # open cache if no connection given
+    close = conn is None
+    conn = conn or connect_to_cache()
+
+    try:
+        with conn:
+            # drop anything stale
+            removed = conn.execute('DELETE FROM STAC_CACHE WHERE created <= ?',
+                                   (time.time() - ttl,)).rowcount
+
+            # drop least recently accessed beyond max
+            removed += conn.execute("""
+                DELETE FROM STAC_CACHE WHERE id NOT IN (
+                    SELECT id FROM STAC_CACHE
+                    ORDER BY accessed DESC
+                    LIMIT ?
+                )
+                """, (max_entries,)).rowcount
+
+    finally:
+        if close:
+            conn.close()
+
+    return removed
@@ -0,0 +1,273 @@
+# general imports
+import io
+import warnings
+import numpy as np
+import xarray as xr
+
+# globals
+EWMACD_HARMONICS = 2  # num of sine, cosine pairs in seasonal fit
+EWMACD_TRAIN_YEARS = 5  # years from start of record the seasonal fit is trained on
+EWMACD_MIN_TRAIN = 10  # min valid training scenes per pixel, fewer gives no result
+EWMACD_TRAIN_LIMIT = 1.5  # training scenes beyond this many std devs are dropped before refit
+EWMACD_OUTLIER_LIMIT = 20  # scenes beyond this many std devs are ignored when monitoring
+EWMACD_LAMBDA = 0.3  # ewma weight of newest scene
+EWMACD_LIMIT = 3  # control limit width in std devs of the ewma
+EWMACD_PERSISTENCE = 3  # consecutive exceedances before a pixel is flagged as changed
+EWMACD_CHUNK = 256  # pixels per y and x chunk mapped over by dask
+DAYS_PER_YEAR = 365.25
+
+
+def get_harmonics(times):
+    """
+    Builds the seasonal design matrix of an intercept and
+    sine, cosine pairs of day of year.
+
+    :param times: 1d datetime64 array.
+    :return: 2d numpy array (time, 1 + 2 * EWMACD_HARMONICS).
+    """
+
+    times = np.asarray(times, dtype='datetime64[D]')
+    years = times.astype('datetime64[Y]')
+    angle = 2 * np.pi * (times - years).astype('float64') / DAYS_PER_YEAR
+
+    columns = [np.ones(len(times))]
+    for k in range(1, EWMACD_HARMONICS + 1):
+        columns += [np.cos(k * angle), np.sin(k * angle)]
+
+    return np.stack(columns, axis=-1)
+
+
+def fit_harmonics(values, design, weights):
+    """
+    Weighted least squares fit of the seasonal design to
+    many series at once.
+
+    :param values: 2d numpy array (pixels, time), nan filled with 0.
+    :param design: 2d numpy array (time, terms), see get_harmonics.
+    :param weights: 2d numpy array (pixels, time) of 0 or 1.
+    :return: 2d numpy array (pixels, time) of fitted values.
+    """
+
+    # normal equations per pixel as two matrix products, ridge keeps empty pixels solvable
+    terms = design.shape[1]
+    outer = (design[:, :, np.newaxis] * design[:, np.newaxis, :]).reshape(len(design), -1)
+    xtwx = (weights @ outer).reshape(-1, terms, terms) + np.eye(terms) * 1e-9
+    xtwy = (weights * values) @ design
+    coefs = np.linalg.solve(xtwx.astype('float64'), xtwy[..., np.newaxis].astype('float64'))[..., 0]
+
+    return coefs.astype(values.dtype) @ design.T
+
+
+def ewmacd_array(values, times):
+    """
+    Exponentially weighted moving average change detection
+    (EWMACD) for many pixels at once. A seasonal harmonic fit
+    is trained per pixel on the first EWMACD_TRAIN_YEARS of
+    the record, refit once without training scenes beyond
+    EWMACD_TRAIN_LIMIT std devs. Residuals of every scene are
+    standardised by the training std dev and smoothed by an
+    ewma, which is compared against its control limits. The
+    loop runs once over time, vectorised over pixels.
+
+    Nan scenes are skipped, carrying the ewma and run count
+    forward. Pixels with fewer than EWMACD_MIN_TRAIN valid
+    training scenes are nan throughout.
+
+    :param values: Numpy array (..., time) of index values.
+    :param times: 1d datetime64 array of scene dates.
+    :return: Tuple of float32 arrays (..., time) of ewma in std
+    devs and signed count of consecutive exceedances, positive
+    above the upper limit and negative below the lower.
+    """
+
+    shape = values.shape
+    values = values.reshape(-1, shape[-1]).astype('float32')
+    times = np.asarray(times, dtype='datetime64[D]')
+
+    if values.size == 0:
+        return values.reshape(shape), values.reshape(shape)
+
+    # train on start of record
+    valid = np.isfinite(values)
+    filled = np.where(valid, values, 0).astype('float32')
+    design = get_harmonics(times).astype('float32')
+    train = times < times.min() + np.timedelta64(int(EWMACD_TRAIN_YEARS * DAYS_PER_YEAR), 'D')
+    weights = (valid & train).astype('float32')
+
+    # fit, drop poorly fit training scenes, refit
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for limit in [EWMACD_TRAIN_LIMIT, None]:
+            fitted = fit_harmonics(filled, design, weights)
+            resids = filled - fitted
+            sigma = np.sqrt((weights * resids ** 2).sum(axis=1, keepdims=True) /
+                            weights.sum(axis=1, keepdims=True))
+            if limit is not None:
+                weights[np.abs(resids) > limit * sigma] = 0
+
+        # standardised residuals, ignoring gross outliers
+        sigma[(weights.sum(axis=1) < EWMACD_MIN_TRAIN) | (sigma[:, 0] == 0), :] = np.nan
+        scores = (values - fitted) / sigma
+        scores[np.abs(scores) > EWMACD_OUTLIER_LIMIT] = np.nan
+
+    # control limit widens to its asymptote as scenes accrue, by num of scenes seen
+    steps = np.arange(values.shape[1] + 1)
+    limits = EWMACD_LIMIT * np.sqrt(EWMACD_LAMBDA / (2 - EWMACD_LAMBDA) *
+                                    (1 - (1 - EWMACD_LAMBDA) ** (2 * steps))).astype('float32')
+
+    # run ewma and count consecutive exceedances through time, time major for contiguous steps
+    scores = np.ascontiguousarray(scores.T)
+    observed = np.isfinite(scores)
+    scores[~observed] = 0
+    obs_steps = observed.astype('float32')
+    z, run = np.zeros(len(values), dtype='float32'), np.zeros(len(values), dtype='float32')
+    n = np.zeros(len(values), dtype='int64')
+    ewma, conseqs = np.empty_like(scores), np.empty_like(scores)
+    for t in range(len(scores)):
+        obs = obs_steps[t]
+        n += observed[t]
+        z += obs * EWMACD_LAMBDA * (scores[t] - z)
+        exceed = np.sign(z) * (np.abs(z) > limits[n])
+
+        # extend run if same direction, else restart it
+        same = (exceed != 0) & (np.sign(run) == exceed)
+        run += obs * (exceed + run * same - run)
+
+        ewma[t], conseqs[t] = z, run
+
+    # nan until a pixel's first scene and where training failed
+    unseen = np.cumsum(observed, axis=0) == 0
+    unseen |= ~np.isfinite(sigma[:, 0])
+    ewma[unseen], conseqs[unseen] = np.nan, np.nan
+    ewma, conseqs = ewma.T, conseqs.T
+
+    return ewma.reshape(shape), conseqs.reshape(shape)
+
+
+def detect_change(da):
+    """
+    Runs EWMACD (see ewmacd_array) per pixel of an index
+    cube, mapped over dask chunks of EWMACD_CHUNK pixels
+    with the whole record per chunk. Compute with
+    backend.get_compute_kwargs to spread chunks across cores.
+
+    :param da: DataArray (time, y, x) of index values.
+    :return: Lazy dataset (time, y, x) of ewma and conseqs.
+    """
+
+    # whole time series per chunk, split spatially
+    da = da.chunk({'time': -1, 'y': EWMACD_CHUNK, 'x': EWMACD_CHUNK})
+
+    ewma, conseqs = xr.apply_ufunc(ewmacd_array, da,
+                                   kwargs={'times': da['time'].values},
+                                   input_core_dims=[['time']],
+                                   output_core_dims=[['time'], ['time']],
+                                   dask='parallelized',
+                                   output_dtypes=['float32', 'float32'])
+
+    ds = xr.Dataset({'ewma': ewma, 'conseqs': conseqs})
+
+    return ds.transpose('time', 'y', 'x')
+
+
+def summarise_pixels(ds):
+    """
+    Gets each pixel's change state at the latest scene.
+
+    :param ds: Dataset (time, y, x) of ewma and conseqs, see detect_change.
+    :return: Dataset (y, x) of magnitude, direction and conseqs.
+    """
+
+    last = ds.isel(time=-1)
+    flagged = np.abs(last['conseqs']) >= EWMACD_PERSISTENCE
+
+    return xr.Dataset({'magnitude': np.abs(last['ewma']),
+                       'direction': xr.where(flagged, np.sign(last['conseqs']), 0).where(last['ewma'].notnull()),
+                       'conseqs': np.abs(last['conseqs'])})
+
+
+def reduce_change(ds, mask, crs=None):
+    """
+    Reduces a site's per pixel change (see detect_change) to
+    a site series and summary. The series is the mean ewma
+    of in-mask pixels per scene. Pixels with at least
+    EWMACD_PERSISTENCE consecutive exceedances at the latest
+    scene are flagged, the site's direction is that of most
+    flagged pixels, its magnitude the mean latest ewma and
+    its conseqs the median run of flagged pixels in its
+    direction.
+
+    :param ds: Computed dataset (time, y, x) of ewma and conseqs.
+    :param mask: 2d boolean numpy array (y, x) on ds grid.
+    :param crs: Crs string of grid, kept with pixel maps.
+    :return: Dict of dates, ewma, magnitude, direction, conseqs,
+    changed (pct of pixels flagged) and pixels (dict of grid x,
+    y, crs and 2d magnitude, direction and conseqs lists).
+    """
+
+    pixels = summarise_pixels(ds).where(mask)
+    site_ewma = ds['ewma'].values[:, mask]
+
+    # site series, nan if no pixel had a result
+    with np.errstate(invalid='ignore'):
+        counts = np.isfinite(site_ewma).sum(axis=1)
+        ewma = np.where(counts > 0, np.nansum(site_ewma, axis=1) / np.maximum(counts, 1), np.nan)
+
+    # flagged pixels decide direction
+    directions = pixels['direction'].values[mask]
+    runs = pixels['conseqs'].values[mask]
+    ups, downs = np.sum(directions > 0), np.sum(directions < 0)
+    direction = int(np.sign(ups - downs))
+    flagged = runs[directions == direction] if direction != 0 else []
+    last = ewma[np.isfinite(ewma)]
+
+    return {'dates': [str(dt) for dt in ds['time'].values.astype('datetime64[D]')],
+            'ewma': [None if np.isnan(v) else float(v) for v in ewma],
+            'magnitude': float(abs(last[-1])) if len(last) else None,
+            'direction': direction,
+            'conseqs': int(np.median(flagged)) if len(flagged) else 0,
+            'changed': round(float(ups + downs) / max(mask.sum(), 1) * 100, 2),
+            'pixels': {'crs': None if crs is None else str(crs),
+                       'x': ds['x'].values.tolist(),
+                       'y': ds['y'].values.tolist(),
+                       'magnitude': pixels['magnitude'].values.tolist(),
+                       'direction': pixels['direction'].values.tolist(),
+                       'conseqs': pixels['conseqs'].values.tolist()}}
+
+
+def encode_pixels(pixels):
+    """
+    Encodes a site's pixel maps (see reduce_change) as
+    compressed npz bytes for storage as a blob.
+
+    :param pixels: Dict of crs, x, y and 2d magnitude, direction and conseqs.
+    :return: Bytes, or None if no pixels.
+    """
+
+    if pixels is None:
+        return None
+
+    arrays = {key: np.asarray(value, dtype='float32') for key, value in pixels.items() if key != 'crs'}
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, crs=np.array(pixels.get('crs') or ''), **arrays)
+
+    return buffer.getvalue()
+
+
+def decode_pixels(blob):
+    """
+    Decodes pixel maps stored by encode_pixels.
+
+    :param blob: Bytes or None.
+    :return: Dict of crs, x, y and 2d magnitude, direction and conseqs arrays, or None.
+    """
+
+    if blob is None or len(blob) == 0:
+        return None
+
+    with np.load(io.BytesIO(bytes(blob))) as arrays:
+        pixels = {key: arrays[key] for key in arrays.files}
+
+    pixels['crs'] = str(pixels['crs']) or None
+
+    return pixels
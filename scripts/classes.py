@@ -3,11 +3,12 @@
 # import sys
 # import time
 # import uuid
-import json
+import os
+from operator import attrgetter
 # import numpy as np
 
 # pyside imports
-from PySide2.QtCore import Qt, QAbstractListModel, QModelIndex, Slot
+from PySide2.QtCore import Qt, QAbstractListModel, QModelIndex, QSortFilterProxyModel, Signal, Slot
 
 # Qt, Slot, QAbstractListModel, QModelIndex, QThreadPool, QRunnable, QPoint, QObject
 # from PySide2.QtGui import QGuiApplication
@@ -21,52 +22,136 @@ from PySide2.QtCore import Qt, QAbstractListModel, QModelIndex, Slot
 # external scripts imports
 # from scripts import analyses
 # from scripts import data
-# from scripts import spatial
+from scripts import spatial
+from scripts import store
 
 # globals
 DATASTORE = r"C:\Users\Lewis\PycharmProjects\monitoria\data\data.json"  # r"..\data\data.json"
+SITESTORE = os.path.splitext(DATASTORE)[0] + '.jsonl'  # journal replacing whole-file DATASTORE
+
+# model roles, in role order from Qt.UserRole
+ROLES = ('id', 'code', 'dates', 'veg_raw', 'veg_smooth', 'geometry', 'selected')
+ROLE_NAMES = {Qt.UserRole + i: name.encode() for i, name in enumerate(ROLES)}
+ROLE_GETTERS = {Qt.UserRole + i: attrgetter(name) for i, name in enumerate(ROLES)}
+ROLE_IDS = {name: Qt.UserRole + i for i, name in enumerate(ROLES)}
+SELECTED_ROLE = ROLE_IDS['selected']
+GEOMETRY_ROLE = ROLE_IDS['geometry']
+
+
+class Site:
+    """
+    Compact record for one site (model row), one slot per
+    role. Supports dict-style get, update and item access so
+    rows read the same as the plain dicts they replace.
+    """
+    __slots__ = ROLES
+
+    def __init__(self, id=None, code=None, dates=None, veg_raw=None,
+                 veg_smooth=None, geometry=None, selected=False):
+        self.id = id
+        self.code = code
+        self.dates = dates
+        self.veg_raw = veg_raw
+        self.veg_smooth = veg_smooth
+        self.geometry = geometry
+        self.selected = selected
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**{key: values.get(key) for key in ROLES if key in values})
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in ROLES}
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def update(self, values):
+        for key, value in values.items():
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
 
 
 class SitesModel(QAbstractListModel):
 
+    # emitted when the set of sites in the map viewport changes
+    viewportChanged = Signal()
+
     def __init__(self, parent=None):
         super(SitesModel, self).__init__(parent)
         self.selected_index = -1
         self.sites = []
+        self.store = store.SiteStore(path=SITESTORE, legacy_path=DATASTORE)
+        self.spatial_index = spatial.SiteIndex()
+        self.visible_ids = None
+        self.zoom = None
         self.load()
 
     def rowCount(self, parent=QModelIndex()):
         return len(self.sites)
 
     def roleNames(self):
-        roles = {
-            hash(Qt.UserRole): 'id'.encode(),
-            hash(Qt.UserRole + 1): 'code'.encode(),
-            hash(Qt.UserRole + 2): 'dates'.encode(),
-            hash(Qt.UserRole + 3): 'veg_raw'.encode(),
-            hash(Qt.UserRole + 4): 'veg_smooth'.encode(),
-            hash(Qt.UserRole + 5): 'geometry'.encode(),
-            hash(Qt.UserRole + 6): 'selected'.encode(),
-        }
-        return roles
+        return ROLE_NAMES
 
     def data(self, index=QModelIndex(), role=Qt.DisplayRole):
-        if index.isValid():
+        getter = ROLE_GETTERS.get(role)
+        if index.isValid() and getter is not None:
             site = self.sites[index.row()]
-            return site.get(list(site)[role - Qt.UserRole])
 
-    def load(self):
+            # draw geometry simplified for current zoom
+            if role == GEOMETRY_ROLE and self.zoom is not None:
+                return self.spatial_index.simplify(site.id, self.zoom) or site.geometry
+
+            return getter(site)
+
+    def load(self, series=False):
+        """
+        Loads sites from the journal. Time series are skipped
+        unless requested and can be read later via load_series.
+
+        :param series: Also parse each site's time series.
+        :return: None.
+        """
         try:
-            with open(DATASTORE, 'r') as f:
-                self.sites = json.load(f)
+            sites = self.store.load(series=series)
+            self.sites = [Site.from_dict(site) for site in sites.values()]
         except Exception as e:
             print(e)
             pass
 
-    def save(self):
+        # index all site polygons
+        self.spatial_index = spatial.SiteIndex()
+        for site in self.sites:
+            self.spatial_index.insert(site.id, site.geometry or [])
+
+    def load_series(self, index):
+        """
+        Reads a site's time series from the journal on demand
+        if it was skipped on load.
+
+        :param index: Row of site.
+        :return: None.
+        """
+        site = self.sites[index]
+        if site.get('dates') is None:
+            series = self.store.get_series(site['id']) or {}
+            site.update({key: value for key, value in series.items() if key in ROLES})
+
+    def save(self, index=None):
+        """
+        Appends a site's current state to the journal, or
+        compacts the whole journal if no row is given.
+
+        :param index: Row of changed site, optional.
+        :return: None.
+        """
         try:
-            with open(DATASTORE, 'w') as f:
-                json.dump(self.sites, f)
+            if index is None:
+                self.store.compact()
+            else:
+                self.store.put(self.sites[index].to_dict())
         except Exception as e:
             print(e)
             pass
@@ -78,24 +163,22 @@ class SitesModel(QAbstractListModel):
         vertices = [{'latitude': v.latitude(), 'longitude': v.longitude()} for v in vertices]
 
         # prepare row item
-        row = {'id': None,
-               'code': None,
-               'dates': None,
-               'veg_raw': None,
-               'veg_smooth': None,
-               'geometry': vertices,
-               'selected': False}
+        row = Site(id=self.store.next_id(), geometry=vertices)
 
         # perform safe insert
         self.beginInsertRows(QModelIndex(), self.rowCount(), self.rowCount())
         self.sites.insert(self.rowCount(), row)
         self.endInsertRows()
 
-        # save json
-        self.save()
+        # append new site to journal and index
+        self.save(self.rowCount() - 1)
+        self.spatial_index.insert(row.id, vertices)
+        if self.visible_ids is not None:
+            self.visible_ids.add(row.id)
+            self.viewportChanged.emit()
 
-        # reset selected index
-        self.selected_index = -1
+        # reset selection
+        self.deselectAreas()
 
     @Slot(int)
     def deleteArea(self, index):
@@ -105,43 +188,128 @@ class SitesModel(QAbstractListModel):
 
         # perform safe delete
         self.beginRemoveRows(QModelIndex(), index, index)
-        self.sites.remove(self.sites[index])
+        site = self.sites.pop(index)
         self.endRemoveRows()
 
-        # save json
-        self.save()
-
-        # reset selected index
-        self.selected_index = -1
+        # append delete to journal, drop from index
+        try:
+            self.store.delete(site.id)
+        except Exception as e:
+            print(e)
+        self.spatial_index.delete(site.id)
+
+        # reset selection, keep tracking if selected row shifted up
+        if index == self.selected_index:
+            self.selected_index = -1
+        elif index < self.selected_index:
+            self.selected_index -= 1
+
+    @Slot(float, float, float, float, float)
+    def setViewport(self, min_x, min_y, max_x, max_y, zoom):
+        """
+        Sets the visible map rectangle and zoom level. Only sites
+        inside the rectangle pass the viewport proxy model, and
+        geometry is served simplified for the zoom level.
+
+        :param min_x: West longitude.
+        :param min_y: South latitude.
+        :param max_x: East longitude.
+        :param max_y: North latitude.
+        :param zoom: Map zoom level.
+        :return: None.
+        """
+
+        # redraw geometry only when whole zoom level changes
+        zoom_changed = self.zoom is None or int(zoom) != int(self.zoom)
+        self.zoom = zoom
+
+        # update visible sites
+        visible_ids = self.spatial_index.query_bbox([min_x, min_y, max_x, max_y])
+        if visible_ids != self.visible_ids:
+            self.visible_ids = visible_ids
+            self.viewportChanged.emit()
+
+        if zoom_changed and self.rowCount() > 0:
+            self.dataChanged.emit(self.index(0), self.index(self.rowCount() - 1), [GEOMETRY_ROLE])
+
+    @Slot(float, float, result=int)
+    def pickArea(self, x, y):
+        """
+        Selects the site containing a clicked map coordinate,
+        or deselects all if none does.
+
+        :param x: Longitude.
+        :param y: Latitude.
+        :return: Row of picked site or -1.
+        """
+
+        id = self.spatial_index.query_point(x, y)
+        rows = [i for i, site in enumerate(self.sites) if site.id == id] if id is not None else []
+
+        if len(rows) == 0:
+            self.deselectAreas()
+            return -1
+
+        self.selectArea(rows[0])
+        return rows[0]
 
     @Slot(int)
     def selectArea(self, index):
 
-        # iter rows and select clicked polygon
-        for i in range(self.rowCount()):
-            selected = True if i == index else False
-            self.sites[i].update({'selected': selected})
-            self.dataChanged.emit(self.index(i), self.index(i), self.roleNames())
+        # deselect previous polygon, select clicked polygon
+        self.deselectAreas()
+        self.set_selected(index, True)
 
-        # reset selected index
+        # track selected index
         self.selected_index = index
 
     @Slot()
     def deselectAreas(self):
 
-        # iter rows and deselect all polygons
-        for i in range(self.rowCount()):
-            self.sites[i].update({'selected': False})
-            self.dataChanged.emit(self.index(i), self.index(i), self.roleNames())
+        # only previous selection needs repainting
+        self.set_selected(self.selected_index, False)
 
         # reset selected index
         self.selected_index = -1
 
+    def set_selected(self, index, selected):
+        """
+        Sets a row's selected flag and notifies views of only
+        that row and role.
+
+        :param index: Row to change, ignored if out of range.
+        :param selected: New selected flag.
+        :return: None.
+        """
+        if 0 <= index < self.rowCount():
+            self.sites[index].selected = selected
+            self.dataChanged.emit(self.index(index), self.index(index), [SELECTED_ROLE])
+
     @Slot(str)
     def log(self, msg):
         print(msg)
 
 
+class SitesViewportModel(QSortFilterProxyModel):
+    """
+    Proxy over SitesModel passing only sites inside the map
+    viewport (see SitesModel.setViewport), so map views only
+    create delegates for visible polygons.
+    """
+
+    def __init__(self, source, parent=None):
+        super(SitesViewportModel, self).__init__(parent)
+        self.setSourceModel(source)
+        source.viewportChanged.connect(self.invalidateFilter)
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        source = self.sourceModel()
+        if source.visible_ids is None:
+            return True
+
+        return source.sites[source_row].id in source.visible_ids
+
+
 if __name__ == "__main__":
     # model = SitesModel()
 
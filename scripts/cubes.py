@@ -0,0 +1,169 @@
+# general imports
+import os
+import json
+import shutil
+import hashlib
+import xarray as xr
+
+# optional zarr store, cube caching is skipped without it
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+# globals
+CUBE_CACHE = os.path.join('data', 'cubes')
+CUBE_CACHE_ENABLED = True
+CUBE_CACHE_MAX_BYTES = 5 * 1024 ** 3  # least recently used cubes evicted beyond this
+
+
+def is_enabled():
+    """
+    Checks cube caching is on and zarr is installed.
+
+    :return: Bool.
+    """
+
+    return CUBE_CACHE_ENABLED and zarr is not None
+
+
+def get_cube_key(geometry, crs, resolution, index_names):
+    """
+    Gets the key of a site's pixel cube, a hash of its
+    polygon, load grid and indices. Any change to these
+    gives a new cube.
+
+    :param geometry: List of latitude, longitude dicts.
+    :param crs: Crs string of load grid.
+    :param resolution: Resolution of load grid in crs units.
+    :param index_names: List of index names in cube.
+    :return: String key.
+    """
+
+    coords = [[round(c.get('longitude'), 9), round(c.get('latitude'), 9)] for c in geometry]
+    raw = json.dumps([coords, str(crs).upper(), round(resolution, 12), sorted(index_names)])
+
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def get_cube_path(key, cache_dir=None):
+    return os.path.join(cache_dir or CUBE_CACHE, '{}.zarr'.format(key))
+
+
+def read_cube(key, cache_dir=None):
+    """
+    Opens a cached cube lazily, marking it as recently used.
+    The dates the cube was checked over are held in its
+    checked_from and checked_to attributes, and the ids of
+    every item checked into it in its item_ids attribute.
+
+    :param key: Cube key, see get_cube_key.
+    :param cache_dir: Cube cache folder, optional.
+    :return: Dataset, or None if not cached.
+    """
+
+    path = get_cube_path(key, cache_dir)
+    if not is_enabled() or not os.path.exists(path):
+        return None
+
+    try:
+        ds = xr.open_zarr(path)
+    except Exception as e:
+        print('Discarding unreadable cube: {}'.format(e))
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+
+    # touch for lru eviction
+    os.utime(path)
+
+    return ds
+
+
+def write_cube(key, ds, checked_from, checked_to, item_ids, append=False, cache_dir=None):
+    """
+    Writes a loaded cube to the cache, or appends new time
+    slices to a cached cube, then evicts old cubes if the
+    cache is over size. Appended slices may be dated before
+    existing ones, e.g. late published scenes, so readers
+    should sort by time.
+
+    :param key: Cube key, see get_cube_key.
+    :param ds: Loaded dataset (time, y, x), may have no times if appending.
+    :param checked_from: Start date string (YYYY-MM-DD) scenes were checked from.
+    :param checked_to: End date string (YYYY-MM-DD) scenes were checked to.
+    :param item_ids: List of ids of items checked, valid or not, added to any cached.
+    :param append: Append along time to the cached cube.
+    :param cache_dir: Cube cache folder, optional.
+    :return: None.
+    """
+
+    if not is_enabled():
+        return
+
+    path = get_cube_path(key, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # one scene per chunk so appends never rewrite old chunks
+    ds = ds.drop_vars('spatial_ref', errors='ignore').chunk({'time': 1, 'y': -1, 'x': -1})
+    ds.attrs.update({'checked_from': checked_from, 'checked_to': checked_to, 'item_ids': sorted(item_ids)})
+    for var in ds.variables:
+        ds[var].encoding = {}
+
+    if append:
+        if len(ds['time']) > 0:
+            ds.to_zarr(path, append_dim='time')
+
+        # keep attrs current even if nothing new
+        group = zarr.open_group(path, mode='r+')
+        group.attrs['checked_to'] = checked_to
+        group.attrs['item_ids'] = sorted(set(group.attrs.get('item_ids', [])) | set(item_ids))
+        zarr.consolidate_metadata(path)
+    else:
+        ds.to_zarr(path, mode='w')
+
+    evict_cubes(cache_dir=cache_dir)
+
+
+def get_size(path):
+    """
+    Gets total size of files under a folder in bytes.
+    """
+
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+
+    return size
+
+
+def evict_cubes(max_bytes=None, cache_dir=None):
+    """
+    Removes least recently used cubes until the cache is
+    within its size limit.
+
+    :param max_bytes: Max cache size, defaults to CUBE_CACHE_MAX_BYTES.
+    :param cache_dir: Cube cache folder, optional.
+    :return: None.
+    """
+
+    max_bytes = max_bytes or CUBE_CACHE_MAX_BYTES
+    cache_dir = cache_dir or CUBE_CACHE
+    if not os.path.exists(cache_dir):
+        return
+
+    # oldest used first
+    cubes = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.zarr')]
+    cubes = sorted(cubes, key=os.path.getmtime)
+    sizes = {path: get_size(path) for path in cubes}
+
+    total = sum(sizes.values())
+    for path in cubes[:-1]:
+        if total <= max_bytes:
+            break
+
+        # notify
+        print('Evicting cached cube {}.'.format(os.path.basename(path)))
+
+        shutil.rmtree(path, ignore_errors=True)
+        total -= sizes[path]
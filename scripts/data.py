@@ -1,28 +1,133 @@
+# general imports
+import uuid
+import threading
+from contextlib import contextmanager
+
 # pyside imports
+from PySide2.QtCore import QByteArray
 from PySide2.QtSql import QSqlDatabase, QSqlQuery
 
+# external scripts imports
+from scripts import series
+
 # globals
 DATABASE = r'.\data\monitoria.db'
+BUSY_TIMEOUT = 5000  # ms to wait on a locked db before failing
+
+# one connection and prepared query cache per thread
+_local = threading.local()
 
 
 def connect_to_db(connection_name=None):
     """
-    Connect to database, accepts custom connection name
-    for threading, if required.
+    Gets the long-lived connection for the calling thread,
+    opening it on first use. Qt connections may only be used
+    by the thread that created them, so each thread (e.g. a
+    QThreadPool worker) gets its own, kept open and reused.
+    Connections are opened in WAL mode so readers and a
+    writer on other threads do not block each other.
 
-    :param connection_name: Custom name of connection.
-    :return: QSqlDatabase file.
+    :param connection_name: Custom name of connection, optional.
+    :return: QSqlDatabase connection.
     """
 
-    # create db
-    db = QSqlDatabase.addDatabase('QSQLITE', connection_name)
-    db.setDatabaseName(DATABASE)
-
-    if db.open():
+    # reuse this thread's connection if open
+    db = getattr(_local, 'db', None)
+    if connection_name is None and db is not None and db.isOpen():
         return db
+
+    # else create, unique per thread as idents can be reused
+    name = connection_name or 'monitoria_{}'.format(uuid.uuid4().hex)
+    if QSqlDatabase.contains(name):
+        db = QSqlDatabase.database(name)
     else:
+        db = QSqlDatabase.addDatabase('QSQLITE', name)
+        db.setDatabaseName(DATABASE)
+        db.setConnectOptions('QSQLITE_BUSY_TIMEOUT={}'.format(BUSY_TIMEOUT))
+
+    if not db.isOpen() and not db.open():
         raise ValueError('Cannot initialise database.')
 
+    # wal lets workers read while another thread writes
+    query = QSqlQuery(db=db)
+    query.exec_('PRAGMA journal_mode=WAL')
+    query.exec_('PRAGMA synchronous=NORMAL')
+
+    # keep as this thread's connection
+    if connection_name is None:
+        _local.db = db
+        _local.queries = {}
+
+    return db
+
+
+def close_connection():
+    """
+    Closes and removes the calling thread's connection,
+    e.g. before a worker thread exits.
+
+    :return: None.
+    """
+
+    db = getattr(_local, 'db', None)
+    if db is None:
+        return
+
+    # release prepared queries before removing connection
+    name = db.connectionName()
+    _local.queries = {}
+    _local.db = None
+    db.close()
+    del db
+    QSqlDatabase.removeDatabase(name)
+
+
+def prepare_query(sql):
+    """
+    Gets a prepared query on the calling thread's connection,
+    preparing it only on first use so repeated statements skip
+    re-parsing. Bind values and exec_ as usual. Call finish
+    once a SELECT's rows are read, as a cached statement left
+    active keeps its read open on the connection, blocking
+    wal checkpoints and VACUUM.
+
+    :param sql: Sql statement with named placeholders.
+    :return: Prepared QSqlQuery.
+    """
+
+    db = connect_to_db()
+
+    # prepare once per thread
+    query = _local.queries.get(sql)
+    if query is None:
+        query = QSqlQuery(db=db)
+        if not query.prepare(sql):
+            raise ValueError('Cannot prepare query: {}'.format(query.lastError().text()))
+        _local.queries[sql] = query
+
+    return query
+
+
+@contextmanager
+def transaction():
+    """
+    Batches all statements on the calling thread's connection
+    inside the with block into one transaction, committed on
+    exit or rolled back on error.
+
+    :return: QSqlDatabase connection.
+    """
+
+    db = connect_to_db()
+    db.transaction()
+    try:
+        yield db
+    except Exception:
+        db.rollback()
+        raise
+    else:
+        db.commit()
+
 
 def create_monitoring_areas_table(db=None):
     """
@@ -33,9 +138,9 @@ def create_monitoring_areas_table(db=None):
         CREATE TABLE IF NOT EXISTS MONITORING_AREAS (
             id INTEGER NOT NULL,
             code TEXT,
-            dates TEXT,
-            veg_raw TEXT,
-            veg_smooth TEXT,
+            dates BLOB,
+            veg_raw BLOB,
+            veg_smooth BLOB,
             geometry TEXT NOT NULL,
             PRIMARY KEY (id)
         )
@@ -51,3 +156,134 @@ def create_monitoring_areas_table(db=None):
         print('Failed to create MONITORING_AREAS table.')
 
 
+def create_site_indices_table(db=None):
+    """
+    Check if SITE_INDICES table exists in db, else create one.
+    Holds a series per monitoring area per index other than
+    the veg_raw series in MONITORING_AREAS.
+    """
+
+    sql = """
+        CREATE TABLE IF NOT EXISTS SITE_INDICES (
+            id INTEGER NOT NULL,
+            idx TEXT NOT NULL,
+            dates BLOB,
+            veg_raw BLOB,
+            PRIMARY KEY (id, idx)
+        )
+        """
+
+    # ok if table exists, if not create it
+    if 'SITE_INDICES' in db.tables():
+        return
+
+    # if not, attempt to create it
+    query = QSqlQuery(db=db)
+    if not query.exec_(sql):
+        print('Failed to create SITE_INDICES table.')
+
+
+def create_site_change_table(db=None):
+    """
+    Check if SITE_CHANGE table exists in db, else create one.
+    Holds the latest ewmacd change results per monitoring
+    area, its ewma series, summary and encoded pixel maps.
+    """
+
+    sql = """
+        CREATE TABLE IF NOT EXISTS SITE_CHANGE (
+            id INTEGER NOT NULL,
+            dates BLOB,
+            ewma BLOB,
+            magnitude REAL,
+            direction INTEGER,
+            conseqs INTEGER,
+            changed REAL,
+            pixels BLOB,
+            PRIMARY KEY (id)
+        )
+        """
+
+    # ok if table exists, if not create it
+    if 'SITE_CHANGE' in db.tables():
+        return
+
+    # if not, attempt to create it
+    query = QSqlQuery(db=db)
+    if not query.exec_(sql):
+        print('Failed to create SITE_CHANGE table.')
+
+
+def to_blob(value):
+    """
+    Wraps bytes for binding to a blob column.
+
+    :param value: Bytes or None.
+    :return: QByteArray or None.
+    """
+
+    return QByteArray(value) if value is not None else None
+
+
+def from_blob(value):
+    """
+    Unwraps a queried blob column value to bytes. Legacy
+    text values and nulls are returned as is.
+
+    :param value: Value from QSqlQuery.value.
+    :return: Bytes, str or None.
+    """
+
+    return value.data() if isinstance(value, QByteArray) else value
+
+
+def migrate_monitoring_areas_table(db=None):
+    """
+    Converts any legacy comma-joined text series in the
+    MONITORING_AREAS table into binary blobs (int32 day
+    numbers and float32 values, see series.py), in a single
+    transaction. Rows already holding blobs are skipped.
+    """
+
+    # find legacy text rows
+    query = QSqlQuery(db=db)
+    query.exec_("SELECT id, dates, veg_raw, veg_smooth FROM MONITORING_AREAS "
+                "WHERE typeof(dates) = 'text' OR typeof(veg_raw) = 'text' "
+                "OR typeof(veg_smooth) = 'text'")
+
+    rows = []
+    while query.next():
+        rows.append((query.value(0),
+                     series.encode_dates(series.decode_dates(query.value(1) or None)),
+                     series.encode_values(series.decode_values(query.value(2) or None)),
+                     series.encode_values(series.decode_values(query.value(3) or None))))
+    query.finish()
+
+    # nothing to migrate
+    if len(rows) == 0:
+        return
+
+    # notify
+    print('Migrating {} monitoring areas to binary series.'.format(len(rows)))
+
+    # rewrite all rows at once
+    db.transaction()
+    update = QSqlQuery(db=db)
+    update.prepare('UPDATE MONITORING_AREAS '
+                   'SET dates = :dates, veg_raw = :veg_raw, veg_smooth = :veg_smooth '
+                   'WHERE id = :id')
+    for id, dates, veg_raw, veg_smooth in rows:
+        update.bindValue(':id', id)
+        update.bindValue(':dates', to_blob(dates))
+        update.bindValue(':veg_raw', to_blob(veg_raw))
+        update.bindValue(':veg_smooth', to_blob(veg_smooth))
+        if not update.exec_():
+            db.rollback()
+            print('Failed to migrate MONITORING_AREAS table.')
+            return
+
+    db.commit()
+    update.finish()
+
+    # reclaim space from old text, needs no statements in progress
+    QSqlQuery(db=db).exec_('VACUUM')
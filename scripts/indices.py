@@ -0,0 +1,90 @@
+# globals
+SCALE = 10000  # dea ard surface reflectance scale factor
+SAVI_L = 0.5   # savi soil brightness correction
+
+
+def ndvi(ds):
+    """
+    Normalised difference vegetation index.
+    """
+    return (ds['nir'] - ds['red']) / (ds['nir'] + ds['red'])
+
+
+def savi(ds):
+    """
+    Soil adjusted vegetation index, needs reflectance in
+    0 to 1 so bands are descaled first.
+    """
+    nir, red = ds['nir'] / SCALE, ds['red'] / SCALE
+    return (nir - red) / (nir + red + SAVI_L) * (1 + SAVI_L)
+
+
+def ndmi(ds):
+    """
+    Normalised difference moisture index.
+    """
+    return (ds['nir'] - ds['swir_1']) / (ds['nir'] + ds['swir_1'])
+
+
+def mavi(ds):
+    """
+    Moisture adjusted vegetation index.
+    """
+    return (ds['nir'] - ds['red']) / (ds['nir'] + ds['red'] + ds['swir_1'])
+
+
+# vegetation indices, each with the bands it reads and its formula
+INDICES = {
+    'NDVI': {'bands': ['red', 'nir'], 'formula': ndvi},
+    'SAVI': {'bands': ['red', 'nir'], 'formula': savi},
+    'NDMI': {'bands': ['nir', 'swir_1'], 'formula': ndmi},
+    'MAVI': {'bands': ['red', 'nir', 'swir_1'], 'formula': mavi},
+}
+
+
+def get_index(index):
+    """
+    Gets a registered index, case insensitive.
+
+    :param index: Index name, e.g. NDVI.
+    :return: Dict of bands and formula.
+    """
+
+    if index.upper() not in INDICES:
+        raise ValueError('Index {} not supported, use one of {}.'.format(index, ', '.join(INDICES)))
+
+    return INDICES[index.upper()]
+
+
+def get_bands(indices):
+    """
+    Gets the bands needed by one or more indices, each band
+    once and in order of first use.
+
+    :param indices: Index name or list of index names.
+    :return: List of band names.
+    """
+
+    indices = [indices] if isinstance(indices, str) else indices
+
+    bands = []
+    for index in indices:
+        for band in get_index(index)['bands']:
+            if band not in bands:
+                bands.append(band)
+
+    return bands
+
+
+def get_var(index):
+    """
+    Gets the dataset variable name an index is stored in.
+
+    :param index: Index name, e.g. NDVI.
+    :return: Variable name, e.g. ndvi.
+    """
+
+    # validate first
+    get_index(index)
+
+    return index.lower()
@@ -0,0 +1,160 @@
+# general imports
+import os
+import json
+import time
+import logging
+import tracemalloc
+import contextlib
+
+# globals
+SPAN_LOG = os.path.join('data', 'spans.jsonl')
+LOGGER = logging.getLogger('monitoria.spans')
+TRACE_MEMORY = False  # tracemalloc analyses for per stage peaks, slows every allocation
+
+
+def start_tracing():
+    """
+    Starts tracemalloc, if not already, so spans record the
+    peak of their own stage (see get_peak_mb). Opt in only
+    (see TRACE_MEMORY), as tracing slows every allocation.
+    Tracing and its peak are process wide, so peaks are only
+    per stage when one analysis runs at a time, concurrent
+    analyses reset each other's. Threaded dask workers are
+    traced, distributed ones not.
+
+    :return: None.
+    """
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def get_peak_mb():
+    """
+    Gets peak memory in mb. Uses tracemalloc when it is
+    tracing (see start_tracing, exact per stage as the peak
+    is reset at each span), else the process peak resident
+    size, which only ever grows.
+
+    :return: Float of mb, or None if unavailable.
+    """
+
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1] / 1024 ** 2
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # linux reports kb
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Span:
+    """
+    Timing and i/o record of one pipeline stage for one site
+    or cluster of sites. Stages fill in bytes and scene counts
+    they know of, the rest is measured on close.
+    """
+
+    __slots__ = ('stage', 'sites', 'start', 'wall', 'cpu',
+                 'bytes', 'scenes_in', 'scenes_out', 'peak_mb')
+
+    def __init__(self, stage, sites=None):
+        self.stage = stage
+        self.sites = list(sites or [])
+        self.start = time.time()
+        self.wall = None
+        self.cpu = None
+        self.bytes = None
+        self.scenes_in = None
+        self.scenes_out = None
+        self.peak_mb = None
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+class Recorder:
+    """
+    Collects spans of pipeline stages. Bind a recorder to
+    site ids (see bind) so every span it records is tagged
+    with them, spans are shared with the parent.
+    """
+
+    def __init__(self, sites=None, spans=None):
+        self.sites = list(sites or [])
+        self.spans = [] if spans is None else spans
+
+    def bind(self, sites):
+        """
+        Gets a recorder tagging spans with site ids, sharing
+        this recorder's spans.
+
+        :param sites: List of site ids.
+        :return: Recorder.
+        """
+
+        return Recorder(sites=sites, spans=self.spans)
+
+    def to_dicts(self):
+        return [span.to_dict() for span in self.spans]
+
+    def write(self, path=SPAN_LOG):
+        """
+        Appends all spans to a json lines file.
+
+        :param path: Path to spans file.
+        :return: None.
+        """
+
+        write_spans(self.to_dicts(), path=path)
+
+
+@contextlib.contextmanager
+def span(recorder, stage):
+    """
+    Records a span around a pipeline stage. The span is
+    yielded so the stage can set bytes and scene counts. If
+    recorder is None the span is measured but not kept.
+    Cpu time is process wide, so includes dask workers.
+
+    :param recorder: Recorder, or None.
+    :param stage: Name of the pipeline stage.
+    :return: Span.
+    """
+
+    s = Span(stage, sites=recorder.sites if recorder else None)
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield s
+    finally:
+        s.wall = round(time.perf_counter() - wall, 4)
+        s.cpu = round(time.process_time() - cpu, 4)
+        s.peak_mb = get_peak_mb()
+
+        if recorder is not None:
+            recorder.spans.append(s)
+            LOGGER.info(json.dumps(s.to_dict()))
+
+
+def write_spans(spans, path=SPAN_LOG):
+    """
+    Appends span dicts to a json lines file.
+
+    :param spans: List of span dicts.
+    :param path: Path to spans file.
+    :return: None.
+    """
+
+    if len(spans) == 0:
+        return
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as f:
+        for s in spans:
+            f.write(json.dumps(s) + '\n')
@@ -0,0 +1,140 @@
+# general imports
+import numpy as np
+
+# globals
+DATE_DTYPE = '<i4'   # days since 1970-01-01
+VALUE_DTYPE = '<f4'  # float32 index values
+
+
+def encode_dates(dates):
+    """
+    Encodes dates as little-endian int32 day numbers for
+    storage as a blob.
+
+    :param dates: List or array of date strings or datetime64.
+    :return: Bytes, or None if no dates.
+    """
+
+    if dates is None:
+        return None
+
+    # any date-like input to whole days
+    days = np.asarray(dates, dtype='datetime64[D]').astype('int64')
+
+    return days.astype(DATE_DTYPE).tobytes()
+
+
+def decode_dates(blob):
+    """
+    Decodes a date blob back to an array of datetime64 days.
+    The blob is read in place and widened to datetime64 in a
+    single vectorised cast. Legacy comma-joined text is also
+    accepted.
+
+    :param blob: Bytes from encode_dates, legacy text or None.
+    :return: Numpy datetime64[D] array, or None.
+    """
+
+    if blob is None or len(blob) == 0:
+        return None
+
+    # legacy comma-joined text
+    if isinstance(blob, str):
+        return np.array(blob.split(','), dtype='datetime64[D]')
+
+    return np.frombuffer(blob, dtype=DATE_DTYPE).astype('datetime64[D]')
+
+
+def encode_values(values):
+    """
+    Encodes index values as little-endian float32 for
+    storage as a blob.
+
+    :param values: List or array of floats.
+    :return: Bytes, or None if no values.
+    """
+
+    if values is None:
+        return None
+
+    return np.asarray(values, dtype=VALUE_DTYPE).tobytes()
+
+
+def decode_values(blob):
+    """
+    Decodes a value blob back to a float32 array. The array
+    is a read-only view on the blob, no copy is made. Legacy
+    comma-joined text is also accepted.
+
+    :param blob: Bytes from encode_values, legacy text or None.
+    :return: Numpy float32 array, or None.
+    """
+
+    if blob is None or len(blob) == 0:
+        return None
+
+    # legacy comma-joined text
+    if isinstance(blob, str):
+        return np.array(blob.split(','), dtype='float32')
+
+    return np.frombuffer(blob, dtype=VALUE_DTYPE)
+
+
+def to_msecs(dates):
+    """
+    Converts dates to milliseconds since epoch, as used by
+    qt chart datetime axes.
+
+    :param dates: Array of datetime64 values.
+    :return: Numpy float64 array.
+    """
+
+    return np.asarray(dates).astype('datetime64[ms]').astype('float64')
+
+
+def lttb(x, y, threshold):
+    """
+    Downsamples a series with Largest-Triangle-Three-Buckets,
+    keeping the first and last points and, from each bucket
+    between, the point forming the largest triangle with the
+    previous kept point and the next bucket's average. Nan
+    values are dropped first.
+
+    :param x: 1d numpy array of x values, ascending.
+    :param y: 1d numpy array of y values.
+    :param threshold: Number of points to keep.
+    :return: Tuple of downsampled x and y arrays.
+    """
+
+    # drop gaps, they cannot be drawn
+    keep = ~np.isnan(y)
+    x, y = np.asarray(x, dtype='float64')[keep], np.asarray(y, dtype='float64')[keep]
+
+    # nothing to reduce
+    num_points = len(x)
+    if threshold >= num_points or threshold < 3:
+        return x, y
+
+    # bucket size, excluding first and last points
+    every = (num_points - 2) / (threshold - 2)
+
+    a = 0
+    indexes = np.zeros(threshold, dtype='int64')
+    for i in range(threshold - 2):
+
+        # average of next bucket, used as third triangle vertex
+        avg_start = int(np.floor((i + 1) * every)) + 1
+        avg_end = min(int(np.floor((i + 2) * every)) + 1, num_points)
+        avg_x, avg_y = x[avg_start:avg_end].mean(), y[avg_start:avg_end].mean()
+
+        # point in this bucket with largest triangle
+        start = int(np.floor(i * every)) + 1
+        end = int(np.floor((i + 1) * every)) + 1
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) -
+                       (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        indexes[i + 1] = a
+
+    indexes[-1] = num_points - 1
+
+    return x[indexes], y[indexes]
@@ -1,7 +1,25 @@
+# general imports
+import numpy as np
+
+# projection imports
+from pyproj import Transformer
+
 # shapely imports
-from shapely.geometry import Polygon
+from shapely.geometry import Point, Polygon, box
+from shapely.strtree import STRtree
 from shapely.wkt import loads
 
+# vectorised point in polygon, moved in shapely 2
+try:
+    from shapely import contains_xy
+except ImportError:
+    from shapely.vectorized import contains as contains_xy
+
+# globals
+MASK_CACHE = {}
+MASK_CACHE_SIZE = 256
+GEOGRAPHIC_CRS = 'EPSG:4326'
+
 
 # deprecated
 def qml_polygon_to_wkt(qml_polygon):
@@ -42,3 +60,314 @@ def wkt_to_qml_polygon(wkt_polygon):
     coords = [{'latitude': c[1], 'longitude': c[0]} for c in coords]
 
     return coords
+
+
+def qml_polygon_to_bbox(qml_polygon):
+    """
+    Helper function to get the bounding box of a qml
+    polygon (a list of latitude, longitude dicts).
+
+    :param qml_polygon: List of latitude, longitude dicts.
+    :return: List of min x, min y, max x, max y.
+    """
+
+    xs = [coord.get('longitude') for coord in qml_polygon]
+    ys = [coord.get('latitude') for coord in qml_polygon]
+
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def union_bbox(bboxes):
+    """
+    Gets the bounding box covering a list of bounding boxes.
+
+    :param bboxes: List of bboxes (min x, min y, max x, max y).
+    :return: List of min x, min y, max x, max y.
+    """
+
+    return [min(b[0] for b in bboxes), min(b[1] for b in bboxes),
+            max(b[2] for b in bboxes), max(b[3] for b in bboxes)]
+
+
+def cluster_bboxes(bboxes, max_distance=0.02, max_extent=0.2):
+    """
+    Groups bounding boxes by proximity so neighbouring sites
+    can share one stac query and load. A bbox joins a cluster
+    if it lies within max distance (degrees) of it and the
+    cluster's union extent stays within max extent (degrees).
+
+    :param bboxes: Dict of key to bbox (min x, min y, max x, max y).
+    :param max_distance: Max gap between bbox and cluster in degrees.
+    :param max_extent: Max width or height of a cluster in degrees.
+    :return: List of lists of keys, one per cluster.
+    """
+
+    # sweep west to east so neighbours are met together
+    keys = sorted(bboxes, key=lambda k: bboxes[k][0])
+
+    clusters = []
+    for key in keys:
+        bbox = bboxes[key]
+
+        # find first cluster close enough and still small enough
+        for cluster in clusters:
+            extent = cluster['bbox']
+            gap_x = max(extent[0] - bbox[2], bbox[0] - extent[2], 0)
+            gap_y = max(extent[1] - bbox[3], bbox[1] - extent[3], 0)
+            if max(gap_x, gap_y) > max_distance:
+                continue
+
+            merged = union_bbox([extent, bbox])
+            if max(merged[2] - merged[0], merged[3] - merged[1]) > max_extent:
+                continue
+
+            cluster['keys'].append(key)
+            cluster['bbox'] = merged
+            break
+
+        # else start a new cluster
+        else:
+            clusters.append({'keys': [key], 'bbox': list(bbox)})
+
+    return [cluster['keys'] for cluster in clusters]
+
+
+def erode_mask(mask, pixels=1):
+    """
+    Erodes a boolean mask by a number of pixels, removing
+    any pixel with an out of mask 4-neighbour each pass.
+    Pixels on the array border are treated as edges.
+
+    :param mask: 2d boolean numpy array (y, x).
+    :param pixels: Number of pixels to erode by.
+    :return: 2d boolean numpy array (y, x).
+    """
+
+    for _ in range(pixels):
+        padded = np.pad(mask, 1, constant_values=False)
+        mask = (padded[1:-1, 1:-1] &
+                padded[:-2, 1:-1] & padded[2:, 1:-1] &
+                padded[1:-1, :-2] & padded[1:-1, 2:])
+
+    return mask
+
+
+def is_geographic(crs):
+    """
+    Checks if a crs is the lat, lon crs of qml polygons.
+
+    :param crs: Crs string or None.
+    :return: Bool.
+    """
+
+    return crs is None or str(crs).upper() == GEOGRAPHIC_CRS
+
+
+def project_coords(coords, crs):
+    """
+    Projects lon, lat coordinates into a crs.
+
+    :param coords: List of (lon, lat) tuples.
+    :param crs: Crs string, e.g. EPSG:32750.
+    :return: List of (x, y) tuples.
+    """
+
+    if is_geographic(crs):
+        return list(coords)
+
+    transformer = Transformer.from_crs(GEOGRAPHIC_CRS, crs, always_xy=True)
+    xs, ys = transformer.transform([c[0] for c in coords], [c[1] for c in coords])
+
+    return list(zip(xs, ys))
+
+
+def project_bbox(bbox, crs):
+    """
+    Projects a lon, lat bbox into a crs, returning the bbox
+    covering it there.
+
+    :param bbox: List of min x, min y, max x, max y in lon, lat.
+    :param crs: Crs string, e.g. EPSG:32750.
+    :return: List of min x, min y, max x, max y in crs units.
+    """
+
+    if is_geographic(crs):
+        return list(bbox)
+
+    transformer = Transformer.from_crs(GEOGRAPHIC_CRS, crs, always_xy=True)
+
+    return list(transformer.transform_bounds(*bbox))
+
+
+def rasterize_polygon(qml_polygon, xs, ys, erode=0, crs=None):
+    """
+    Rasterizes a qml polygon onto a grid of pixel centres,
+    returning a boolean mask of pixels inside the polygon.
+    Masks are cached per polygon, grid and erosion so each
+    site is only rasterized once per grid. If erosion would
+    remove every pixel, the uneroded mask is returned, and
+    if no pixel centre falls inside, the whole grid is.
+
+    :param qml_polygon: List of latitude, longitude dicts.
+    :param xs: 1d array of pixel centre x coordinates.
+    :param ys: 1d array of pixel centre y coordinates.
+    :param erode: Number of edge pixels to erode by.
+    :param crs: Crs of grid, polygon is projected to it, defaults to lat, lon.
+    :return: 2d boolean numpy array (y, x).
+    """
+
+    # build key from polygon and grid
+    xs, ys = np.asarray(xs), np.asarray(ys)
+    coords = tuple((c.get('longitude'), c.get('latitude')) for c in qml_polygon)
+    grid = (len(xs), xs[0], xs[-1], len(ys), ys[0], ys[-1]) if len(xs) and len(ys) else ()
+    key = (coords, grid, erode, None if is_geographic(crs) else str(crs).upper())
+
+    # cache hit
+    if key in MASK_CACHE:
+        return MASK_CACHE[key]
+
+    # test every pixel centre against polygon
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    mask = contains_xy(Polygon(project_coords(coords, crs)), grid_x, grid_y)
+
+    # polygon smaller than a pixel, fall back to whole grid
+    if not mask.any():
+        mask = np.ones_like(mask)
+
+    # erode, but never to nothing
+    if erode > 0:
+        eroded = erode_mask(mask, pixels=erode)
+        mask = eroded if eroded.any() else mask
+
+    # drop oldest if cache is full
+    if len(MASK_CACHE) >= MASK_CACHE_SIZE:
+        MASK_CACHE.pop(next(iter(MASK_CACHE)))
+    MASK_CACHE[key] = mask
+
+    return mask
+
+
+class SiteIndex:
+    """
+    STRtree spatial index over site polygons, keyed by site
+    id. The tree is immutable, so edits mark it stale and it
+    is rebuilt on the next query. Also caches polygons
+    simplified to one screen pixel per web map zoom level.
+    """
+
+    def __init__(self):
+        self.polygons = {}
+        self.simplified = {}
+        self.tree = None
+        self.tree_ids = []
+
+    def insert(self, id, qml_polygon):
+        """
+        Adds or replaces a site polygon.
+
+        :param id: Site id.
+        :param qml_polygon: List of latitude, longitude dicts.
+        :return: None.
+        """
+
+        coords = [(c.get('longitude'), c.get('latitude')) for c in qml_polygon]
+        if len(coords) < 3:
+            return
+
+        self.polygons[id] = Polygon(coords)
+        self.simplified = {key: val for key, val in self.simplified.items() if key[0] != id}
+        self.tree = None
+
+    def delete(self, id):
+        """
+        Removes a site polygon.
+
+        :param id: Site id.
+        :return: None.
+        """
+
+        if self.polygons.pop(id, None) is not None:
+            self.simplified = {key: val for key, val in self.simplified.items() if key[0] != id}
+            self.tree = None
+
+    def query(self, geometry):
+        """
+        Gets ids of sites intersecting a shapely geometry.
+
+        :param geometry: Shapely geometry.
+        :return: List of site ids.
+        """
+
+        if len(self.polygons) == 0:
+            return []
+
+        # rebuild stale tree
+        if self.tree is None:
+            self.tree_ids = list(self.polygons)
+            self.tree = STRtree([self.polygons[site_id] for site_id in self.tree_ids])
+
+        # shapely 2 gives indexes, shapely 1 gives geometries
+        hits = self.tree.query(geometry)
+        if len(hits) > 0 and not isinstance(hits[0], (int, np.integer)):
+            positions = {id(polygon): i for i, polygon in enumerate(self.tree.geometries)}
+            hits = [positions[id(hit)] for hit in hits]
+
+        # envelopes overlap, check actual geometry
+        ids = [self.tree_ids[i] for i in hits]
+        return [site_id for site_id in ids if self.polygons[site_id].intersects(geometry)]
+
+    def query_bbox(self, bbox):
+        """
+        Gets ids of sites intersecting a bbox, e.g. the map
+        viewport.
+
+        :param bbox: List of min x, min y, max x, max y.
+        :return: Set of site ids.
+        """
+
+        return set(self.query(box(*bbox)))
+
+    def query_point(self, x, y):
+        """
+        Gets the id of the site containing a point, the
+        smallest if sites overlap, for picking.
+
+        :param x: Longitude.
+        :param y: Latitude.
+        :return: Site id or None.
+        """
+
+        ids = self.query(Point(x, y))
+        if len(ids) == 0:
+            return None
+
+        return min(ids, key=lambda id: self.polygons[id].area)
+
+    def simplify(self, id, zoom):
+        """
+        Gets a site polygon simplified to about one screen pixel
+        at a web map zoom level, as a qml polygon. Cached per
+        whole zoom level.
+
+        :param id: Site id.
+        :param zoom: Map zoom level.
+        :return: List of latitude, longitude dicts, or None.
+        """
+
+        polygon = self.polygons.get(id)
+        if polygon is None:
+            return None
+
+        key = (id, int(zoom))
+        if key not in self.simplified:
+
+            # degrees per 256 px tile pixel at this zoom
+            tolerance = 360 / (256 * 2 ** int(zoom))
+            simple = polygon.simplify(tolerance, preserve_topology=True)
+            if simple.is_empty or simple.geom_type != 'Polygon':
+                simple = polygon
+
+            self.simplified[key] = [{'latitude': y, 'longitude': x}
+                                    for x, y in simple.exterior.coords]
+
+        return self.simplified[key]
@@ -0,0 +1,275 @@
+# general imports
+import os
+import json
+
+# globals
+SERIES_KEYS = ['dates', 'veg_raw', 'veg_smooth', 'indices', 'change']
+COMPACT_RATIO = 2.0  # compact once dead records exceed live records by this factor
+
+
+class SiteStore:
+    """
+    Append-only journal of sites, one json record per line.
+    Each edit appends only the changed site, deletes append a
+    tombstone, and the journal is compacted once dead records
+    outweigh live ones. Time series are held in their own
+    records so loading can skip them and read them on demand.
+
+    Records look like:
+        {"op": "put", "id": 1, "site": {...}}
+        {"op": "series", "id": 1, "series": {"dates": [...], ...}}
+        {"op": "delete", "id": 1}
+    """
+
+    def __init__(self, path, legacy_path=None):
+        """
+        :param path: Path to journal file (.jsonl).
+        :param legacy_path: Path to old whole-file json store to import once.
+        """
+        self.path = path
+        self.legacy_path = legacy_path
+        self.sites = {}
+        self.series_offsets = {}
+        self.num_records = 0
+
+    def load(self, series=False):
+        """
+        Replays the journal into a dict of id to site. If series
+        is False, series records are skipped without parsing and
+        only their file offsets are kept for get_series.
+
+        :param series: Parse and attach series to sites.
+        :return: Dict of site id to site dict.
+        """
+
+        # import old whole-file store on first run
+        if not os.path.exists(self.path) and self.legacy_path and os.path.exists(self.legacy_path):
+            self.import_legacy()
+
+        self.sites, self.series_offsets, self.num_records = {}, {}, 0
+        if not os.path.exists(self.path):
+            return self.sites
+
+        with open(self.path, 'rb') as f:
+            offset = f.tell()
+            for line in iter(f.readline, b''):
+                self.num_records += 1
+
+                # skip heavy series payloads, note where they are
+                if not series and line.startswith(b'{"op": "series"'):
+                    id = json.loads(line[:line.index(b', "series"')] + b'}')['id']
+                    self.series_offsets[id] = offset
+                    offset = f.tell()
+                    continue
+
+                offset_of_line, offset = offset, f.tell()
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print('Skipping unreadable journal record.')
+                    continue
+
+                # apply record
+                id = record['id']
+                if record['op'] == 'put':
+                    site = dict(record['site'])
+                    site.update({key: None for key in SERIES_KEYS})
+                    if id in self.sites:
+                        site.update({key: self.sites[id].get(key) for key in SERIES_KEYS})
+                    self.sites[id] = site
+                elif record['op'] == 'series':
+                    self.series_offsets[id] = offset_of_line
+                    if id in self.sites:
+                        self.sites[id].update(record['series'])
+                elif record['op'] == 'delete':
+                    self.sites.pop(id, None)
+                    self.series_offsets.pop(id, None)
+
+        # forget series of deleted sites
+        self.series_offsets = {id: o for id, o in self.series_offsets.items() if id in self.sites}
+
+        return self.sites
+
+    def get_series(self, id):
+        """
+        Reads the latest series record of a site on demand.
+
+        :param id: Site id.
+        :return: Dict of series keys to lists, or None.
+        """
+
+        offset = self.series_offsets.get(id)
+        if offset is None:
+            return None
+
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())['series']
+
+    def get_stored_series(self, id):
+        """
+        Gets a site's full stored series, from memory if
+        loaded, else from its latest series record.
+
+        :param id: Site id.
+        :return: Dict of series keys to lists, may be empty.
+        """
+
+        site = self.sites.get(id) or {}
+        if any(site.get(key) is not None for key in SERIES_KEYS):
+            return {key: site.get(key) for key in SERIES_KEYS}
+
+        return self.get_series(id) or {}
+
+    def next_id(self):
+        """
+        Gets an unused site id.
+
+        :return: Integer id.
+        """
+
+        return max(self.sites, default=0) + 1
+
+    def put(self, site):
+        """
+        Appends a site's attributes, and its series if it has
+        any, to the journal.
+
+        :param site: Site dict with an id.
+        :return: None.
+        """
+
+        self.put_many([site])
+
+    def put_many(self, sites):
+        """
+        Appends several sites to the journal in a single write
+        and sync, e.g. the results of a batch run. Series keys
+        not given are merged from the stored series, so each
+        series record is complete on its own.
+
+        :param sites: List of site dicts with ids.
+        :return: None.
+        """
+
+        records, updated = [], []
+        for site in sites:
+            id = site['id']
+            attrs = {key: value for key, value in site.items()
+                     if key not in SERIES_KEYS and key != 'selected'}
+            records.append({'op': 'put', 'id': id, 'site': attrs})
+
+            # only write series if present, keys not given are kept as stored
+            series = {key: site[key] for key in SERIES_KEYS if key in site}
+            if any(value is not None for value in series.values()):
+                if len(series) < len(SERIES_KEYS):
+                    stored = self.get_stored_series(id)
+                    series = dict({key: stored.get(key) for key in SERIES_KEYS}, **series)
+                records.append({'op': 'series', 'id': id, 'series': series})
+                site = dict(site, **series)
+
+            updated.append(site)
+
+        self.append(records)
+        for site in updated:
+            self.sites[site['id']] = dict(site)
+
+        self.compact_if_needed()
+
+    def delete(self, id):
+        """
+        Appends a tombstone for a site to the journal.
+
+        :param id: Site id.
+        :return: None.
+        """
+
+        self.append([{'op': 'delete', 'id': id}])
+        self.sites.pop(id, None)
+        self.series_offsets.pop(id, None)
+
+        self.compact_if_needed()
+
+    def compact_if_needed(self):
+        """
+        Compacts the journal once dead records outweigh live
+        ones by COMPACT_RATIO. Live sites have a put and maybe
+        a series record.
+
+        :return: True if compacted.
+        """
+
+        live = len(self.sites) + len(self.series_offsets)
+        if self.num_records - live <= max(live, 1) * COMPACT_RATIO:
+            return False
+
+        self.compact()
+
+        return True
+
+    def append(self, records):
+        """
+        Appends records to the journal, tracking offsets of
+        series records.
+
+        :param records: List of record dicts.
+        :return: None.
+        """
+
+        with open(self.path, 'ab') as f:
+            for record in records:
+                if record['op'] == 'series':
+                    self.series_offsets[record['id']] = f.tell()
+                f.write(json.dumps(record).encode() + b'\n')
+                self.num_records += 1
+            f.flush()
+            os.fsync(f.fileno())
+
+    def compact(self):
+        """
+        Rewrites the journal with one put (and series) record per
+        live site, replacing the old journal atomically.
+
+        :return: None.
+        """
+
+        # notify
+        print('Compacting site journal.')
+
+        # gather live sites with their series
+        sites = []
+        for id, site in self.sites.items():
+            site = dict(site)
+            if all(site.get(key) is None for key in SERIES_KEYS):
+                site.update(self.get_series(id) or {})
+            sites.append(site)
+
+        # write to temp file then swap in
+        tmp_path = self.path + '.tmp'
+        open(tmp_path, 'wb').close()
+        path, self.path = self.path, tmp_path
+        self.series_offsets, self.num_records = {}, 0
+        try:
+            self.put_many(sites)
+        finally:
+            self.path = path
+        os.replace(tmp_path, self.path)
+
+    def import_legacy(self):
+        """
+        Imports sites from the old whole-file json store into
+        a new journal, assigning ids to any sites without one.
+
+        :return: None.
+        """
+
+        # notify
+        print('Importing sites from {}.'.format(self.legacy_path))
+
+        with open(self.legacy_path, 'r') as f:
+            sites = json.load(f)
+
+        for site in sites:
+            if site.get('id') is None:
+                site['id'] = self.next_id()
+            self.put(site)
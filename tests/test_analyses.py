@@ -0,0 +1,48 @@
+# general imports
+import numpy as np
+import pytest
+import xarray as xr
+
+# pipeline needs odc, stac and pyproj installed
+pytest.importorskip('odc.stac')
+pytest.importorskip('pystac_client')
+pytest.importorskip('pyproj')
+
+# external scripts imports
+from scripts import analyses
+from scripts import cubes
+
+
+def make_cube(from_date='1990-01-01', to_date='2020-01-01'):
+    times = np.arange(from_date, to_date, 16, dtype='datetime64[D]')
+    values = np.random.default_rng(0).uniform(0.2, 0.8, (len(times), 8, 8)).astype('float32')
+    return xr.Dataset({'ndvi': (('time', 'y', 'x'), values)},
+                      coords={'time': times,
+                              'y': np.linspace(-22.0, -22.01, 8),
+                              'x': np.linspace(119.0, 119.01, 8)})
+
+
+def test_load_means_without_cube_cache_detects_change(monkeypatch):
+    """
+    With the cube cache off, load_means used to read a
+    missing checked_from attribute and raise KeyError.
+    """
+
+    monkeypatch.setattr(cubes, 'CUBE_CACHE_ENABLED', False)
+    monkeypatch.setattr(analyses, 'load_cube', lambda *args, **kwargs: make_cube())
+
+    geometry = [{'latitude': -22.002, 'longitude': 119.002}, {'latitude': -22.002, 'longitude': 119.008},
+                {'latitude': -22.008, 'longitude': 119.008}, {'latitude': -22.008, 'longitude': 119.002}]
+    means, site_change = analyses.load_means(items=[object()],
+                                             geometry=geometry,
+                                             bbox=[119.0, -22.01, 119.01, -22.0],
+                                             crs='EPSG:4326',
+                                             index_names=['NDVI'],
+                                             erode=0,
+                                             from_date=analyses.FROM_DATE,
+                                             to_date='2020-01-01',
+                                             ewmacd=True)
+
+    assert len(means['time']) > 0
+    assert site_change is not None
+    assert len(site_change['dates']) == len(means['time'])